@@ -1,8 +1,19 @@
 import os
 import csv
 import cv2
+import queue
+import threading
+import contextvars
 from argparse import ArgumentParser
-from downloader.downloader_center import get_img_center_by_pixels
+from downloader.downloader_center import get_img_center_by_pixels, center_tile_range_by_pixels
+from utils.batch_plan import BatchPlan
+from utils.session import session_scope
+from utils.policy import AdaptivePolicy
+from utils.tile_cache import TileCache, cache_scope
+from utils.hedge import HedgePolicy, hedge_scope
+from utils.placeholder import PlaceholderRegistry, placeholder_scope
+from utils.metrics import run_scope, record_queue
+from utils.concurrent_helper import TaskStats, observer_scope
 
 # 配置参数
 DESIRED_WIDTH_PX = 20000
@@ -131,6 +142,138 @@ def parse_csv(csv_path):
     return loc_list
 
 
+class _PipelineStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.success_count = 0
+        self.fail_count = 0
+
+    def success(self):
+        with self.lock:
+            self.success_count += 1
+
+    def fail(self):
+        with self.lock:
+            self.fail_count += 1
+
+
+def plan_batch(source, loc_list, start_idx, end_idx):
+    """按下载顺序计算各位置的瓦片范围，相邻位置重叠的瓦片只请求一次"""
+    windows = []
+    for idx in range(start_idx, end_idx):
+        lat, lng = loc_list[idx][0], loc_list[idx][1]
+        windows.append(center_tile_range_by_pixels(lng, lat, DESIRED_WIDTH_PX, DESIRED_HEIGHT_PX, ZOOM))
+    return BatchPlan(source, ZOOM, windows)
+
+
+def _download_stage(args, loc_list, start_idx, end_idx, out_q, slots, stats, plan=None):
+    """逐个位置顺序下载，不增加对瓦片服务的并发"""
+    # 自适应策略在整批位置之间复用，保留已学到的并发数和延迟
+    policy = AdaptivePolicy(max_concurrency=args.nproc) if args.adaptive else None
+    try:
+        for idx in range(start_idx, end_idx):
+            # 画布数达到上限时等待后续阶段释放
+            slots.acquire()
+            try:
+                # 注意: CSV 中格式为 [lat, lng]，使用时需要转换为 [lng, lat]
+                lat, lng = loc_list[idx][0], loc_list[idx][1]
+                print(f"[{idx+1}/{end_idx-start_idx}] 开始下载索引 {idx} / {end_idx-1}")
+                image = get_img_center_by_pixels(
+                    lng, lat,
+                    DESIRED_WIDTH_PX, DESIRED_HEIGHT_PX,
+                    args.source, ZOOM, nproc=args.nproc, engine=args.engine, policy=policy,
+                    memmap_dir=args.memmap_dir, decode_workers=args.decode_workers,
+                    batch=plan.job(idx - start_idx) if plan is not None else None,
+                    fallback=args.fallback
+                )
+            except Exception as e:
+                print(f"索引 {idx} 错误: {str(e)}")
+                stats.fail()
+                slots.release()
+                continue
+            if image is None:
+                print(f"索引 {idx} 跳过 (下载失败过多)")
+                stats.fail()
+                slots.release()
+                continue
+            out_q.put((idx, image))
+            record_queue('hrw_enhance', out_q.qsize())
+            image = None
+    finally:
+        out_q.put(None)
+
+
+def _enhance_stage(mode, in_q, out_q, slots, stats):
+    while True:
+        item = in_q.get()
+        if item is None:
+            out_q.put(None)
+            return
+        idx, image = item
+        try:
+            # 可选增强（默认关闭）。
+            if mode != 'none':
+                image = enhance_image(image, mode)
+        except Exception as e:
+            print(f"索引 {idx} 错误: {str(e)}")
+            stats.fail()
+            slots.release()
+            continue
+        out_q.put((idx, image))
+        record_queue('hrw_encode', out_q.qsize())
+        item = image = None
+
+
+def _encode_stage(save_path, prefix, source, in_q, slots, stats):
+    while True:
+        item = in_q.get()
+        if item is None:
+            return
+        idx, image = item
+        try:
+            # 保存图像
+            filename = f"{prefix}_{idx}_{source}.jpg"
+            filepath = os.path.join(save_path, filename)
+            cv2.imencode('.jpg', image)[1].tofile(filepath)
+            print(f"索引 {idx} 完成")
+            stats.success()
+        except Exception as e:
+            print(f"索引 {idx} 错误: {str(e)}")
+            stats.fail()
+        finally:
+            # 释放对画布的引用后再归还名额
+            item = image = None
+            slots.release()
+
+
+def run_pipeline(args, loc_list, start_idx, end_idx, save_path, prefix, plan=None):
+    """
+    位置N+1下载的同时对位置N做增强和编码，阶段之间用有界队列连接，
+    同时存在的画布数不超过args.max_inflight
+    :param plan: 瓦片去重计划，见plan_batch
+    :return: (成功数, 失败数)
+    """
+    max_inflight = max(1, args.max_inflight)
+    slots = threading.BoundedSemaphore(max_inflight)
+    enhance_q = queue.Queue(maxsize=max_inflight)
+    encode_q = queue.Queue(maxsize=max_inflight)
+    stats = _PipelineStats()
+
+    workers = [
+        # 各阶段线程继承当前的run_scope等作用域
+        threading.Thread(target=contextvars.copy_context().run,
+                         args=(_enhance_stage, args.enhance, enhance_q, encode_q, slots, stats)),
+        threading.Thread(target=contextvars.copy_context().run,
+                         args=(_encode_stage, save_path, prefix, args.source, encode_q, slots, stats)),
+    ]
+    for worker in workers:
+        worker.start()
+    _download_stage(args, loc_list, start_idx, end_idx, enhance_q, slots, stats, plan)
+    for worker in workers:
+        worker.join()
+    return stats.success_count, stats.fail_count
+
+
 def main():
     # 解析命令行参数
     parser = ArgumentParser(description='下载指定区域的高分辨率卫星图像')
@@ -156,11 +299,89 @@ def main():
         '--nproc', type=int, default=8,
         help='并发进程数 (默认: 8)'
     )
+    parser.add_argument(
+        '--engine', type=str, default='thread',
+        choices=['thread', 'async'],
+        help='下载引擎: thread(默认, 逐列线程池) 或 async(asyncio, 需安装aiohttp)'
+    )
     parser.add_argument(
         '--enhance', type=str, default='none',
         choices=['none', 'gentle', 'bing'],
         help='图像增强模式: none(默认)/gentle/bing，增强会尽量避免增白'
     )
+    parser.add_argument(
+        '--adaptive', action='store_true',
+        help='按瓦片主机自适应调整并发、超时和重试退避，--nproc作为并发上限'
+    )
+    parser.add_argument(
+        '--cache-dir', type=str, default=None,
+        help='本地瓦片缓存目录，多次运行和相邻位置之间复用已下载的瓦片 (默认: 不启用)'
+    )
+    parser.add_argument(
+        '--cache-size-gb', type=float, default=20,
+        help='瓦片缓存容量上限(GB)，超出后按最近访问时间淘汰 (默认: 20)'
+    )
+    parser.add_argument(
+        '--memmap-dir', type=str, default=None,
+        help='画布改用该目录下的np.memmap临时文件承载，降低每个位置的内存占用 (默认: 内存)'
+    )
+    parser.add_argument(
+        '--decode-workers', type=int, default=0,
+        help='瓦片解码进程数，大于0时解码在进程池中进行并直接写入共享内存画布，不能与--memmap-dir同时使用 (默认: 0)'
+    )
+    parser.add_argument(
+        '--max-inflight', type=int, default=2,
+        help='流水线中同时存在的画布数上限，控制内存占用 (默认: 2)'
+    )
+    parser.add_argument(
+        '--fallback', type=str, nargs='*', default=[],
+        choices=['google', 'bing', 'tianditu', 'arcgis'],
+        help='备用数据源，按顺序补齐主数据源失败或空白的瓦片，如 --fallback bing arcgis (默认: 不启用)'
+    )
+    parser.add_argument(
+        '--hedge', action='store_true',
+        help='瓦片超过自适应阈值仍未响应时向另一个镜像子域名发送对冲请求，取先返回的结果'
+    )
+    parser.add_argument(
+        '--hedge-ratio', type=float, default=0.1,
+        help='对冲请求数占总请求数的上限 (默认: 0.1)'
+    )
+    parser.add_argument(
+        '--placeholders', type=str, default=None,
+        help='占位瓦片指纹库json文件，匹配的瓦片不解码不写入，输出中为nodata；不存在时新建 (默认: 不启用)'
+    )
+    parser.add_argument(
+        '--learn-placeholders', type=int, default=0,
+        help='同一数据源中字节完全相同的小瓦片出现该次数后自动加入指纹库 (默认: 0, 不学习)'
+    )
+    parser.add_argument(
+        '--overzoom', type=int, default=0,
+        help='占位瓦片改为从低1~N级的父瓦片裁剪放大补齐 (默认: 0)'
+    )
+    parser.add_argument(
+        '--dedup', action='store_true',
+        help='事先计算所有位置瓦片范围的并集，相互重叠的瓦片整批只请求一次'
+    )
+    parser.add_argument(
+        '--metrics-json', type=str, default=None,
+        help='整批的运行指标(请求数、状态码、重试、字节数、延迟、解码/写入耗时、队列深度)保存为json (默认: 不保存)'
+    )
+    parser.add_argument(
+        '--metrics-prom', type=str, default=None,
+        help='整批的运行指标保存为Prometheus文本格式，可供node_exporter的textfile collector读取 (默认: 不保存)'
+    )
+    parser.add_argument(
+        '--task-stats', action='store_true',
+        help='统计并发任务(瓦片下载等)的耗时分位数和最慢的任务，整批结束时打印'
+    )
+    parser.add_argument(
+        '--profile-rate', type=float, default=0.0,
+        help='用cProfile剖析的并发任务比例，如0.01，整批结束时打印热点函数 (默认: 0, 不剖析)'
+    )
+    parser.add_argument(
+        '--profile-out', type=str, default=None,
+        help='剖析结果保存为pstats文件，可用snakeviz查看 (默认: 不保存)'
+    )
     args = parser.parse_args()
 
     # 获取数据集配置
@@ -188,52 +409,63 @@ def main():
     
     print(f"开始下载: 索引 {start_idx} 到 {end_idx-1}")
     print(f"保存路径: {save_path}")
-    print(f"数据源: {args.source}, 缩放级别: {ZOOM}, 并发数: {args.nproc}, 增强: {args.enhance}")
+    print(f"数据源: {args.source}, 缩放级别: {ZOOM}, 并发数: {args.nproc}, 增强: {args.enhance}, "
+          f"在途画布数: {args.max_inflight}")
     print("=" * 80)
 
-    # 下载图像
-    success_count = 0
-    fail_count = 0
-    
-    for idx in range(start_idx, end_idx):
-        try:
-            loc = loc_list[idx]
-            print(f"[{idx+1}/{end_idx-start_idx}] 处理索引 {idx} / {end_idx-1}", end=' ... ')
-            
-            # 注意: CSV 中格式为 [lat, lng]，使用时需要转换为 [lng, lat]
-            lat, lng = loc[0], loc[1]
-            
-            image = get_img_center_by_pixels(
-                lng, lat,
-                DESIRED_WIDTH_PX, DESIRED_HEIGHT_PX,
-                args.source, ZOOM, nproc=args.nproc
-            )
+    plan = None
+    if args.dedup:
+        plan = plan_batch(args.source, loc_list, start_idx, end_idx)
+        plan.report()
+
+    cache = None
+    if args.cache_dir:
+        cache = TileCache(args.cache_dir, int(args.cache_size_gb * 1024 ** 3))
+        print(f"瓦片缓存: {args.cache_dir}, 容量上限: {args.cache_size_gb} GB")
+
+    hedge = HedgePolicy(max_ratio=args.hedge_ratio) if args.hedge else None
+    registry = None
+    if args.placeholders:
+        registry = PlaceholderRegistry(args.placeholders, learn_threshold=args.learn_placeholders,
+                                       overzoom=args.overzoom)
+
+    task_stats = None
+    if args.task_stats or args.profile_rate > 0:
+        task_stats = TaskStats(profile_rate=args.profile_rate)
+
+    # 下载图像：下载、增强、编码三个阶段流水线并行
+    # 每个位置结束时打印该位置的指标汇总，整批的汇总在最后打印
+    with run_scope('HRW batch', report=False) as metrics, session_scope(args.nproc), cache_scope(cache), \
+            hedge_scope(hedge), placeholder_scope(registry), observer_scope(task_stats):
+        success_count, fail_count = run_pipeline(args, loc_list, start_idx, end_idx, save_path, prefix, plan)
 
-            # 可选增强（默认关闭）。
-            if args.enhance != 'none':
-                image = enhance_image(image, args.enhance)
-            
-            if image is None:
-                print("跳过 (下载失败过多)")
-                fail_count += 1
-                continue
-            
-            # 保存图像
-            filename = f"{prefix}_{idx}_{args.source}.jpg"
-            filepath = os.path.join(save_path, filename)
-            cv2.imencode('.jpg', image)[1].tofile(filepath)
-            print("完成")
-            success_count += 1
-            
-        except Exception as e:
-            print(f"错误: {str(e)}")
-            fail_count += 1
-            continue
-    
     # 打印统计信息
     print("=" * 80)
     print(f"下载完成!")
     print(f"成功: {success_count}, 失败: {fail_count}, 总计: {success_count + fail_count}")
+    if plan is not None:
+        print(f"批量去重: 复用重叠瓦片 {plan.hits} 次")
+    if registry is not None:
+        registry.save()
+        print(f"占位瓦片: {registry.summary()}")
+    if hedge is not None:
+        stats = hedge.summary()
+        print(f"对冲请求: {stats['hedges']}/{stats['requests']} ({stats['hedge_ratio']:.1%}), "
+              f"对冲胜出 {stats['hedge_wins']} 次 ({stats['hedge_win_ratio']:.1%}), 当前阈值 {stats['delay']}s")
+    metrics.report()
+    if args.metrics_json:
+        metrics.save_json(args.metrics_json)
+        print(f"运行指标已保存: {args.metrics_json}")
+    if args.metrics_prom:
+        metrics.save_prometheus(args.metrics_prom)
+        print(f"运行指标已保存: {args.metrics_prom}")
+    if task_stats is not None:
+        task_stats.report()
+        if args.profile_rate > 0:
+            task_stats.print_profile()
+        if args.profile_out:
+            task_stats.dump_profile(args.profile_out)
+            print(f"剖析结果已保存: {args.profile_out}")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,205 @@
+import re
+import time
+import random
+import threading
+import http.server
+import socketserver
+from urllib.parse import urlsplit, parse_qs
+import cv2
+import numpy as np
+
+# 合成瓦片的种类数，按瓦片坐标选择其中之一
+pool_size = 32
+
+
+def make_tile_pool(size=pool_size, quality=85, seed=0):
+    """
+    生成一组256*256的合成JPEG瓦片：平滑的低频纹理加噪声，编码后大小与真实卫星瓦片接近(约15~25KB)
+    """
+    rng = np.random.default_rng(seed)
+    pool = []
+    for _ in range(size):
+        base = rng.integers(0, 256, (8, 8, 3), dtype=np.uint8)
+        img = cv2.resize(base, (256, 256), interpolation=cv2.INTER_CUBIC).astype(np.int16)
+        img += rng.integers(-24, 25, (256, 256, 3), dtype=np.int16)
+        img = np.clip(img, 0, 255).astype(np.uint8)
+        pool.append(cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes())
+    return pool
+
+
+def _quadkey_to_tile(quadkey):
+    x = y = 0
+    for digit in quadkey:
+        d = int(digit)
+        x = (x << 1) | (d & 1)
+        y = (y << 1) | (d >> 1)
+    return x, y, len(quadkey)
+
+
+def parse_tile_request(url):
+    """
+    按utils.url.format_url的格式解析瓦片请求
+    :return: (数据源, x, y, z)，无法识别时返回None
+    """
+    parts = urlsplit(url)
+    host, path = parts.netloc, parts.path
+    if host.endswith('google.com'):
+        m = re.search(r'x=(\d+)&y=(\d+)&z=(\d+)', path + '&' + parts.query)
+        return m and ('google', int(m.group(1)), int(m.group(2)), int(m.group(3)))
+    if host.endswith('virtualearth.net'):
+        m = re.search(r'/tiles/a([0-3]*)\.jpeg', path)
+        return m and ('bing',) + _quadkey_to_tile(m.group(1))
+    if host.endswith('tianditu.gov.cn'):
+        q = parse_qs(parts.query)
+        if not all(k in q for k in ('x', 'y', 'l')):
+            return None
+        return 'tianditu', int(q['x'][0]), int(q['y'][0]), int(q['l'][0])
+    if host.endswith('arcgisonline.com'):
+        m = re.search(r'/tile/(\d+)/(\d+)/(\d+)', path)
+        return m and ('arcgis', int(m.group(3)), int(m.group(2)), int(m.group(1)))
+    return None
+
+
+class ServerConfig(object):
+    """
+    模拟服务的行为
+    :param latency: 延迟分布，("constant", 秒) / ("uniform", 最小, 最大) / ("lognormal", 中位数, sigma)
+    :param error_rate: 随机返回500的比例
+    :param burst_interval: 每隔burst_interval秒出现一次持续burst_duration秒的限流，期间按burst_rate的比例返回429；为0时不限流
+    :param slow_rate: 额外注入slow_latency秒长尾延迟的请求比例
+    """
+
+    def __init__(self, latency=('lognormal', 0.05, 0.5), error_rate=0.0, burst_interval=0.0, burst_duration=1.0,
+                 burst_rate=0.8, slow_rate=0.0, slow_latency=1.5, seed=0):
+        self.latency = tuple(latency)
+        self.error_rate = error_rate
+        self.burst_interval = burst_interval
+        self.burst_duration = burst_duration
+        self.burst_rate = burst_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.seed = seed
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+    def sample_latency(self, rng):
+        kind = self.latency[0]
+        if kind == 'constant':
+            t = self.latency[1]
+        elif kind == 'uniform':
+            t = rng.uniform(self.latency[1], self.latency[2])
+        elif kind == 'lognormal':
+            t = self.latency[1] * rng.lognormvariate(0, self.latency[2])
+        else:
+            raise ValueError("unknow latency distribution, {}".format(kind))
+        if self.slow_rate and rng.random() < self.slow_rate:
+            t += self.slow_latency
+        return t
+
+
+def parse_latency(text):
+    """
+    命令行的延迟分布，如"constant:0.05"、"uniform:0.01,0.1"、"lognormal:0.05,0.5"
+    """
+    kind, _, args = text.partition(':')
+    return (kind,) + tuple(float(v) for v in args.split(',') if v)
+
+
+class MockTileServer(object):
+    """
+    本地模拟瓦片服务，作为HTTP代理运行：下载进程设置HTTP_PROXY指向它后，format_url生成的
+    google/bing/tianditu/arcgis地址原样请求，主机名(镜像子域名)保持不变，按主机的自适应策略和对冲请求照常工作。
+    记录每个请求的状态码、字节数和服务端耗时
+    """
+
+    def __init__(self, config=None, host='127.0.0.1', port=0):
+        self.config = config or ServerConfig()
+        self.pool = make_tile_pool(seed=self.config.seed)
+        self.rng = random.Random(self.config.seed)
+        self.rng_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.records = []
+        self.start_time = time.time()
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                server._handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+            daemon_threads = True
+            # async引擎同时建立数百个连接，默认的监听队列(5)溢出后客户端要等SYN重传
+            request_queue_size = 1024
+
+            def handle_error(self, request, client_address):
+                # 客户端断开连接(keep-alive连接随下载进程退出)不打印
+                pass
+
+        self.httpd = Server((host, port), Handler)
+        self.thread = None
+
+    @property
+    def proxy_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop()
+
+    def reset(self):
+        with self.lock:
+            records, self.records = self.records, []
+        return records
+
+    def _decide(self, tile):
+        config = self.config
+        with self.rng_lock:
+            latency = config.sample_latency(self.rng)
+            r = self.rng.random()
+        if tile is None:
+            return latency, 404
+        now = time.time() - self.start_time
+        if config.burst_interval and now % config.burst_interval < config.burst_duration and r < config.burst_rate:
+            return latency, 429
+        if r < config.error_rate:
+            return latency, 500
+        return latency, 200
+
+    def _handle(self, handler):
+        s = time.time()
+        tile = parse_tile_request(handler.path)
+        latency, status = self._decide(tile)
+        time.sleep(latency)
+        body = b''
+        if status == 200:
+            source, x, y, z = tile
+            body = self.pool[hash((x, y, z)) % len(self.pool)]
+        try:
+            handler.send_response(status)
+            handler.send_header('Content-Type', 'image/jpeg')
+            handler.send_header('Content-Length', str(len(body)))
+            handler.end_headers()
+            handler.wfile.write(body)
+        except OSError:
+            # 客户端已放弃(超时或对冲请求被取消)
+            status = -1
+        with self.lock:
+            self.records.append((tile[0] if tile else None, status, len(body), time.time() - s))
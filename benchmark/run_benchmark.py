@@ -0,0 +1,256 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import platform
+import subprocess
+from collections import Counter
+from argparse import ArgumentParser, SUPPRESS
+import numpy as np
+from benchmark.mock_tile_server import MockTileServer, ServerConfig, parse_latency
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# 基准区域：武汉大学附近，与main.py的示例一致
+CENTER = (114.359383, 30.535471)
+ZOOM = 19
+
+# 用例名 -> (下载函数, 输出类型)；*_GTiff用例的输出类型传给output参数，stream为spool='stream'
+CASES = {
+    'tblr': ('get_img_tblr', None),
+    'center_by_pixels': ('get_img_center_by_pixels', None),
+    'center_gdal': ('get_img_center_gdal', None),
+    'tblr_GTiff': ('get_img_tblr_gdal_GTiff', 'tiff'),
+    'tblr_GTiff_stream': ('get_img_tblr_gdal_GTiff', 'stream'),
+    'tblr_GTiff_cog': ('get_img_tblr_gdal_GTiff', 'cog'),
+    'tblr_GTiff_jpeg': ('get_img_tblr_gdal_GTiff', 'jpeg'),
+    'tblr_GTiff_vrt': ('get_img_tblr_gdal_GTiff', 'vrt'),
+    'center_GTiff': ('get_img_center_gdal_GTiff', 'tiff'),
+}
+
+
+def _rusage():
+    """
+    :return: (进程及子进程的CPU秒数, 峰值RSS的MB数)，没有resource模块时峰值RSS为None
+    """
+    if resource is None:
+        return time.process_time(), None
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = self_usage.ru_utime + self_usage.ru_stime + children.ru_utime + children.ru_stime
+    # linux上ru_maxrss的单位为KB，macOS上为字节
+    scale = 1024 ** 2 if sys.platform == 'darwin' else 1024
+    return cpu, self_usage.ru_maxrss / scale
+
+
+def _tile_window(n, zoom):
+    """
+    以CENTER所在瓦片为中心、n*n个瓦片的范围
+    :return: (tileX_tl, tileY_tl)
+    """
+    from utils import tile_utils
+    tileX_c, tileY_c = tile_utils.lnglatToTile(*CENTER, zoom)
+    return tileX_c - n // 2, tileY_c - n // 2
+
+
+def _run_case(spec):
+    """
+    在子进程中运行单个用例，返回下载的瓦片数、结果是否正常和耗时
+    """
+    from utils import tile_utils, distance_utils
+    from utils.policy import AdaptivePolicy
+    from downloader import downloader_center, downloader_tblr
+
+    n, zoom, engine, nproc = spec['tiles'], spec['zoom'], spec['engine'], spec['nproc']
+    func_name, output = CASES[spec['case']]
+    policy = AdaptivePolicy(max_concurrency=nproc) if spec['adaptive'] else None
+    tiff_filename = os.path.join(spec['workdir'], 'bench.tif')
+    kwargs = dict(datasource=spec['source'], zoom=zoom, nproc=nproc, engine=engine, policy=policy)
+
+    if func_name.startswith('get_img_tblr'):
+        tileX_tl, tileY_tl = _tile_window(n, zoom)
+        # 取瓦片中心点的经纬度，避免落在瓦片边界上
+        loc_tl = tile_utils.tileToLnglat(tileX_tl + 0.5, tileY_tl + 0.5, zoom)
+        loc_br = tile_utils.tileToLnglat(tileX_tl + n - 0.5, tileY_tl + n - 0.5, zoom)
+        nX = nY = n
+        if func_name == 'get_img_tblr':
+            run = lambda: downloader_tblr.get_img_tblr(loc_tl, loc_br, **kwargs)
+        else:
+            spool, output_type = ('stream', 'tiff') if output == 'stream' else ('dir', output)
+            run = lambda: downloader_tblr.get_img_tblr_gdal_GTiff(loc_tl, loc_br, tiff_filename, spool=spool,
+                                                                 output=output_type, **kwargs)
+    elif func_name == 'get_img_center_by_pixels':
+        _, _, nX, nY = downloader_center.center_tile_range_by_pixels(*CENTER, n * 256, n * 256, zoom)
+        run = lambda: downloader_center.get_img_center_by_pixels(*CENTER, n * 256, n * 256, **kwargs)
+    else:
+        # 中心点向四周扩展n/2个瓦片对应的地面距离
+        lng, lat = CENTER
+        tileX_tl, tileY_tl = _tile_window(n, zoom)
+        lng_tl, lat_tl = tile_utils.tileToLnglat(tileX_tl + 0.5, tileY_tl + 0.5, zoom)
+        dlng_km = distance_utils.lng_degree2km(dif_degree=lng - lng_tl, center_lat=lat)
+        dlat_km = distance_utils.lat_degree2km(dif_degree=lat_tl - lat)
+        _, _, nX, nY = downloader_center.center_tile_range(lng, lat, dlng_km, dlat_km, zoom)
+        func = getattr(downloader_center, func_name)
+        extra = {'output': output} if output is not None else {}
+        run = lambda: func(lng, lat, tiff_filename, dlng_km=dlng_km, dlat_km=dlat_km, **extra, **kwargs)
+
+    cpu_start, rss_before = _rusage()
+    wall_start = time.time()
+    result = run()
+    seconds = time.time() - wall_start
+    cpu_end, peak_rss = _rusage()
+
+    if func_name in ('get_img_tblr', 'get_img_center_by_pixels'):
+        ok = result is not None
+    elif output == 'vrt':
+        ok = os.path.exists(os.path.splitext(tiff_filename)[0] + '.vrt')
+    else:
+        ok = os.path.exists(tiff_filename)
+    return {'tiles': nX * nY, 'ok': ok, 'seconds': seconds, 'cpu_seconds': cpu_end - cpu_start,
+            'rss_after_import_mb': rss_before, 'peak_rss_mb': peak_rss}
+
+
+def _child_main(spec_path):
+    with open(spec_path, 'r', encoding='utf-8') as f:
+        spec = json.load(f)
+    try:
+        result = _run_case(spec)
+    except ImportError as e:
+        # 未安装GDAL或aiohttp时跳过该用例
+        result = {'skipped': f"{type(e).__name__}: {e}"}
+    except Exception as e:
+        result = {'error': f"{type(e).__name__}: {e}"}
+    with open(spec['result'], 'w', encoding='utf-8') as f:
+        json.dump(result, f)
+
+
+def _server_stats(records):
+    latencies = np.array([r[3] for r in records if r[1] == 200])
+    stats = {
+        'requests': len(records),
+        'status': {str(k): v for k, v in sorted(Counter(r[1] for r in records).items())},
+        'bytes': int(sum(r[2] for r in records)),
+    }
+    if len(latencies):
+        stats['latency_p50'] = float(np.percentile(latencies, 50))
+        stats['latency_p99'] = float(np.percentile(latencies, 99))
+    return stats
+
+
+def run_case(server, case, engine, args, repeat_index):
+    """
+    在子进程中运行一个用例：子进程通过HTTP_PROXY把瓦片请求发到模拟服务，内存和CPU统计互不影响
+    """
+    workdir = tempfile.mkdtemp(prefix=f'bench_{case}_')
+    spec = {'case': case, 'engine': engine, 'source': args.source, 'tiles': args.tiles, 'zoom': args.zoom,
+            'nproc': args.nproc, 'adaptive': args.adaptive, 'workdir': workdir, 'result': os.path.join(workdir, 'result.json')}
+    spec_path = os.path.join(workdir, 'spec.json')
+    with open(spec_path, 'w', encoding='utf-8') as f:
+        json.dump(spec, f)
+    env = dict(os.environ)
+    for key in ('NO_PROXY', 'no_proxy', 'HTTPS_PROXY', 'https_proxy', 'ALL_PROXY', 'all_proxy'):
+        env.pop(key, None)
+    env['HTTP_PROXY'] = env['http_proxy'] = server.proxy_url
+
+    server.reset()
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    stdout = None if args.verbose else subprocess.DEVNULL
+    process = subprocess.run([sys.executable, '-m', 'benchmark.run_benchmark', '--child', spec_path],
+                             cwd=root, env=env, stdout=stdout, stderr=stdout)
+    records = server.reset()
+    try:
+        with open(spec['result'], 'r', encoding='utf-8') as f:
+            result = json.load(f)
+    except (OSError, ValueError):
+        result = {'error': f"benchmark process exited with code {process.returncode}"}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    result = dict({'case': case, 'engine': engine, 'run': repeat_index}, **result)
+    if 'seconds' in result:
+        result['tiles_per_sec'] = result['tiles'] / result['seconds'] if result['seconds'] > 0 else None
+        result.update(_server_stats(records))
+    return result
+
+
+def _print_result(result):
+    name = f"{result['case']}[{result['engine']}]#{result['run']}"
+    if 'skipped' in result:
+        print(f"{name:<36} skipped: {result['skipped']}")
+    elif 'error' in result:
+        print(f"{name:<36} error: {result['error']}")
+    else:
+        p50, p99 = result.get('latency_p50', float('nan')), result.get('latency_p99', float('nan'))
+        rss = result['peak_rss_mb']
+        print(f"{name:<36} {result['tiles']} tiles {result['seconds']:.2f}s {result['tiles_per_sec']:.1f} tiles/s "
+              f"p50={p50 * 1000:.0f}ms p99={p99 * 1000:.0f}ms cpu={result['cpu_seconds']:.2f}s "
+              f"rss={'-' if rss is None else f'{rss:.0f}MB'} ok={result['ok']} status={result['status']}")
+
+
+def main():
+    parser = ArgumentParser(description='用本地模拟瓦片服务测试各下载、合并路径的吞吐量、延迟、CPU和内存')
+    parser.add_argument('--child', type=str, default=None, help=SUPPRESS)
+    parser.add_argument('--cases', type=str, nargs='*', default=list(CASES), choices=list(CASES),
+                        help='要运行的用例 (默认: 全部)')
+    parser.add_argument('--engines', type=str, nargs='*', default=['thread', 'async'], choices=['thread', 'async'],
+                        help='下载引擎 (默认: thread async)')
+    parser.add_argument('--source', type=str, default='google', choices=['google', 'bing', 'tianditu', 'arcgis'],
+                        help='数据源，模拟服务按format_url的格式解析请求 (默认: google)')
+    parser.add_argument('--tiles', type=int, default=16, help='每边的瓦片数 (默认: 16)')
+    parser.add_argument('--zoom', type=int, default=ZOOM, help=f'瓦片级别 (默认: {ZOOM})')
+    parser.add_argument('--nproc', type=int, default=8, help='下载线程数 (默认: 8)')
+    parser.add_argument('--adaptive', action='store_true', help='使用utils.policy.AdaptivePolicy')
+    parser.add_argument('--repeat', type=int, default=1, help='每个用例的运行次数 (默认: 1)')
+    parser.add_argument('--latency', type=str, default='lognormal:0.05,0.5',
+                        help='服务端延迟分布: constant:秒 / uniform:最小,最大 / lognormal:中位数,sigma '
+                             '(默认: lognormal:0.05,0.5)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='返回500的比例 (默认: 0)')
+    parser.add_argument('--burst-interval', type=float, default=0.0, help='429限流的周期(秒)，0为不限流 (默认: 0)')
+    parser.add_argument('--burst-duration', type=float, default=1.0, help='每次限流持续的秒数 (默认: 1)')
+    parser.add_argument('--burst-rate', type=float, default=0.8, help='限流期间返回429的比例 (默认: 0.8)')
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='注入长尾延迟的请求比例 (默认: 0)')
+    parser.add_argument('--slow-latency', type=float, default=1.5, help='长尾请求额外的延迟秒数 (默认: 1.5)')
+    parser.add_argument('--seed', type=int, default=0, help='随机种子 (默认: 0)')
+    parser.add_argument('--output', type=str, default='benchmark_report.json', help='json报告路径')
+    parser.add_argument('--verbose', action='store_true', help='显示下载过程的输出')
+    args = parser.parse_args()
+
+    if args.child is not None:
+        _child_main(args.child)
+        return
+
+    config = ServerConfig(latency=parse_latency(args.latency), error_rate=args.error_rate,
+                          burst_interval=args.burst_interval, burst_duration=args.burst_duration,
+                          burst_rate=args.burst_rate, slow_rate=args.slow_rate, slow_latency=args.slow_latency,
+                          seed=args.seed)
+    results = []
+    with MockTileServer(config) as server:
+        print(f"mock tile server: {server.proxy_url}")
+        for case in args.cases:
+            for engine in args.engines:
+                for i in range(args.repeat):
+                    result = run_case(server, case, engine, args, i)
+                    _print_result(result)
+                    results.append(result)
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': {'source': args.source, 'tiles': args.tiles, 'zoom': args.zoom, 'nproc': args.nproc,
+                   'adaptive': args.adaptive},
+        'server': config.to_dict(),
+        'results': results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=1)
+    print(f"report saved: {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,64 +1,34 @@
-import os
-import cv2
-import shutil
-import numpy as np
-from osgeo import gdal
-from tqdm import tqdm
 from utils import tile_utils
 from utils import distance_utils
-from utils.url import format_url
-from utils.download import download, download_tiff, download_save2tmpdir
-from utils.concurrent_helper import run_with_concurrent
-from utils.merge import mergeInJPG, mergeJPG2TIF
-
-
-def get_img_center(lng, lat, datasource='google', dlng_km=0.1, dlat_km=0.1, zoom=19, nproc=8):
-    center_lng = lng
-    center_lat = lat
+from utils.tile_grid import download_grid, download_canvas
+from utils.tile_store import open_spool
+from utils.manifest import JobManifest
+from utils.merge import finish_output, save_sources, supported_output
+from utils.geotiff_writer import download_to_geotiff
+from utils.failover import as_chain
+from utils.metrics import report_run
+
+
+# 中心点向东西、南北各扩展dlng_km、dlat_km的瓦片范围
+def center_tile_range(lng, lat, dlng_km=0.1, dlat_km=0.1, zoom=19):
+    """
+    :return: (tileX_tl, tileY_tl, nX, nY)
+    """
     # 地面距离转经纬度角度差
     dlng = distance_utils.lng_km2degree(dis_km=dlng_km, center_lat=lat)
     dlat = distance_utils.lat_km2degree(dis_km=dlat_km)
 
     # 左上角点-右下角点的瓦片标号
-    tileX_tl, tileY_tl = tile_utils.lnglatToTile(center_lng - dlng, center_lat + dlat, zoom)
-    tileX_br, tileY_br = tile_utils.lnglatToTile(center_lng + dlng, center_lat - dlat, zoom)
-    nX = tileX_br - tileX_tl + 1
-    nY = tileY_br - tileY_tl + 1
-
-    # 最终的大图
-    canvas = np.zeros((nY * 256, nX * 256, 3), dtype=np.uint8)
-
-    with tqdm(total=nX * nY) as pbar:
-        failure_count = 0
-        retry_list = []
-        for x in range(nX):
-            task_list = []
-            for y in range(nY):
-                url, headers = format_url(datasource, tileX_tl, x, tileY_tl, y, zoom)
-                task_list.append([url, headers, x, y, canvas, pbar])
-            # 多线程并发
-            status = run_with_concurrent(download, task_list, "thread", min(nproc, len(task_list)))
-            for i in range(len(status)):
-                if status[i] != 0:
-                    retry_list.append(task_list[i])
-                    failure_count += 1
-            if failure_count >= (nX * nY) / 10:
-                return None
-    status = run_with_concurrent(download, retry_list, "thread", min(nproc, len(retry_list)))
-
-    return canvas
-
+    tileX_tl, tileY_tl = tile_utils.lnglatToTile(lng - dlng, lat + dlat, zoom)
+    tileX_br, tileY_br = tile_utils.lnglatToTile(lng + dlng, lat - dlat, zoom)
+    return tileX_tl, tileY_tl, tileX_br - tileX_tl + 1, tileY_br - tileY_tl + 1
 
-# 基于中心点与目标像素尺寸自动决定边界并下载
-def get_img_center_by_pixels(lng, lat,
-                             desired_width_px=20000,
-                             desired_height_px=None,
-                             datasource='google',
-                             zoom=19,
-                             nproc=8):
-    center_lng = lng
-    center_lat = lat
 
+# 以中心点所在瓦片为基准、像素尺寸为(desired_width_px, desired_height_px)的瓦片范围
+def center_tile_range_by_pixels(lng, lat, desired_width_px=20000, desired_height_px=None, zoom=19):
+    """
+    :return: (tileX_tl, tileY_tl, nX, nY)
+    """
     if desired_height_px is None:
         desired_height_px = desired_width_px
 
@@ -71,173 +41,131 @@ def get_img_center_by_pixels(lng, lat,
         nY += 1
 
     # 以中心点所在瓦片为基准，向四周扩展
-    tileX_c, tileY_c = tile_utils.lnglatToTile(center_lng, center_lat, zoom)
-    tileX_tl = tileX_c - nX // 2
-    tileY_tl = tileY_c - nY // 2
-
-    # 最终的大图
-    canvas = np.zeros((nY * 256, nX * 256, 3), dtype=np.uint8)
+    tileX_c, tileY_c = tile_utils.lnglatToTile(lng, lat, zoom)
+    return tileX_c - nX // 2, tileY_c - nY // 2, nX, nY
 
-    with tqdm(total=nX * nY) as pbar:
-        failure_count = 0
-        retry_list = []
-        for x in range(nX):
-            task_list = []
-            for y in range(nY):
-                url, headers = format_url(datasource, tileX_tl, x, tileY_tl, y, zoom)
-                task_list.append([url, headers, x, y, canvas, pbar])
-            # 多线程并发
-            status = run_with_concurrent(download, task_list, "thread", min(nproc, len(task_list)))
-            for i in range(len(status)):
-                if status[i] != 0:
-                    retry_list.append(task_list[i])
-                    failure_count += 1
-            if failure_count >= (nX * nY) / 10:
-                return None
-    status = run_with_concurrent(download, retry_list, "thread", min(nproc, len(retry_list)))
 
-    return canvas
+@report_run
+def get_img_center(lng, lat, datasource='google', dlng_km=0.1, dlat_km=0.1, zoom=19, nproc=8,
+                   engine='thread', policy=None, memmap_dir=None, out=None,
+                   decode_workers=0, job=None, batch=None, fallback=None):
+    """
+    :param fallback: 备用数据源列表(如['bing', 'arcgis'])或utils.failover.SourceChain，
+        失败或空白的瓦片依次由后面的数据源补齐
+    """
+    tileX_tl, tileY_tl, nX, nY = center_tile_range(lng, lat, dlng_km, dlat_km, zoom)
 
+    # 最终的大图
+    return download_canvas(datasource, tileX_tl, tileY_tl, nX, nY, zoom, nproc, engine=engine, policy=policy,
+                           memmap_dir=memmap_dir, out=out, decode_workers=decode_workers, job=job,
+                           batch=batch, fallback=as_chain(fallback))
 
-# 下载后直接写入tif文件，适合用于小图下载
-def get_img_center_gdal(lng, lat, tiff_filename, datasource='google', dlng_km=0.1, dlat_km=0.1, zoom=19, nproc=8):
-    center_lng = lng
-    center_lat = lat
-    # 地面距离转经纬度角度差
-    dlng = distance_utils.lng_km2degree(dis_km=dlng_km, center_lat=lat)
-    dlat = distance_utils.lat_km2degree(dis_km=dlat_km)
 
-    # 左上角点-右下角点的瓦片标号
-    tileX_tl, tileY_tl = tile_utils.lnglatToTile(center_lng - dlng, center_lat + dlat, zoom)
-    tileX_br, tileY_br = tile_utils.lnglatToTile(center_lng + dlng, center_lat - dlat, zoom)
-    nX = tileX_br - tileX_tl + 1
-    nY = tileY_br - tileY_tl + 1
+# 基于中心点与目标像素尺寸自动决定边界并下载
+@report_run
+def get_img_center_by_pixels(lng, lat,
+                             desired_width_px=20000,
+                             desired_height_px=None,
+                             datasource='google',
+                             zoom=19,
+                             nproc=8,
+                             engine='thread',
+                             policy=None,
+                             memmap_dir=None,
+                             out=None,
+                             decode_workers=0,
+                             job=None,
+                             batch=None,
+                             fallback=None):
+    tileX_tl, tileY_tl, nX, nY = center_tile_range_by_pixels(lng, lat, desired_width_px, desired_height_px, zoom)
 
-    height = nY * 256
-    width = nX * 256
-    channels = 3
+    # 最终的大图
+    return download_canvas(datasource, tileX_tl, tileY_tl, nX, nY, zoom, nproc, engine=engine, policy=policy,
+                           memmap_dir=memmap_dir, out=out, decode_workers=decode_workers, job=job,
+                           batch=batch, fallback=as_chain(fallback))
 
-    driver = gdal.GetDriverByName('GTiff')
-    dataset = driver.Create(tiff_filename, width, height, channels, gdal.GDT_Byte, ['COMPRESS=LZW'])
-    dataset.SetMetadataItem("BLOCKXSIZE", str(256))
-    dataset.SetMetadataItem("BLOCKYSIZE", str(256))
-    gdal.SetConfigOption('GDAL_CACHEMAX', '10240')  # 设置缓存大小
 
-    with tqdm(total=nX * nY) as pbar:
-        failure_count = 0
-        retry_list = []
-        for x in range(nX):
-            task_list = []
-            for y in range(nY):
-                url, headers = format_url(datasource, tileX_tl, x, tileY_tl, y, zoom)
-                task_list.append([url, headers, x, y, dataset, pbar])
-            # 多线程并发
-            status = run_with_concurrent(download_tiff, task_list, "thread", min(nproc, len(task_list)))
-            for i in range(len(status)):
-                if status[i] != 0:
-                    retry_list.append(task_list[i])
-                    failure_count += 1
-            if failure_count >= (nX * nY) / 10:
-                return None
-    status = run_with_concurrent(download_tiff, retry_list, "thread", min(nproc, len(retry_list)))
+# 下载后直接写入tif文件，适合用于小图下载
+@report_run
+def get_img_center_gdal(lng, lat, tiff_filename, datasource='google', dlng_km=0.1, dlat_km=0.1, zoom=19, nproc=8,
+                        engine='thread', policy=None, fallback=None):
+    tileX_tl, tileY_tl, nX, nY = center_tile_range(lng, lat, dlng_km, dlat_km, zoom)
 
-    dataset.FlushCache()
-    print("保存完成：" + tiff_filename)
+    # 单个写线程流式写入分块压缩的GeoTIFF
+    chain = as_chain(fallback)
+    if not download_to_geotiff(tiff_filename, datasource, tileX_tl, tileY_tl, nX, nY, zoom, nproc,
+                               engine=engine, policy=policy, fallback=chain):
+        return None
+    save_sources(chain, tiff_filename)
 
 
 # 直接保存所有的瓦片到临时目录
+@report_run
 def get_img_center_gdal_savetmp(lng, lat, tiff_filename,
-                                datasource='google', dlng_km=0.1, dlat_km=0.1, zoom=19, nproc=8):
-    center_lng = lng
-    center_lat = lat
-    # 地面距离转经纬度角度差
-    dlng = distance_utils.lng_km2degree(dis_km=dlng_km, center_lat=lat)
-    dlat = distance_utils.lat_km2degree(dis_km=dlat_km)
-
-    # 左上角点-右下角点的瓦片标号
-    tileX_tl, tileY_tl = tile_utils.lnglatToTile(center_lng - dlng, center_lat + dlat, zoom)
-    tileX_br, tileY_br = tile_utils.lnglatToTile(center_lng + dlng, center_lat - dlat, zoom)
-    nX = tileX_br - tileX_tl + 1
-    nY = tileY_br - tileY_tl + 1
+                                datasource='google', dlng_km=0.1, dlat_km=0.1, zoom=19, nproc=8,
+                                engine='thread', policy=None, spool='dir'):
+    tileX_tl, tileY_tl, nX, nY = center_tile_range(lng, lat, dlng_km, dlat_km, zoom)
 
     height = nY * 256
     width = nX * 256
 
-    tmpdir = os.path.join(os.path.dirname(tiff_filename), os.path.basename(tiff_filename).split('.')[0])
-    os.makedirs(tmpdir, exist_ok=True)
-
-    with tqdm(total=nX * nY) as pbar:
-        failure_count = 0
-        retry_list = []
-        for x in range(nX):
-            task_list = []
-            for y in range(nY):
-                url, headers = format_url(datasource, tileX_tl, x, tileY_tl, y, zoom)
-                task_list.append([url, headers, x, y, tmpdir, pbar])
-            # 多线程并发
-            status = run_with_concurrent(download_save2tmpdir, task_list, "thread", min(nproc, len(task_list)))
-            for i in range(len(status)):
-                if status[i] != 0:
-                    retry_list.append(task_list[i])
-                    failure_count += 1
-            if failure_count >= (nX * nY) / 10:
-                return None
-    status = run_with_concurrent(download_save2tmpdir, retry_list, "thread", min(nproc, len(retry_list)))
+    # 瓦片暂存到临时目录或单个mbtiles文件
+    spool_sink = open_spool(tiff_filename, spool, zoom, tileX_tl, tileY_tl, nX, nY)
+    # 进度清单，重新运行时只下载缺失的瓦片
+    manifest = JobManifest(spool_sink.path + '.manifest', datasource, zoom, tileX_tl, tileY_tl, nX, nY)
+
+    success = download_grid(spool_sink, datasource, tileX_tl, tileY_tl, nX, nY, zoom, nproc,
+                            engine=engine, policy=policy, manifest=manifest)
+    manifest.close()
+    if not success:
+        spool_sink.close()
+        return None
+    spool_sink.close()
     # merge2tiff(tmpdir, tiff_filename, width, height)
     # print("保存完成：" + tiff_filename)
 
 
 # 直接保存所有的瓦片到临时目录，先合成为更大的jpg，再合并为tiff，适合用于大图下载
+@report_run
 def get_img_center_gdal_GTiff(lng, lat, tiff_filename,
-                              datasource='google', dlng_km=0.1, dlat_km=0.1, zoom=19, nproc=8):
-    center_lng = lng
-    center_lat = lat
-    # 地面距离转经纬度角度差
-    dlng = distance_utils.lng_km2degree(dis_km=dlng_km, center_lat=lat)
-    dlat = distance_utils.lat_km2degree(dis_km=dlat_km)
-
-    # 左上角点-右下角点的瓦片标号
-    tileX_tl, tileY_tl = tile_utils.lnglatToTile(center_lng - dlng, center_lat + dlat, zoom)
-    tileX_br, tileY_br = tile_utils.lnglatToTile(center_lng + dlng, center_lat - dlat, zoom)
-    nX = tileX_br - tileX_tl + 1
-    nY = tileY_br - tileY_tl + 1
-
-    height = nY * 256
-    width = nX * 256
-
-    tmpdir = os.path.join(os.path.dirname(tiff_filename), os.path.basename(tiff_filename).split('.')[0])
-    os.makedirs(tmpdir, exist_ok=True)
-
-    with tqdm(total=nX * nY) as pbar:
-        failure_count = 0
-        retry_list = []
-        for x in range(nX):
-            task_list = []
-            for y in range(nY):
-                url, headers = format_url(datasource, tileX_tl, x, tileY_tl, y, zoom)
-                task_list.append([url, headers, x, y, tmpdir, pbar])
-            # 多线程并发
-            status = run_with_concurrent(download_save2tmpdir, task_list, "thread", min(nproc, len(task_list)))
-            for i in range(len(status)):
-                if status[i] != 0:
-                    retry_list.append(task_list[i])
-                    failure_count += 1
-            if failure_count >= (nX * nY) / 10:
-                return None
-    status = run_with_concurrent(download_save2tmpdir, retry_list, "thread", min(nproc, len(retry_list)))
-    # 合并为更大的jpg
-    jpg_dir = os.path.join(os.path.dirname(tiff_filename),
-                           os.path.basename(tiff_filename).split('.')[0] + '_merged_images')
-    os.makedirs(jpg_dir, exist_ok=True)
-    mergeInJPG(tmpdir, nX, nY, 60, 60, jpg_dir)
-    files = os.listdir(tmpdir)
-    if len(files) == nX * nY:
-        print(f"JPG下载合并完成，没有瓦片缺失，删除临时目录：{tmpdir}")
-        shutil.rmtree(tmpdir)  # 删除临时目录
-    # 合并为tiff
-    geoTransform = tile_utils.getGeoTransform(tileX_tl, tileY_tl, nX, nY, zoom)
-    mergeJPG2TIF(jpg_dir, tiff_filename, width, height, geoTransform)
-    print("保存完成：" + tiff_filename)
+                              datasource='google', dlng_km=0.1, dlat_km=0.1, zoom=19, nproc=8,
+                              engine='thread', policy=None, spool='dir', output='tiff',
+                              cog_compress='JPEG', cog_blocksize=512, merge_nproc=1, batch=None, fallback=None):
+    """
+    :param batch: utils.batch_plan.BatchPlan.job(i)，批量下载时与其他位置共享重叠的瓦片
+    :param fallback: 备用数据源列表或utils.failover.SourceChain，每个瓦片的来源保存在{tiff}_sources.json
+    """
+    tileX_tl, tileY_tl, nX, nY = center_tile_range(lng, lat, dlng_km, dlat_km, zoom)
+
+    if output not in supported_output:
+        raise ValueError("unknow output type, {}".format(output))
+    chain = as_chain(fallback)
+    if spool == 'stream':
+        if output != 'tiff':
+            raise ValueError("spool stream only supports tiff output")
+        # 不暂存瓦片，直接从网络流式写入tiff
+        if not download_to_geotiff(tiff_filename, datasource, tileX_tl, tileY_tl, nX, nY, zoom, nproc,
+                                   engine=engine, policy=policy, batch=batch, fallback=chain):
+            return None
+        save_sources(chain, tiff_filename)
+        return
+
+    # 瓦片暂存到临时目录或单个mbtiles文件
+    spool_sink = open_spool(tiff_filename, spool, zoom, tileX_tl, tileY_tl, nX, nY)
+    # 进度清单，重新运行时只下载缺失的瓦片
+    manifest = JobManifest(spool_sink.path + '.manifest', datasource, zoom, tileX_tl, tileY_tl, nX, nY)
+
+    success = download_grid(spool_sink, datasource, tileX_tl, tileY_tl, nX, nY, zoom, nproc,
+                            engine=engine, policy=policy, manifest=manifest, batch=batch, fallback=chain)
+    complete = manifest.is_complete()
+    placeholder_mask = manifest.placeholder_mask()
+    manifest.close()
+    if not success:
+        spool_sink.close()
+        return None
+    finish_output(spool_sink, manifest, complete, tiff_filename, tileX_tl, tileY_tl, nX, nY, zoom, output=output,
+                  cog_compress=cog_compress, cog_blocksize=cog_blocksize, merge_nproc=merge_nproc, chain=chain,
+                  placeholder_mask=placeholder_mask)
 
 
 # 获取以中心为准、像素尺寸为(desired_width_px, desired_height_px)的矩形区域四角经纬度坐标
@@ -245,31 +173,10 @@ def get_pol(lng, lat,
             desired_width_px=20000,
             desired_height_px=None,
             zoom=19):
-    center_lng = lng
-    center_lat = lat
-    if desired_height_px is None:
-        desired_height_px = desired_width_px
-    nX = max(1, int(round(desired_width_px / 256)))
-    nY = max(1, int(round(desired_height_px / 256)))
-    if nX % 2 == 0:
-        nX += 1
-    if nY % 2 == 0:
-        nY += 1
-    tileX_c, tileY_c = tile_utils.lnglatToTile(center_lng, center_lat, zoom)
-    tileX_tl = tileX_c - nX // 2
-    tileY_tl = tileY_c - nY // 2
-    # 左上角
-    lng_tl, lat_tl = tile_utils.pixelToLnglat(tileX_tl, tileY_tl, 0, 0, zoom)
-    # 右上角
-    lng_tr, lat_tr = tile_utils.pixelToLnglat(tileX_tl + nX - 1, tileY_tl, 255, 0, zoom)
-    # 右下角
-    lng_br, lat_br = tile_utils.pixelToLnglat(tileX_tl + nX - 1, tileY_tl + nY - 1, 255, 255, zoom)
-    # 左下角
-    lng_bl, lat_bl = tile_utils.pixelToLnglat(tileX_tl, tileY_tl + nY - 1, 0, 255, zoom)
+    tileX_tl, tileY_tl, nX, nY = center_tile_range_by_pixels(lng, lat, desired_width_px, desired_height_px, zoom)
+    # 四角(左上、右上、右下、左下)一次计算
+    lng, lat = tile_utils.pixelToLnglatArray([tileX_tl, tileX_tl + nX - 1, tileX_tl + nX - 1, tileX_tl],
+                                             [tileY_tl, tileY_tl, tileY_tl + nY - 1, tileY_tl + nY - 1],
+                                             [0, 255, 255, 0], [0, 0, 255, 255], zoom)
     # 顺时针返回四角
-    return [
-        [lng_tl, lat_tl],  # 左上
-        [lng_tr, lat_tr],  # 右上
-        [lng_br, lat_br],  # 右下
-        [lng_bl, lat_bl]   # 左下
-    ]
+    return [[float(lng[i]), float(lat[i])] for i in range(4)]
@@ -0,0 +1,54 @@
+import numpy as np
+from utils.aoi import covering_tiles
+from utils.tile_grid import download_canvas
+from utils.geotiff_writer import download_to_geotiff
+from utils.failover import as_chain
+from utils.merge import save_sources
+from utils.metrics import report_run
+
+
+def _cover(polygon, zoom):
+    tileX_tl, tileY_tl, tile_mask = covering_tiles(polygon, zoom)
+    nX, nY = tile_mask.shape
+    count = int(np.count_nonzero(tile_mask))
+    print(f"covering tiles: {count}/{nX * nY} of the bounding box ({count / (nX * nY):.1%})")
+    return tileX_tl, tileY_tl, nX, nY, tile_mask
+
+
+@report_run
+def get_img_polygon(polygon, datasource='google', zoom=20, nproc=8, engine='thread', policy=None,
+                    memmap_dir=None, out=None, decode_workers=0, job=None, fallback=None):
+    """
+    只下载与多边形相交的瓦片，返回多边形外接矩形范围的图像，未覆盖的瓦片处为0
+    :param polygon: 经纬度(wgs84)多边形，GeoJSON(dict、字符串或文件)或WKT，见utils.aoi.parse_polygon
+    :param datasource:数据来源
+    :param zoom:瓦片级别
+    :param nproc:下载线程数
+    :param engine:下载引擎，thread或async
+    :param policy:下载策略，utils.policy.AdaptivePolicy
+    :param memmap_dir:指定时画布由该目录下的np.memmap临时文件承载
+    :param out:调用方提供的画布缓冲区
+    :param decode_workers:大于0时使用该数量的进程解码
+    :param job:任务文件路径前缀，中断后以相同参数重新运行只下载缺失的瓦片
+    :param fallback:备用数据源列表或utils.failover.SourceChain，失败或空白的瓦片依次由后面的数据源补齐
+    :return:(图像, 瓦片掩膜)，掩膜为(nX, nY)的bool数组，mask[x, y]对应图像中[y*256:(y+1)*256, x*256:(x+1)*256]
+    """
+    tileX_tl, tileY_tl, nX, nY, tile_mask = _cover(polygon, zoom)
+    img = download_canvas(datasource, tileX_tl, tileY_tl, nX, nY, zoom, nproc, engine=engine, policy=policy,
+                          memmap_dir=memmap_dir, out=out, decode_workers=decode_workers, job=job,
+                          tile_mask=tile_mask, fallback=as_chain(fallback))
+    return img, tile_mask
+
+
+# 流式写入GeoTIFF(EPSG:3857)，未覆盖的瓦片在内部掩膜中为nodata
+@report_run
+def get_img_polygon_gdal_GTiff(polygon, tiff_filename, datasource='google', zoom=20, nproc=8,
+                               engine='thread', policy=None, compress='LZW', fallback=None):
+    tileX_tl, tileY_tl, nX, nY, tile_mask = _cover(polygon, zoom)
+    chain = as_chain(fallback)
+    success = download_to_geotiff(tiff_filename, datasource, tileX_tl, tileY_tl, nX, nY, zoom, nproc,
+                                  engine=engine, policy=policy, compress=compress, tile_mask=tile_mask,
+                                  fallback=chain)
+    if success:
+        save_sources(chain, tiff_filename)
+    return success
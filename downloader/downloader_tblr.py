@@ -1,15 +1,16 @@
-import numpy as np
-from tqdm import tqdm
 from utils import tile_utils
-from utils.url import format_url
-from utils.download import download, download_save2tmpdir
-from utils.concurrent_helper import run_with_concurrent
-import os
-import shutil
-from utils.merge import mergeInJPG, mergeJPG2TIF
+from utils.tile_grid import download_grid, download_canvas
+from utils.tile_store import open_spool
+from utils.manifest import JobManifest
+from utils.geotiff_writer import download_to_geotiff
+from utils.failover import as_chain
+from utils.metrics import report_run
+from utils.merge import finish_output, save_sources, supported_output
 
 
-def get_img_tblr(loc_tl, loc_br, datasource='google', zoom=20, nproc=8):
+@report_run
+def get_img_tblr(loc_tl, loc_br, datasource='google', zoom=20, nproc=8, engine='thread', policy=None,
+                 memmap_dir=None, out=None, decode_workers=0, job=None, fallback=None):
     """
     根据左上角和右下角的经纬度返回图像
     :param loc_tl:[tl_lng, tl_lat] 左上角的经度，纬度
@@ -17,6 +18,13 @@ def get_img_tblr(loc_tl, loc_br, datasource='google', zoom=20, nproc=8):
     :param datasource:数据来源
     :param zoom:瓦片级别
     :param nproc:下载线程数
+    :param engine:下载引擎，thread或async
+    :param policy:下载策略，utils.policy.AdaptivePolicy
+    :param memmap_dir:指定时画布由该目录下的np.memmap临时文件承载，大图不再受内存限制
+    :param out:调用方提供的画布缓冲区，形状为(nY*256, nX*256, 3)
+    :param decode_workers:大于0时使用该数量的进程解码，直接写入共享内存画布
+    :param job:任务文件路径前缀，指定时画布和进度保存在磁盘上，中断后以相同参数重新运行只下载缺失的瓦片
+    :param fallback:备用数据源列表(如['bing', 'arcgis'])或utils.failover.SourceChain，失败或空白的瓦片依次由后面的数据源补齐
     :return:区域的卫星图像
     """
     tl_lng, tl_lat = loc_tl
@@ -29,31 +37,16 @@ def get_img_tblr(loc_tl, loc_br, datasource='google', zoom=20, nproc=8):
     assert (nX > 0) & (nY > 0), "input loc error"
 
     # 最终的大图
-    canvas = np.zeros((nY * 256, nX * 256, 3), dtype=np.uint8)
-
-    with tqdm(total=nX * nY) as pbar:
-        failure_count = 0
-        retry_list = []
-        for x in range(nX):
-            task_list = []
-            for y in range(nY):
-                url, headers = format_url(datasource, tileX_tl, x, tileY_tl, y, zoom)
-                task_list.append([url, headers, x, y, canvas, pbar])
-            # 多线程并发
-            status = run_with_concurrent(download, task_list, "thread", min(nproc, len(task_list)))
-            for i in range(len(status)):
-                if status[i] != 0:
-                    retry_list.append(task_list[i])
-                    failure_count += 1
-            if failure_count >= (nX * nY) / 10:
-                return None
-    status = run_with_concurrent(download, retry_list, "thread", min(nproc, len(retry_list)))
-
-    return canvas
+    return download_canvas(datasource, tileX_tl, tileY_tl, nX, nY, zoom, nproc, engine=engine, policy=policy,
+                           memmap_dir=memmap_dir, out=out, decode_workers=decode_workers, job=job,
+                           fallback=as_chain(fallback))
 
 
 # 直接保存所有的瓦片到临时目录，先合成为更大的jpg，再合并为tiff，适合用于大图下载
-def get_img_tblr_gdal_GTiff(loc_tl, loc_br, tiff_filename, datasource='google', zoom=20, nproc=8):
+@report_run
+def get_img_tblr_gdal_GTiff(loc_tl, loc_br, tiff_filename, datasource='google', zoom=20, nproc=8,
+                            engine='thread', policy=None, spool='dir', output='tiff',
+                            cog_compress='JPEG', cog_blocksize=512, merge_nproc=1, fallback=None):
     tl_lng, tl_lat = loc_tl
     br_lng, br_lat = loc_br
     # 左上角点-右下角点的瓦片标号
@@ -63,39 +56,33 @@ def get_img_tblr_gdal_GTiff(loc_tl, loc_br, tiff_filename, datasource='google',
     nY = tileY_br - tileY_tl + 1
     assert (nX > 0) & (nY > 0), "input loc error"
 
-    height = nY * 256
-    width = nX * 256
+    if output not in supported_output:
+        raise ValueError("unknow output type, {}".format(output))
+    # 备用数据源，每个瓦片的来源保存在{tiff}_sources.json
+    chain = as_chain(fallback)
+    if spool == 'stream':
+        if output != 'tiff':
+            raise ValueError("spool stream only supports tiff output")
+        # 不暂存瓦片，直接从网络流式写入tiff
+        if not download_to_geotiff(tiff_filename, datasource, tileX_tl, tileY_tl, nX, nY, zoom, nproc,
+                                   engine=engine, policy=policy, fallback=chain):
+            return None
+        save_sources(chain, tiff_filename)
+        return
 
-    tmpdir = os.path.join(os.path.dirname(tiff_filename), os.path.basename(tiff_filename).split('.')[0])
-    os.makedirs(tmpdir, exist_ok=True)
+    # 瓦片暂存到临时目录或单个mbtiles文件
+    spool_sink = open_spool(tiff_filename, spool, zoom, tileX_tl, tileY_tl, nX, nY)
+    # 进度清单，重新运行时只下载缺失的瓦片
+    manifest = JobManifest(spool_sink.path + '.manifest', datasource, zoom, tileX_tl, tileY_tl, nX, nY)
 
-    with tqdm(total=nX * nY) as pbar:
-        failure_count = 0
-        retry_list = []
-        for x in range(nX):
-            task_list = []
-            for y in range(nY):
-                url, headers = format_url(datasource, tileX_tl, x, tileY_tl, y, zoom)
-                task_list.append([url, headers, x, y, tmpdir, pbar])
-            # 多线程并发
-            status = run_with_concurrent(download_save2tmpdir, task_list, "thread", min(nproc, len(task_list)))
-            for i in range(len(status)):
-                if status[i] != 0:
-                    retry_list.append(task_list[i])
-                    failure_count += 1
-            if failure_count >= (nX * nY) / 10:
-                return None
-    status = run_with_concurrent(download_save2tmpdir, retry_list, "thread", min(nproc, len(retry_list)))
-    # 合并为更大的jpg
-    jpg_dir = os.path.join(os.path.dirname(tiff_filename),
-                           os.path.basename(tiff_filename).split('.')[0] + '_merged_images')
-    os.makedirs(jpg_dir, exist_ok=True)
-    mergeInJPG(tmpdir, nX, nY, 60, 60, jpg_dir)
-    files = os.listdir(tmpdir)
-    if len(files) == nX * nY:
-        print(f"JPG下载合并完成，没有瓦片缺失，删除临时目录：{tmpdir}")
-        shutil.rmtree(tmpdir)  # 删除临时目录
-    # 合并为tiff
-    geoTransform = tile_utils.getGeoTransform(tileX_tl, tileY_tl, nX, nY, zoom)
-    mergeJPG2TIF(jpg_dir, tiff_filename, width, height, geoTransform)
-    print("保存完成：" + tiff_filename)
+    success = download_grid(spool_sink, datasource, tileX_tl, tileY_tl, nX, nY, zoom, nproc,
+                            engine=engine, policy=policy, manifest=manifest, fallback=chain)
+    complete = manifest.is_complete()
+    placeholder_mask = manifest.placeholder_mask()
+    manifest.close()
+    if not success:
+        spool_sink.close()
+        return None
+    finish_output(spool_sink, manifest, complete, tiff_filename, tileX_tl, tileY_tl, nX, nY, zoom, output=output,
+                  cog_compress=cog_compress, cog_blocksize=cog_blocksize, merge_nproc=merge_nproc, chain=chain,
+                  placeholder_mask=placeholder_mask)
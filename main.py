@@ -1,5 +1,6 @@
 import cv2
 from downloader.downloader_tblr import get_img_tblr, get_img_tblr_gdal_GTiff
+from downloader.downloader_polygon import get_img_polygon_gdal_GTiff
 from utils.distance_utils import calArea
 
 
@@ -26,6 +27,15 @@ def Demo_download_tiff():
     print(f"区域影像下载完成，保存路径：{tiff_name}")
 
 
+def Demo_download_polygon():
+    tiff_name = 'save_files/whu_polygon.tif'
+    # 经纬度多边形，也可以是GeoJSON
+    polygon = 'POLYGON ((114.341316 30.553657, 114.37745 30.540, 114.365 30.517285, 114.345 30.525, 114.341316 30.553657))'
+    zoom = 19  # 0.3 m/pixel
+    print(f"开始下载多边形范围内的影像，缩放级别：{zoom}, 保存路径：{tiff_name}...")
+    get_img_polygon_gdal_GTiff(polygon, tiff_name, 'google', zoom, 8)
+
+
 if __name__ == '__main__':
     # Demo_download_jpg()
     Demo_download_tiff()
@@ -2,7 +2,10 @@ import os
 import cv2
 import pandas as pd
 import numpy as np
-from downloader.downloader_center import get_img_center_gdal_savetmp, get_img_center, get_img_center_gdal_GTiff
+from downloader.downloader_center import get_img_center_gdal_savetmp, get_img_center, get_img_center_gdal_GTiff, \
+    center_tile_range
+from utils.batch_plan import BatchPlan
+from utils.tile_cache import TileCache, cache_scope
 
 if __name__ == '__main__':
     csv_path = 'save_files/locs.csv'
@@ -11,6 +14,16 @@ if __name__ == '__main__':
     dis_km = 18.7 / 2
     zoom = 19  # 0.3 km/pixel
     datasource = 'google'
+    spool = 'dir'  # 瓦片暂存方式: 'dir' 临时目录 或 'mbtiles' 单个sqlite文件
+    # 本地瓦片缓存目录，重复运行和相互重叠的位置不再重复下载；默认不启用，如os.path.join(save_path, 'tile_cache')
+    cache_dir = None
+    cache_size_gb = 50
+    # 瓦片合并为大块jpg的进程数，每个进程约占700MB内存(60*60个瓦片的块)
+    merge_nproc = min(4, os.cpu_count())
+    # 备用数据源，datasource失败或空白的瓦片依次从这些数据源补齐，如['bing', 'arcgis']
+    fallback = []
+    # 相互重叠的位置之间共享瓦片，整批每个瓦片只请求一次
+    dedup = True
     data = pd.read_csv(csv_path, encoding='utf-8')
     name = np.array(data['name']).tolist()
     lng = np.array(data['lng']).tolist()
@@ -19,30 +32,41 @@ if __name__ == '__main__':
 
     os.makedirs(save_path, exist_ok=True)
 
-    for i in range(len(name)):
-        # if name[i].startswith('R1'):
-        #     continue
-        if name[i].startswith('R'):
-            continue
-        print('=' * 80)
-        print(f"start download point {name[i]}")
-        tiff_name = os.path.join(save_path, name[i] + '.tif')
-        print(f"tiff_name: {tiff_name}, lng: {lng[i]}, lat: {lat[i]}, dis_km: {dis_km}, zoom: {zoom}")
-        get_img_center_gdal_GTiff(lng=lng[i], lat=lat[i], tiff_filename=tiff_name,
-                                  datasource=datasource,
-                                  dlng_km=dis_km, dlat_km=dis_km,
-                                  zoom=zoom, nproc=8)
-        # get_img_center_gdal_savetmp(lng=lng[i], lat=lat[i], tiff_filename=tiff_name,
-        #                             datasource=datasource,
-        #                             dlng_km=dis_km, dlat_km=dis_km,
-        #                             zoom=zoom, nproc=8)
+    # 跳过以R开头的位置
+    selected = [i for i in range(len(name)) if not name[i].startswith('R')]
+    # selected = [i for i in range(len(name)) if not name[i].startswith('R1')]
+    plan = None
+    if dedup:
+        plan = BatchPlan(datasource, zoom,
+                         [center_tile_range(lng[i], lat[i], dis_km, dis_km, zoom) for i in selected])
+        plan.report()
 
-        # save_path_test = os.path.join(save_path, 'test')
-        # zoom_test = 14
-        # save_name = os.path.join(save_path_test, name[i] + '_z14.jpg')
-        # canvas = get_img_center(lng=lng[i], lat=lat[i],
-        #                         datasource=datasource,
-        #                         dlng_km=dis_km, dlat_km=dis_km,
-        #                         zoom=zoom_test, nproc=8)
-        # cv2.imwrite(save_name, canvas)
+    cache = TileCache(cache_dir, cache_size_gb * 1024 ** 3) if cache_dir else None
+    with cache_scope(cache):
+        for k, i in enumerate(selected):
+            print('=' * 80)
+            print(f"start download point {name[i]}")
+            tiff_name = os.path.join(save_path, name[i] + '.tif')
+            print(f"tiff_name: {tiff_name}, lng: {lng[i]}, lat: {lat[i]}, dis_km: {dis_km}, zoom: {zoom}")
+            get_img_center_gdal_GTiff(lng=lng[i], lat=lat[i], tiff_filename=tiff_name,
+                                      datasource=datasource,
+                                      dlng_km=dis_km, dlat_km=dis_km,
+                                      zoom=zoom, nproc=8, spool=spool, merge_nproc=merge_nproc,
+                                      batch=plan.job(k) if plan is not None else None,
+                                      fallback=fallback)
+            # get_img_center_gdal_savetmp(lng=lng[i], lat=lat[i], tiff_filename=tiff_name,
+            #                             datasource=datasource,
+            #                             dlng_km=dis_km, dlat_km=dis_km,
+            #                             zoom=zoom, nproc=8)
+
+            # save_path_test = os.path.join(save_path, 'test')
+            # zoom_test = 14
+            # save_name = os.path.join(save_path_test, name[i] + '_z14.jpg')
+            # canvas = get_img_center(lng=lng[i], lat=lat[i],
+            #                         datasource=datasource,
+            #                         dlng_km=dis_km, dlat_km=dis_km,
+            #                         zoom=zoom_test, nproc=8)
+            # cv2.imwrite(save_name, canvas)
+    if plan is not None:
+        print(f"复用重叠瓦片 {plan.hits} 次")
     print('全部区域影像下载结束')
@@ -4,6 +4,7 @@ import pandas as pd
 import numpy as np
 from utils import tile_utils, distance_utils
 from utils.merge import mergeInJPG, mergeJPG2TIF
+from utils.vrt import writeBlocksVRT, materializeVRT
 
 if __name__ == '__main__':
     csv_path = 'save_files/locs.csv'
@@ -11,6 +12,11 @@ if __name__ == '__main__':
     dis_km = 18.7
     zoom = 19  # 0.3 km/pixel
     datasource = 'google'
+    # 合并为大块jpg的进程数，每个进程约占950MB内存(70*70个瓦片的块)
+    merge_nproc = min(4, os.cpu_count())
+    # 'tiff' 合并为单个tiff；'vrt' 只生成引用大块jpg的VRT(毫秒级)，materialize为True时再转换为tiff
+    output = 'tiff'
+    materialize = False
     data = pd.read_csv(csv_path, encoding='utf-8')
     name = np.array(data['name']).tolist()
     lng = np.array(data['lng']).tolist()
@@ -28,6 +34,9 @@ if __name__ == '__main__':
         print(f"start merge point {name[i]}")
         tiff_name = os.path.join(save_path, name[i] + '.tif')
         tmpdir = os.path.join(os.path.dirname(tiff_name), os.path.basename(tiff_name).split('.')[0])
+        # 下载时使用spool='mbtiles'的，直接从瓦片库读取
+        if os.path.exists(tmpdir + '.mbtiles'):
+            tmpdir = tmpdir + '.mbtiles'
 
         center_lng = lng[i]
         center_lat = lat[i]
@@ -48,8 +57,15 @@ if __name__ == '__main__':
         jpg_dir = os.path.join(os.path.dirname(tiff_name),
                                os.path.basename(tiff_name).split('.')[0] + '_merged_images')
         os.makedirs(jpg_dir, exist_ok=True)
-        mergeInJPG(tmpdir, nX, nY, 70, 70, jpg_dir)
+        mergeInJPG(tmpdir, nX, nY, 70, 70, jpg_dir, nproc=merge_nproc)
         # shutil.rmtree(tmpdir)  # 删除临时目录
+        if output == 'vrt':
+            vrt_name = os.path.join(target_dir, name[i] + '.vrt')
+            writeBlocksVRT(jpg_dir, vrt_name, width, height,
+                           tile_utils.getMercatorGeoTransform(tileX_tl, tileY_tl, zoom))
+            if materialize:
+                materializeVRT(vrt_name, os.path.join(target_dir, name[i] + '.tif'))
+            continue
         # 合并为tiff
         geoTransform = tile_utils.getGeoTransform(tileX_tl, tileY_tl, nX, nY, zoom)
 
@@ -0,0 +1,22 @@
+import pytest
+from benchmark.mock_tile_server import MockTileServer, ServerConfig
+
+
+@pytest.fixture(scope='session')
+def tile_server():
+    with MockTileServer(ServerConfig(latency=('constant', 0.0))) as server:
+        yield server
+
+
+@pytest.fixture
+def mock_server(tile_server, monkeypatch):
+    """
+    瓦片请求通过HTTP_PROXY发到本地模拟服务，与benchmark相同
+    """
+    for key in ('NO_PROXY', 'no_proxy', 'HTTPS_PROXY', 'https_proxy', 'ALL_PROXY', 'all_proxy'):
+        monkeypatch.delenv(key, raising=False)
+    monkeypatch.setenv('HTTP_PROXY', tile_server.proxy_url)
+    monkeypatch.setenv('http_proxy', tile_server.proxy_url)
+    tile_server.reset()
+    yield tile_server
+    tile_server.reset()
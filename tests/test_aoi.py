@@ -0,0 +1,61 @@
+import json
+import numpy as np
+import pytest
+from utils import tile_utils
+from utils.aoi import covering_tiles, parse_polygon
+
+zoom = 14
+rect = [[116.30, 39.95], [116.50, 39.95], [116.50, 39.80], [116.30, 39.80]]
+
+
+def test_rectangle_covers_its_tile_range():
+    tileX_tl, tileY_tl, mask = covering_tiles([rect], zoom)
+    tileX_br, tileY_br = tile_utils.lnglatToTile(116.50, 39.80, zoom)
+    assert (tileX_tl, tileY_tl) == tile_utils.lnglatToTile(116.30, 39.95, zoom)
+    assert mask.shape == (tileX_br - tileX_tl + 1, tileY_br - tileY_tl + 1)
+    assert mask.all()
+
+
+def test_formats_are_equivalent(tmp_path):
+    geometry = {'type': 'Polygon', 'coordinates': [rect + rect[:1]]}
+    wkt = 'POLYGON ((' + ', '.join(f'{lng} {lat}' for lng, lat in rect + rect[:1]) + '))'
+    path = tmp_path / 'aoi.geojson'
+    path.write_text(json.dumps({'type': 'FeatureCollection',
+                                'features': [{'type': 'Feature', 'geometry': geometry, 'properties': {}}]}))
+    expected = covering_tiles([rect], zoom)
+    for polygon in (geometry, json.dumps(geometry), wkt, str(path)):
+        tileX_tl, tileY_tl, mask = covering_tiles(polygon, zoom)
+        assert (tileX_tl, tileY_tl) == expected[:2]
+        assert (mask == expected[2]).all()
+
+
+def test_triangle_covers_edges_and_interior():
+    triangle = [[116.30, 39.95], [116.50, 39.95], [116.30, 39.80]]
+    tileX_tl, tileY_tl, mask = covering_tiles([triangle], zoom)
+    assert 0 < np.count_nonzero(mask) < mask.size
+    # 顶点和边上采样点所在的瓦片都被覆盖
+    for (lng0, lat0), (lng1, lat1) in zip(triangle, triangle[1:] + triangle[:1]):
+        for t in np.linspace(0, 1, 200):
+            tileX, tileY = tile_utils.lnglatToTile(lng0 + t * (lng1 - lng0), lat0 + t * (lat1 - lat0), zoom)
+            assert mask[tileX - tileX_tl, tileY - tileY_tl]
+    # 斜边之外的右下角瓦片不下载
+    assert not mask[-1, -1]
+
+
+def test_hole_is_excluded():
+    outer = [[116.0, 40.2], [116.8, 40.2], [116.8, 39.6], [116.0, 39.6]]
+    hole = [[116.3, 40.0], [116.5, 40.0], [116.5, 39.8], [116.3, 39.8]]
+    tileX_tl, tileY_tl, mask = covering_tiles([outer, hole], zoom)
+    tileX, tileY = tile_utils.lnglatToTile(116.4, 39.9, zoom)
+    assert not mask[tileX - tileX_tl, tileY - tileY_tl]
+    tileX, tileY = tile_utils.lnglatToTile(116.1, 40.1, zoom)
+    assert mask[tileX - tileX_tl, tileY - tileY_tl]
+
+
+def test_invalid_polygons():
+    with pytest.raises(ValueError):
+        parse_polygon([[[116.3, 39.9], [116.4, 39.9]]])
+    with pytest.raises(ValueError):
+        parse_polygon('LINESTRING (116.3 39.9, 116.4 39.9)')
+    with pytest.raises(ValueError):
+        parse_polygon({'type': 'Point', 'coordinates': [116.3, 39.9]})
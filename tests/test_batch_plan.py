@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+from utils.batch_plan import BatchPlan
+
+
+class MemorySink(object):
+    def __init__(self):
+        self.tiles = {}
+
+    def exists(self, x, y):
+        return (x, y) in self.tiles
+
+    def write(self, input_image_data, x, y):
+        self.tiles[(x, y)] = input_image_data
+        return 0
+
+    def close(self):
+        pass
+
+
+# 第1个位置与第0个位置重叠2*2个瓦片，第2个位置与前两个都不重叠
+windows = [(100, 200, 3, 3), (101, 201, 3, 3), (110, 210, 2, 2)]
+
+
+def test_summary_counts_overlap():
+    plan = BatchPlan('google', 12, windows)
+    s = plan.summary()
+    assert s['requested'] == 9 + 9 + 4
+    assert s['unique'] == 9 + 9 + 4 - 4
+    assert s['saved'] == 4
+
+
+def test_keep_marks_tiles_used_later():
+    plan = BatchPlan('google', 12, windows)
+    expected = np.zeros((3, 3), dtype=bool)
+    expected[1:, 1:] = True
+    assert (plan.keep[0] == expected).all()
+    assert not plan.keep[1].any() and not plan.keep[2].any()
+
+
+def test_shared_tiles_are_reused_and_released():
+    plan = BatchPlan('google', 12, windows)
+    first = plan.job(0)
+    sink = first.wrap(MemorySink())
+    for x in range(3):
+        for y in range(3):
+            assert not sink.exists(x, y)
+            sink.write(f'{100 + x}_{200 + y}'.encode(), x, y)
+    first.release()
+    assert len(plan.store) == 4
+
+    second = plan.job(1)
+    inner = MemorySink()
+    sink = second.wrap(inner)
+    reused = [(x, y) for x in range(3) for y in range(3) if sink.exists(x, y)]
+    assert reused == [(0, 0), (0, 1), (1, 0), (1, 1)]
+    # 取用的是前一个位置中同一个瓦片的字节
+    assert inner.tiles[(0, 0)] == b'101_201'
+    assert plan.summary()['reused'] == 4
+    second.release()
+    assert plan.store == {}
+
+
+def test_job_must_match_download_range():
+    plan = BatchPlan('google', 12, windows)
+    plan.job(0).check('google', 100, 200, 3, 3, 12)
+    with pytest.raises(ValueError):
+        plan.job(0).check('google', 101, 201, 3, 3, 12)
+    with pytest.raises(ValueError):
+        plan.job(0).check('bing', 100, 200, 3, 3, 12)
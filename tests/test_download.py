@@ -0,0 +1,36 @@
+import os
+
+import cv2
+import numpy as np
+
+from utils.download import TmpdirSink
+
+
+def _png(value=128):
+    ok, encoded = cv2.imencode('.png', np.full((256, 256, 3), value, np.uint8))
+    assert ok
+    return encoded.tobytes()
+
+
+def test_decode_fallback_writes_jpg_without_leftover(tmpdir):
+    sink = TmpdirSink(str(tmpdir), passthrough=False)
+    assert sink.write(_png(), 3, 4) == 0
+    assert os.listdir(str(tmpdir)) == ['3_4.jpg']
+    tile = cv2.imread(sink.tile_path(3, 4))
+    assert tile.shape == (256, 256, 3)
+    assert abs(int(tile.mean()) - 128) <= 2
+
+
+def test_decode_fallback_failure_keeps_no_tile(tmpdir):
+    sink = TmpdirSink(str(tmpdir), passthrough=False)
+    assert sink.write(b'not an image', 0, 0) == -1
+    assert not sink.exists(0, 0)
+
+
+def test_count_ignores_part_files(tmpdir):
+    sink = TmpdirSink(str(tmpdir))
+    assert sink.write(_png(), 0, 0) == 0
+    with open(sink.tile_path(1, 0) + '.part', 'wb') as f:
+        f.write(b'\xff\xd8')
+    assert sink.count() == 1
+    assert list(sink.tiles()) == [(0, 0)]
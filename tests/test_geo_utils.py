@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+import pytest
+from utils import geo_utils
+
+rng = np.random.default_rng(0)
+# 覆盖国内(需要偏移)和国外(原样返回)的点
+lons = np.concatenate([rng.uniform(73, 135, 200), rng.uniform(-180, 180, 50)])
+lats = np.concatenate([rng.uniform(18, 53, 200), rng.uniform(-80, 80, 50)])
+
+pairs = [
+    (geo_utils.gcj02_bd09, geo_utils.gcj02_bd09_array),
+    (geo_utils.bd09_gcj02, geo_utils.bd09_gcj02_array),
+    (geo_utils.wgs84_gcj02, geo_utils.wgs84_gcj02_array),
+    (geo_utils.gcj02_wgs84, geo_utils.gcj02_wgs84_array),
+    (geo_utils.wgs84_bd09, geo_utils.wgs84_bd09_array),
+    (geo_utils.bd09_wgs84, geo_utils.bd09_wgs84_array),
+]
+
+
+@pytest.mark.parametrize('scalar, array', pairs, ids=[p[0].__name__ for p in pairs])
+def test_array_matches_scalar(scalar, array):
+    lon, lat = array(lons, lats)
+    assert lon.shape == lat.shape == lons.shape
+    for i in range(lons.size):
+        assert (lon[i], lat[i]) == pytest.approx(scalar(lons[i], lats[i]), rel=1e-12, abs=1e-9)
+
+
+def test_transform_matches_scalar():
+    lon, lat = lons - 105.0, lats - 35.0
+    tlat, tlng = geo_utils.transform_array(lon, lat)
+    for i in range(lon.size):
+        assert tlat[i] == pytest.approx(geo_utils.transformlat(lon[i], lat[i]), rel=1e-12, abs=1e-9)
+        assert tlng[i] == pytest.approx(geo_utils.transformlng(lon[i], lat[i]), rel=1e-12, abs=1e-9)
+
+
+def test_judge_China_matches_scalar():
+    outside = geo_utils.judge_China_array(lons, lats)
+    assert outside.tolist() == [geo_utils.judge_China(lon, lat) for lon, lat in zip(lons, lats)]
+
+
+@pytest.mark.parametrize('fromCoord', [0, 1, 2])
+@pytest.mark.parametrize('toCoord', [0, 1, 2])
+def test_main_array(fromCoord, toCoord):
+    lon, lat = geo_utils.main_array(lons, lats, fromCoord, toCoord)
+    for i in range(0, lons.size, 10):
+        assert (lon[i], lat[i]) == pytest.approx(geo_utils.main(lons[i], lats[i], fromCoord, toCoord),
+                                                 rel=1e-12, abs=1e-9)
+
+
+def test_scalar_and_broadcast_inputs():
+    lon, lat = geo_utils.wgs84_gcj02_array(116.39, 39.9)
+    assert (float(lon), float(lat)) == pytest.approx(geo_utils.wgs84_gcj02(116.39, 39.9), rel=1e-12)
+    lon, lat = geo_utils.wgs84_gcj02_array(lons[:5], 39.9)
+    assert lon.shape == lat.shape == (5,)
+
+
+def test_convert_dataframe_and_csv(tmp_path):
+    data = pd.DataFrame({'name': ['a', 'b', 'c'], 'lng': lons[:3], 'lat': lats[:3]})
+    converted = geo_utils.convert_dataframe(data, 0, 1, out_lon_col='lng_wgs84', out_lat_col='lat_wgs84')
+    assert data.columns.tolist() == ['name', 'lng', 'lat']
+    for i in range(3):
+        assert [converted['lng_wgs84'][i], converted['lat_wgs84'][i]] == \
+               pytest.approx(geo_utils.gcj02_wgs84(lons[i], lats[i]), rel=1e-12)
+
+    csv_path, out_path = tmp_path / 'in.csv', tmp_path / 'out.csv'
+    data.to_csv(csv_path, index=False)
+    geo_utils.convert_csv(str(csv_path), str(out_path), 2, 1)
+    result = pd.read_csv(out_path)
+    for i in range(3):
+        assert [result['lng'][i], result['lat'][i]] == \
+               pytest.approx(geo_utils.bd09_wgs84(lons[i], lats[i]), rel=1e-10)
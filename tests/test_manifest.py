@@ -0,0 +1,167 @@
+import numpy as np
+import pytest
+from utils.download import TmpdirSink
+from utils.manifest import JobManifest, ManifestSink, PENDING, DONE, FAILED, NODATA, OVERZOOM
+from utils.tile_grid import download_grid
+
+job = dict(datasource='google', zoom=10, tileX_tl=850, tileY_tl=420, nX=4, nY=3)
+
+
+def test_new_manifest_is_pending(tmp_path):
+    manifest = JobManifest(str(tmp_path / 'job.manifest'), **job)
+    assert manifest.created
+    assert manifest.summary() == {'total': 12, 'done': 0, 'nodata': 0, 'failed': 0, 'overzoom': 0, 'pending': 12}
+    manifest.close()
+
+
+def test_state_survives_reopen(tmp_path):
+    path = str(tmp_path / 'job.manifest')
+    manifest = JobManifest(path, **job)
+    manifest.mark(0, 0, DONE)
+    manifest.mark(1, 2, NODATA)
+    manifest.mark(3, 1, FAILED)
+    manifest.mark(2, 2, OVERZOOM)
+    manifest.close()
+
+    manifest = JobManifest(path, **job)
+    assert not manifest.created
+    assert manifest.is_done(0, 0) and manifest.is_done(1, 2)
+    assert not manifest.is_done(3, 1) and not manifest.is_done(2, 2)
+    assert manifest.summary() == {'total': 12, 'done': 2, 'nodata': 1, 'failed': 1, 'overzoom': 1, 'pending': 8}
+    assert not manifest.is_complete()
+    manifest.remove()
+    assert not (tmp_path / 'job.manifest').exists()
+
+
+def test_placeholder_mask(tmp_path):
+    manifest = JobManifest(str(tmp_path / 'job.manifest'), **job)
+    manifest.mark(0, 0, DONE)
+    manifest.mark(1, 2, NODATA)
+    manifest.mark(2, 1, OVERZOOM)
+    manifest.mark(3, 0, FAILED)
+    placeholder_mask = manifest.placeholder_mask()
+    manifest.close()
+    expected = np.zeros((4, 3), dtype=bool)
+    expected[1, 2] = expected[2, 1] = True
+    assert (placeholder_mask == expected).all()
+
+
+def test_other_job_is_rejected(tmp_path):
+    path = str(tmp_path / 'job.manifest')
+    JobManifest(path, **job).close()
+    with pytest.raises(ValueError):
+        JobManifest(path, **dict(job, zoom=11))
+    with pytest.raises(ValueError):
+        JobManifest(path, **dict(job, datasource='bing'))
+
+
+def test_manifest_sink_states(tmp_path):
+    class FakeSink(object):
+        def __init__(self):
+            self.status = 0
+
+        def exists(self, x, y):
+            return False
+
+        def write(self, input_image_data, x, y):
+            return self.status
+
+        def close(self):
+            pass
+
+    manifest = JobManifest(str(tmp_path / 'job.manifest'), **job)
+    inner = FakeSink()
+    sink = ManifestSink(inner, manifest)
+    # 开始下载时记为失败，写入成功后改为完成
+    assert not sink.exists(0, 0)
+    assert manifest.state[0, 0] == FAILED
+    assert sink.write(b'tile', 0, 0) == 0
+    assert manifest.state[0, 0] == DONE
+    assert sink.exists(0, 0)
+
+    inner.status = -1
+    assert not sink.exists(1, 0)
+    assert sink.write(b'tile', 1, 0) == -1
+    assert manifest.state[1, 0] == FAILED
+
+    # 由父瓦片补齐的瓦片重新下载失败时保持OVERZOOM
+    manifest.mark(2, 0, OVERZOOM)
+    assert not sink.exists(2, 0)
+    assert manifest.state[2, 0] == OVERZOOM
+    manifest.close()
+
+
+def test_sync_imports_existing_tmpdir(tmp_path):
+    tmpdir = tmp_path / 'tiles'
+    tmpdir.mkdir()
+    for x, y in [(0, 0), (1, 1), (9, 9)]:
+        (tmpdir / f'{x}_{y}.jpg').write_bytes(b'tile')
+    (tmpdir / '2_2.jpg.part').write_bytes(b'partial')
+    manifest = JobManifest(str(tmp_path / 'job.manifest'), **job)
+    manifest.mark(3, 2, OVERZOOM)
+    (tmpdir / '3_2.jpg').write_bytes(b'tile')
+    ManifestSink(TmpdirSink(str(tmpdir)), manifest)
+    expected = np.zeros((4, 3), dtype=bool)
+    expected[0, 0] = expected[1, 1] = True
+    assert (manifest.done_mask() == expected).all()
+    assert manifest.state[3, 2] == OVERZOOM
+    assert manifest.state[2, 2] == PENDING
+    manifest.close()
+
+
+def _requested(records):
+    return sorted((r[0], r[1]) for r in records)
+
+
+def test_resume_requests_only_remaining_tiles(tmp_path, mock_server):
+    tmpdir = tmp_path / 'tiles'
+    tmpdir.mkdir()
+    path = str(tmp_path / 'job.manifest')
+
+    # 第一次运行只完成一部分瓦片，模拟中断
+    mask = np.zeros((job['nX'], job['nY']), dtype=bool)
+    mask[:2] = True
+    manifest = JobManifest(path, **job)
+    download_grid(TmpdirSink(str(tmpdir)), job['datasource'], job['tileX_tl'], job['tileY_tl'], job['nX'], job['nY'],
+                  job['zoom'], nproc=4, manifest=manifest, tile_mask=mask)
+    manifest.close()
+    records = mock_server.reset()
+    assert len(records) == 6 and all(r[1] == 200 for r in records)
+
+    manifest = JobManifest(path, **job)
+    assert manifest.done_count() == 6
+    download_grid(TmpdirSink(str(tmpdir)), job['datasource'], job['tileX_tl'], job['tileY_tl'], job['nX'], job['nY'],
+                  job['zoom'], nproc=4, manifest=manifest)
+    records = mock_server.reset()
+    assert len(records) == 6 and all(r[1] == 200 for r in records)
+    assert manifest.is_complete()
+    assert sorted(TmpdirSink(str(tmpdir)).tiles()) == [(x, y) for x in range(4) for y in range(3)]
+    manifest.close()
+
+    # 已完成的任务再次运行不发出任何请求
+    manifest = JobManifest(path, **job)
+    download_grid(TmpdirSink(str(tmpdir)), job['datasource'], job['tileX_tl'], job['tileY_tl'], job['nX'], job['nY'],
+                  job['zoom'], nproc=4, manifest=manifest)
+    assert mock_server.reset() == []
+    manifest.close()
+
+
+def test_resume_retries_failed_tiles(tmp_path, mock_server):
+    tmpdir = tmp_path / 'tiles'
+    tmpdir.mkdir()
+    path = str(tmp_path / 'job.manifest')
+    JobManifest(path, **job).close()
+    manifest = JobManifest(path, **job)
+    for x in range(job['nX']):
+        for y in range(job['nY']):
+            manifest.mark(x, y, DONE)
+    # 上次运行中失败的瓦片
+    manifest.mark(1, 1, FAILED)
+    manifest.mark(2, 0, FAILED)
+    download_grid(TmpdirSink(str(tmpdir)), job['datasource'], job['tileX_tl'], job['tileY_tl'], job['nX'], job['nY'],
+                  job['zoom'], nproc=4, manifest=manifest)
+    requested = sorted((r[0], r[1]) for r in mock_server.reset())
+    assert requested == [('google', 200), ('google', 200)]
+    assert sorted(TmpdirSink(str(tmpdir)).tiles()) == [(1, 1), (2, 0)]
+    assert manifest.is_complete()
+    manifest.close()
@@ -0,0 +1,72 @@
+import os
+from utils.download import TmpdirSink, min_tile_bytes
+from utils.placeholder import PlaceholderRegistry, placeholder_scope
+from utils.tile_cache import TileCache, cache_scope
+from utils.tile_grid import download_grid
+
+blank = b'\xff\xd8' + b'\x00' * 1000
+tile = os.urandom(20000)
+
+
+def test_small_responses_always_match():
+    registry = PlaceholderRegistry()
+    assert registry.match('google', b'x' * (min_tile_bytes - 1))
+    assert registry.summary() == {'google': 1}
+
+
+def test_known_fingerprint_matches_per_source():
+    registry = PlaceholderRegistry()
+    registry.add('google', blank)
+    assert registry.match('google', blank)
+    assert not registry.match('bing', blank)
+    # 字节数相同但内容不同
+    assert not registry.match('google', blank[:-1] + b'\x01')
+    assert not registry.match('google', tile)
+
+
+def test_learn_repeated_small_responses():
+    registry = PlaceholderRegistry(learn_threshold=3, learn_max_bytes=4096)
+    assert not registry.match('google', blank)
+    assert not registry.match('google', blank)
+    assert registry.match('google', blank)
+    assert registry.match('google', blank)
+    # 超过learn_max_bytes的响应不学习
+    for _ in range(5):
+        assert not registry.match('google', tile)
+
+
+def test_known_has_no_side_effects():
+    registry = PlaceholderRegistry(learn_threshold=2, learn_max_bytes=4096)
+    for _ in range(3):
+        assert not registry.known('google', blank)
+    assert registry.known('google', b'x')
+    assert registry.summary() == {}
+    assert not registry.match('google', blank)
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / 'placeholders.json')
+    registry = PlaceholderRegistry(path)
+    registry.add('google', blank)
+    registry.save()
+    loaded = PlaceholderRegistry(path)
+    assert loaded.match('google', blank)
+    assert not loaded.match('google', tile)
+
+
+def test_placeholders_are_not_cached(tmp_path, mock_server):
+    # 模拟服务返回的所有瓦片都登记为占位瓦片
+    registry = PlaceholderRegistry()
+    for input_image_data in mock_server.pool:
+        registry.add('google', input_image_data)
+    cache = TileCache(str(tmp_path / 'cache'))
+    tmpdir = tmp_path / 'tiles'
+    tmpdir.mkdir()
+    with cache_scope(cache), placeholder_scope(registry):
+        for _ in range(2):
+            download_grid(TmpdirSink(str(tmpdir)), 'google', 850, 420, 3, 2, 10, nproc=2)
+            # 每次运行都重新请求，不会命中缓存中的占位瓦片
+            assert len(mock_server.reset()) == 6
+    assert cache.size() == 0
+    assert list(TmpdirSink(str(tmpdir)).tiles()) == []
+    cache.close()
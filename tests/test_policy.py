@@ -0,0 +1,130 @@
+import asyncio
+import pytest
+from utils.policy import AdaptivePolicy
+
+
+def test_backoff_grows_exponentially_with_jitter():
+    policy = AdaptivePolicy(backoff_base=0.5, backoff_max=30.0)
+    for attempt in range(5):
+        delay = 0.5 * 2 ** attempt
+        for _ in range(50):
+            assert delay / 2 <= policy.backoff(attempt) <= delay
+
+
+def test_backoff_is_capped():
+    policy = AdaptivePolicy(backoff_base=0.5, backoff_max=4.0)
+    for _ in range(50):
+        assert 2.0 <= policy.backoff(20) <= 4.0
+
+
+def test_controller_per_host():
+    policy = AdaptivePolicy()
+    a = policy.controller('http://mt0.google.com/vt?x=1')
+    assert policy.controller('http://mt0.google.com/vt?x=2') is a
+    assert policy.controller('http://mt1.google.com/vt?x=1') is not a
+
+
+def test_additive_increase_up_to_max():
+    policy = AdaptivePolicy(max_concurrency=4, initial_concurrency=2)
+    controller = policy.controller('http://h/')
+    controller.on_success(0.05)
+    assert controller.limit == pytest.approx(2.5)
+    for _ in range(100):
+        controller.on_success(0.05)
+    assert controller.limit == 4
+
+
+def test_multiplicative_decrease_on_throttle_with_cooldown():
+    policy = AdaptivePolicy(max_concurrency=16, initial_concurrency=16, decrease_cooldown=60)
+    controller = policy.controller('http://h/')
+    controller.on_failure(429)
+    assert controller.limit == 8
+    # 冷却期内的失败不再减小
+    controller.on_failure(503)
+    controller.on_failure()
+    assert controller.limit == 8
+    controller.last_decrease = 0
+    controller.on_failure()
+    assert controller.limit == 4
+
+
+def test_client_errors_do_not_decrease():
+    policy = AdaptivePolicy(max_concurrency=8, initial_concurrency=8)
+    controller = policy.controller('http://h/')
+    controller.on_failure(404)
+    assert controller.limit == 8
+
+
+def test_decrease_stops_at_min_concurrency():
+    policy = AdaptivePolicy(max_concurrency=8, min_concurrency=3, initial_concurrency=4, decrease_cooldown=0)
+    controller = policy.controller('http://h/')
+    for _ in range(10):
+        controller.on_failure(500)
+    assert controller.limit == 3
+
+
+def test_latency_spike_decreases():
+    policy = AdaptivePolicy(max_concurrency=8, initial_concurrency=8, min_samples=20, slow_factor=3.0)
+    controller = policy.controller('http://h/')
+    for _ in range(20):
+        controller.on_success(0.1)
+    limit = controller.limit
+    controller.on_success(1.0)
+    assert controller.limit == limit * policy.decrease_factor
+
+
+def test_timeout_from_latency_percentile():
+    policy = AdaptivePolicy(initial_timeout=2.0, min_timeout=0.5, max_timeout=10.0, min_samples=20,
+                            timeout_percentile=0.99, timeout_factor=2.0)
+    controller = policy.controller('http://h/')
+    assert controller.timeout() == 2.0
+    for _ in range(20):
+        controller.on_success(0.4)
+    assert controller.timeout() == pytest.approx(0.8)
+    fast = policy.controller('http://fast/')
+    for _ in range(20):
+        fast.on_success(0.01)
+    assert fast.timeout() == 0.5
+    slow = AdaptivePolicy(min_samples=20, slow_factor=100).controller('http://slow/')
+    for _ in range(20):
+        slow.on_success(8.0)
+    assert slow.timeout() == 10.0
+
+
+def test_acquire_async_respects_limit_and_wakes_waiters():
+    policy = AdaptivePolicy(max_concurrency=2, initial_concurrency=2)
+    controller = policy.controller('http://h/')
+    peak = [0]
+
+    async def task():
+        await controller.acquire_async()
+        peak[0] = max(peak[0], controller.inflight)
+        await asyncio.sleep(0.001)
+        controller.release()
+
+    async def run():
+        await asyncio.wait_for(asyncio.gather(*[task() for _ in range(50)]), timeout=5)
+
+    asyncio.run(run())
+    assert peak[0] == 2
+    assert controller.inflight == 0
+    assert not controller.async_waiters
+
+
+def test_cancelled_waiter_passes_slot_on():
+    policy = AdaptivePolicy(max_concurrency=1, initial_concurrency=1)
+    controller = policy.controller('http://h/')
+
+    async def run():
+        await controller.acquire_async()
+        first = asyncio.ensure_future(controller.acquire_async())
+        second = asyncio.ensure_future(controller.acquire_async())
+        await asyncio.sleep(0)
+        controller.release()
+        # first已被唤醒但在拿到名额前取消，名额应转交给second
+        first.cancel()
+        await asyncio.wait_for(second, timeout=1)
+        controller.release()
+
+    asyncio.run(run())
+    assert controller.inflight == 0
@@ -0,0 +1,54 @@
+import threading
+import pytest
+from utils.download import TmpdirSink
+from utils.metrics import get_metrics, record_tile, run_scope
+from utils.tile_cache import TileCache, cache_scope, get_cache
+from utils.tile_grid import download_grid
+
+
+def test_concurrent_run_scopes_are_isolated():
+    barrier = threading.Barrier(2)
+    results = {}
+
+    def run(name, count):
+        with run_scope(name, report=False) as metrics:
+            # 两个线程的作用域交错进入和退出
+            barrier.wait()
+            for _ in range(count):
+                record_tile('done')
+            barrier.wait()
+        results[name] = (metrics.snapshot()['tiles'], get_metrics())
+
+    threads = [threading.Thread(target=run, args=('a', 3)), threading.Thread(target=run, args=('b', 5))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results['a'] == ({'done': 3}, None)
+    assert results['b'] == ({'done': 5}, None)
+    assert get_metrics() is None
+
+
+def test_nested_scopes_merge_into_parent():
+    with run_scope('outer', report=False) as outer:
+        with run_scope('inner', report=False) as inner:
+            record_tile('done')
+            assert get_metrics() is inner
+        assert get_metrics() is outer
+    assert outer.snapshot()['tiles'] == {'done': 1}
+
+
+@pytest.mark.parametrize('engine', ['thread', 'async'])
+def test_download_workers_inherit_scopes(tmp_path, mock_server, engine):
+    cache = TileCache(str(tmp_path / 'cache'))
+    tmpdir = tmp_path / 'tiles'
+    tmpdir.mkdir()
+    with run_scope('grid', report=False) as metrics, cache_scope(cache):
+        download_grid(TmpdirSink(str(tmpdir)), 'google', 850, 420, 3, 2, 10, nproc=4, engine=engine)
+    assert get_cache() is None
+    snapshot = metrics.snapshot()
+    assert snapshot['tiles'] == {'done': 6}
+    assert snapshot['sources']['google']['requests'] == 6
+    # 工作线程中写入了缓存
+    assert cache.get('google', 10, 850, 420) is not None
+    cache.close()
@@ -0,0 +1,56 @@
+import os
+from utils import tile_cache
+from utils.tile_cache import TileCache
+
+
+def _blob(i):
+    return i.to_bytes(4, 'big') * 250
+
+
+def test_put_get_and_dedup(tmp_path):
+    cache = TileCache(str(tmp_path))
+    cache.put('google', 10, 1, 2, _blob(1))
+    cache.put('google', 10, 1, 3, _blob(1))
+    cache.put('bing', 10, 1, 2, _blob(2))
+    assert cache.get('google', 10, 1, 2) == _blob(1)
+    assert cache.get('google', 10, 9, 9) is None
+    # 相同内容只存一份
+    assert cache.size() == 2000
+    cache.close()
+
+
+def test_evict_keeps_shared_blobs(tmp_path):
+    cache = TileCache(str(tmp_path))
+    for i in range(2500):
+        cache.put('google', 10, i, 0, _blob(i))
+    # 最早写入的内容还被最新的瓦片引用
+    cache.put('google', 10, 9999, 0, _blob(0))
+    cache.max_bytes = 2000 * 1000
+    assert cache.evict() == 999
+    assert cache.size() == 1501 * 1000
+    assert cache.get('google', 10, 9999, 0) == _blob(0)
+    assert cache.get('google', 10, 0, 0) is None
+    assert cache.get('google', 10, 999, 0) is None
+    assert cache.get('google', 10, 1000, 0) == _blob(1000)
+    # 索引与对象文件一致
+    files = [f for d in os.listdir(cache.objects_dir) for f in os.listdir(os.path.join(cache.objects_dir, d))]
+    assert len(files) * 1000 == cache.size()
+    cache.close()
+
+
+def test_missing_blob_file_drops_index(tmp_path):
+    cache = TileCache(str(tmp_path))
+    cache.put('google', 10, 1, 2, _blob(1))
+    cache.put('google', 10, 1, 3, _blob(1))
+    cache.put('google', 10, 1, 4, _blob(2))
+    blob_dir = cache.objects_dir
+    for d in os.listdir(blob_dir):
+        for f in os.listdir(os.path.join(blob_dir, d)):
+            with open(os.path.join(blob_dir, d, f), 'rb') as fp:
+                if fp.read() == _blob(1):
+                    os.remove(os.path.join(blob_dir, d, f))
+    assert cache.get('google', 10, 1, 2) is None
+    assert cache.get('google', 10, 1, 3) is None
+    assert cache.size() == 1000
+    assert cache.get('google', 10, 1, 4) == _blob(2)
+    cache.close()
@@ -0,0 +1,129 @@
+import math
+import numpy as np
+import pytest
+from utils import tile_utils
+
+
+# 改为numpy实现之前的标量公式，作为对照
+def ref_lnglatToTile(lng, lat, level):
+    tileX = int((lng + 180) / 360 * math.pow(2, level))
+    tileY = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) * math.pow(2, level - 1))
+    return tileX, tileY
+
+
+def ref_tileToLnglat(tileX, tileY, level):
+    lng = tileX / math.pow(2, level) * 360 - 180
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * tileY / math.pow(2, level)))))
+    return lng, lat
+
+
+def ref_lnglatToPixel(lng, lat, level):
+    pixelX = round((lng + 180) / 360 * math.pow(2, level) * 256 % 256)
+    pixelY = round((1 - math.log(math.tan(math.radians(lat)) + 1 / math.cos(math.radians(lat))) / (2 * math.pi)) *
+                   math.pow(2, level) * 256 % 256)
+    return pixelX, pixelY
+
+
+def ref_pixelToLnglat(tileX, tileY, pixelX, pixelY, level):
+    lng = (tileX + pixelX / 256) / math.pow(2, level) * 360 - 180
+    lat = math.degrees(math.atan(math.sinh(math.pi - 2 * math.pi * (tileY + pixelY / 256) / math.pow(2, level))))
+    return lng, lat
+
+
+def ref_TileXYToQuadKey(tileX, tileY, level):
+    quadKey = ''
+    for l in range(level):
+        i = level - l
+        digit = ord('0')
+        mask = 1 << (i - 1)
+        if (tileX & mask) != 0:
+            digit += 1
+        if (tileY & mask) != 0:
+            digit += 2
+        quadKey += chr(digit)
+    return quadKey
+
+
+rng = np.random.default_rng(0)
+lngs = rng.uniform(-179.9, 179.9, 200)
+lats = rng.uniform(-85, 85, 200)
+levels = [0, 1, 8, 15, 18, 21]
+
+
+@pytest.mark.parametrize('level', levels)
+def test_lnglatToTile(level):
+    tileX, tileY = tile_utils.lnglatToTileArray(lngs, lats, level)
+    assert tileX.shape == tileY.shape == lngs.shape
+    for i, (lng, lat) in enumerate(zip(lngs, lats)):
+        expected = ref_lnglatToTile(lng, lat, level)
+        assert (int(tileX[i]), int(tileY[i])) == expected
+        assert tile_utils.lnglatToTile(lng, lat, level) == expected
+
+
+@pytest.mark.parametrize('level', levels)
+def test_tileToLnglat(level):
+    n = 2 ** level
+    tileXs = rng.integers(0, n + 1, 100)
+    tileYs = rng.integers(0, n + 1, 100)
+    lng, lat = tile_utils.tileToLnglatArray(tileXs, tileYs, level)
+    for i, (tileX, tileY) in enumerate(zip(tileXs.tolist(), tileYs.tolist())):
+        expected = ref_tileToLnglat(tileX, tileY, level)
+        assert (lng[i], lat[i]) == pytest.approx(expected, rel=1e-12, abs=1e-12)
+        assert tile_utils.tileToLnglat(tileX, tileY, level) == pytest.approx(expected, rel=1e-12, abs=1e-12)
+
+
+@pytest.mark.parametrize('level', levels)
+def test_lnglatToPixel(level):
+    pixelX, pixelY = tile_utils.lnglatToPixelArray(lngs, lats, level)
+    for i, (lng, lat) in enumerate(zip(lngs, lats)):
+        expected = ref_lnglatToPixel(lng, lat, level)
+        assert (int(pixelX[i]), int(pixelY[i])) == expected
+        assert tile_utils.lnglatToPixel(lng, lat, level) == expected
+
+
+@pytest.mark.parametrize('level', levels)
+def test_pixelToLnglat(level):
+    n = 2 ** level
+    tileXs = rng.integers(0, n, 100)
+    tileYs = rng.integers(0, n, 100)
+    pixelXs = rng.integers(0, 256, 100)
+    pixelYs = rng.integers(0, 256, 100)
+    lng, lat = tile_utils.pixelToLnglatArray(tileXs, tileYs, pixelXs, pixelYs, level)
+    for i, args in enumerate(zip(tileXs.tolist(), tileYs.tolist(), pixelXs.tolist(), pixelYs.tolist())):
+        expected = ref_pixelToLnglat(*args, level)
+        assert (lng[i], lat[i]) == pytest.approx(expected, rel=1e-12, abs=1e-12)
+        assert tile_utils.pixelToLnglat(*args, level) == pytest.approx(expected, rel=1e-12, abs=1e-12)
+
+
+def test_scalar_functions_return_python_types():
+    assert all(type(v) is int for v in tile_utils.lnglatToTile(116.39, 39.9, 18))
+    assert all(type(v) is int for v in tile_utils.lnglatToPixel(116.39, 39.9, 18))
+    assert all(type(v) is float for v in tile_utils.tileToLnglat(215828, 99324, 18))
+    assert all(type(v) is float for v in tile_utils.pixelToLnglat(215828, 99324, 12, 200, 18))
+
+
+@pytest.mark.parametrize('level', [0, 1, 5, 18, 23])
+def test_quadkey(level):
+    n = 2 ** level
+    tileXs = rng.integers(0, n, 100)
+    tileYs = rng.integers(0, n, 100)
+    quadKeys = tile_utils.TileXYToQuadKeyArray(tileXs, tileYs, level)
+    for i, (tileX, tileY) in enumerate(zip(tileXs.tolist(), tileYs.tolist())):
+        expected = ref_TileXYToQuadKey(tileX, tileY, level)
+        assert quadKeys[i] == expected
+        assert tile_utils.TileXYToQuadKey(tileX, tileY, level) == expected
+
+
+def test_quadkeys_for_range():
+    quadKeys = tile_utils.quadKeysForRange(1000, 2000, 5, 3, 12)
+    assert quadKeys.shape == (5, 3)
+    for x in range(5):
+        for y in range(3):
+            assert quadKeys[x, y] == ref_TileXYToQuadKey(1000 + x, 2000 + y, 12)
+
+
+def test_geo_transform():
+    lng_lt, lat_lt = ref_tileToLnglat(215828, 99324, 18)
+    lng_rb, lat_rb = ref_tileToLnglat(215828 + 7, 99324 + 5, 18)
+    expected = (lng_lt, (lng_rb - lng_lt) / (7 * 256), 0, lat_lt, 0, (lat_rb - lat_lt) / (5 * 256))
+    assert tile_utils.getGeoTransform(215828, 99324, 7, 5, 18) == pytest.approx(expected, rel=1e-12)
@@ -0,0 +1,118 @@
+import os
+import re
+import json
+import numpy as np
+
+
+def _rings_from_geojson(geometry):
+    geometry_type = geometry['type']
+    if geometry_type == 'FeatureCollection':
+        return [ring for feature in geometry['features'] for ring in _rings_from_geojson(feature)]
+    if geometry_type == 'Feature':
+        return _rings_from_geojson(geometry['geometry'])
+    if geometry_type == 'GeometryCollection':
+        return [ring for g in geometry['geometries'] for ring in _rings_from_geojson(g)]
+    if geometry_type == 'Polygon':
+        return [np.asarray(ring, dtype=np.float64)[:, :2] for ring in geometry['coordinates']]
+    if geometry_type == 'MultiPolygon':
+        return [np.asarray(ring, dtype=np.float64)[:, :2] for polygon in geometry['coordinates'] for ring in polygon]
+    raise ValueError("unsupported geojson geometry, {}".format(geometry_type))
+
+
+def _rings_from_wkt(wkt):
+    wkt = wkt.strip()
+    if not re.match(r'^(MULTI)?POLYGON\s*(Z|M|ZM)?\s*\(', wkt, re.IGNORECASE):
+        raise ValueError("unsupported wkt geometry, {}".format(wkt[:32]))
+    rings = []
+    # 最内层括号即一个环
+    for ring in re.findall(r'\(([^()]+)\)', wkt):
+        points = [[float(v) for v in p.split()[:2]] for p in ring.split(',') if p.strip()]
+        rings.append(np.asarray(points, dtype=np.float64))
+    return rings
+
+
+def parse_polygon(polygon):
+    """
+    解析经纬度(wgs84)多边形，支持GeoJSON(dict、字符串或.geojson/.json文件)和WKT(POLYGON/MULTIPOLYGON)
+    :return: 环的列表，每个环为(N, 2)的[经度, 纬度]数组；内环(洞)按奇偶规则处理
+    """
+    if isinstance(polygon, str) and os.path.isfile(polygon):
+        with open(polygon, 'r', encoding='utf-8') as f:
+            polygon = f.read()
+    if isinstance(polygon, str):
+        text = polygon.strip()
+        polygon = json.loads(text) if text.startswith('{') else _rings_from_wkt(text)
+    if isinstance(polygon, dict):
+        polygon = _rings_from_geojson(polygon)
+    rings = [np.asarray(ring, dtype=np.float64) for ring in polygon]
+    rings = [ring for ring in rings if len(ring) >= 3]
+    if not rings:
+        raise ValueError("empty polygon")
+    return rings
+
+
+# 经纬度转全球瓦片坐标(带小数)
+def _lnglat_to_tile_xy(ring, zoom):
+    n = 2.0 ** zoom
+    x = (ring[:, 0] + 180) / 360 * n
+    y = (1 - np.arcsinh(np.tan(np.radians(ring[:, 1]))) / np.pi) * (n / 2)
+    return np.stack([x, y], axis=1)
+
+
+def _mark_edges(mask, p0, p1):
+    # 线段经过的所有瓦片：在每个整数x、y处切分，各小段中点所在的瓦片即为经过的瓦片
+    ts = [0.0, 1.0]
+    for axis in range(2):
+        a, b = p0[axis], p1[axis]
+        if a != b:
+            lo, hi = min(a, b), max(a, b)
+            grid = np.arange(np.floor(lo) + 1, np.ceil(hi))
+            ts.extend(((grid - a) / (b - a)).tolist())
+    ts = np.unique(np.clip(ts, 0.0, 1.0))
+    mids = (ts[:-1] + ts[1:]) / 2 if len(ts) > 1 else ts
+    points = p0[None, :] + mids[:, None] * (p1 - p0)[None, :]
+    points = np.concatenate([points, p0[None, :], p1[None, :]])
+    xs = np.clip(np.floor(points[:, 0]).astype(np.int64), 0, mask.shape[0] - 1)
+    ys = np.clip(np.floor(points[:, 1]).astype(np.int64), 0, mask.shape[1] - 1)
+    mask[xs, ys] = True
+
+
+def _mark_interior(mask, edges):
+    # 按瓦片中心逐行扫描，奇偶规则判断中心是否在多边形内
+    x0, y0, x1, y1 = edges[:, 0], edges[:, 1], edges[:, 2], edges[:, 3]
+    centers_x = np.arange(mask.shape[0]) + 0.5
+    for row in range(mask.shape[1]):
+        yc = row + 0.5
+        crossing = (y0 <= yc) != (y1 <= yc)
+        if not crossing.any():
+            continue
+        xs = x0[crossing] + (yc - y0[crossing]) * (x1[crossing] - x0[crossing]) / (y1[crossing] - y0[crossing])
+        xs = np.sort(xs)
+        inside = (np.searchsorted(xs, centers_x) % 2) == 1
+        mask[inside, row] = True
+
+
+def covering_tiles(polygon, zoom):
+    """
+    计算与多边形相交的全部瓦片
+    :param polygon: 见parse_polygon
+    :return: (tileX_tl, tileY_tl, mask)，mask为(nX, nY)的bool数组，mask[x, y]表示瓦片(tileX_tl + x, tileY_tl + y)与多边形相交
+    """
+    rings = [_lnglat_to_tile_xy(ring, zoom) for ring in parse_polygon(polygon)]
+    points = np.concatenate(rings)
+    tileX_tl, tileY_tl = np.floor(points.min(axis=0)).astype(np.int64)
+    tileX_br, tileY_br = np.floor(points.max(axis=0)).astype(np.int64)
+    nX = int(tileX_br - tileX_tl + 1)
+    nY = int(tileY_br - tileY_tl + 1)
+    mask = np.zeros((nX, nY), dtype=bool)
+
+    edges = []
+    for ring in rings:
+        ring = ring - [tileX_tl, tileY_tl]
+        # 首尾不闭合时补上最后一条边
+        closed = ring if np.array_equal(ring[0], ring[-1]) else np.concatenate([ring, ring[:1]])
+        for p0, p1 in zip(closed[:-1], closed[1:]):
+            _mark_edges(mask, p0, p1)
+        edges.append(np.concatenate([closed[:-1], closed[1:]], axis=1))
+    _mark_interior(mask, np.concatenate(edges))
+    return int(tileX_tl), int(tileY_tl), mask
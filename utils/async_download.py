@@ -0,0 +1,181 @@
+import asyncio
+import contextvars
+import functools
+import time
+from concurrent import futures
+import aiohttp
+from utils.download import retry_limit, timeout, write_tile, cacheable
+from utils.tile_cache import get_cache
+from utils.hedge import get_hedge
+from utils.url import mirror_url
+from utils.metrics import record_request, record_retry, record_queue, record_tile
+
+# 整个网格上同时在途的请求数
+max_inflight = 256
+
+
+async def _fetch_once(session, url, headers, policy):
+    controller = policy.controller(url)
+    # 等待该主机的并发名额
+    await controller.acquire_async()
+    try:
+        s = time.time()
+        try:
+            async with session.get(url, headers=headers,
+                                   timeout=aiohttp.ClientTimeout(total=controller.timeout())) as response:
+                if response.status != 200:
+                    controller.on_failure(response.status)
+                    record_request(url, response.status, time.time() - s)
+                    return None
+                input_image_data = await response.read()
+        except Exception as e:
+            controller.on_failure()
+            record_request(url, 'error', time.time() - s)
+            return None
+        latency = time.time() - s
+        record_request(url, 200, latency, len(input_image_data))
+        controller.on_success(latency)
+        return input_image_data
+    finally:
+        controller.release()
+
+
+async def _get_once(session, url, headers):
+    s = time.time()
+    try:
+        async with session.get(url, headers=headers) as response:
+            if response.status == 200:
+                input_image_data = await response.read()
+                record_request(url, 200, time.time() - s, len(input_image_data))
+                return input_image_data
+            record_request(url, response.status, time.time() - s)
+    except Exception as e:
+        record_request(url, 'error', time.time() - s)
+    return None
+
+
+async def _timed(coro):
+    s = time.time()
+    return await coro, time.time() - s
+
+
+async def _fetch_hedged(attempt, url, headers, hedge):
+    # 与HedgePolicy.fetch相同，落后的请求直接取消
+    hedge.start()
+    primary = asyncio.ensure_future(_timed(attempt(url, headers)))
+    pending = {primary}
+    done, _ = await asyncio.wait(pending, timeout=hedge.delay())
+    hedged = False
+    if not done:
+        hedge_url = mirror_url(url)
+        if hedge_url is not None and hedge.try_hedge():
+            hedged = True
+            pending.add(asyncio.ensure_future(_timed(attempt(hedge_url, headers))))
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                input_image_data, latency = task.result()
+                if input_image_data is not None:
+                    hedge.observe(latency)
+                    hedge.finish(hedged, task is not primary, True)
+                    return input_image_data
+        hedge.finish(hedged, False, False)
+        return None
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def _fetch(session, url, headers, policy=None):
+    hedge = get_hedge()
+    if policy is not None:
+        if hedge is not None:
+            return await _fetch_hedged(lambda u, h: _fetch_once(session, u, h, policy), url, headers, hedge)
+        return await _fetch_once(session, url, headers, policy)
+    for retry in range(retry_limit):
+        if retry > 0:
+            record_retry(url)
+        if hedge is not None:
+            input_image_data = await _fetch_hedged(lambda u, h: _get_once(session, u, h), url, headers, hedge)
+        else:
+            input_image_data = await _get_once(session, url, headers)
+        if input_image_data is not None:
+            return input_image_data
+    print("Failed to get {} with retry={}.".format(url, retry_limit))
+    return None
+
+
+def _run_in_executor(loop, executor, func, *args):
+    # run_in_executor不传递contextvars，线程池中的写入、缓存与事件循环使用同样的作用域
+    return loop.run_in_executor(executor, functools.partial(contextvars.copy_context().run, func, *args))
+
+
+async def _download_one(session, url, headers, x, y, key, sink, executor, cache, policy, in_flight):
+    loop = asyncio.get_running_loop()
+    if sink.exists(x, y):
+        record_tile('skipped')
+        return 0
+    if cache is not None:
+        input_image_data = await _run_in_executor(loop, executor, cache.get, *key)
+        if input_image_data is not None and cacheable(key[0], input_image_data) and \
+                await _run_in_executor(loop, executor, write_tile, sink, input_image_data, x, y) == 0:
+            record_tile('cached')
+            return 0
+    in_flight[0] += 1
+    record_queue('async_inflight', in_flight[0])
+    try:
+        input_image_data = await _fetch(session, url, headers, policy)
+    finally:
+        in_flight[0] -= 1
+    status = -1
+    if input_image_data is not None:
+        # 解码与写入放到线程池，避免阻塞事件循环
+        status = await _run_in_executor(loop, executor, write_tile, sink, input_image_data, x, y)
+        if status == 0 and cache is not None and cacheable(key[0], input_image_data):
+            await _run_in_executor(loop, executor, cache.put, *key, input_image_data)
+    record_tile('done' if status == 0 else 'failed')
+    return status
+
+
+async def _worker(session, tasks, sink, pbar, executor, failed, max_failures, policy, in_flight):
+    cache = get_cache()
+    # 所有worker共享同一个任务迭代器，单线程内无需加锁
+    for url, headers, x, y, key in tasks:
+        if len(failed) >= max_failures:
+            return
+        status = await _download_one(session, url, headers, x, y, key, sink, executor, cache, policy, in_flight)
+        pbar.update(1)
+        if status != 0:
+            failed.append((url, headers, x, y, key))
+
+
+async def _download_all(tasks, sink, pbar, nproc, inflight, max_failures, policy):
+    failed = []
+    tasks = iter(tasks)
+    # 在途请求数，所有worker在同一个事件循环中，无需加锁
+    in_flight = [0]
+    connector = aiohttp.TCPConnector(limit=inflight, ttl_dns_cache=300)
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    with futures.ThreadPoolExecutor(max_workers=nproc) as executor:
+        # trust_env: 与requests一致，使用HTTP_PROXY等环境变量中的代理
+        async with aiohttp.ClientSession(connector=connector, timeout=client_timeout, trust_env=True) as session:
+            await asyncio.gather(*[
+                _worker(session, tasks, sink, pbar, executor, failed, max_failures, policy, in_flight)
+                for _ in range(inflight)
+            ])
+    return failed
+
+
+def download_tiles_async(tasks, sink, pbar, nproc=8, inflight=max_inflight, max_failures=float('inf'),
+                         policy=None):
+    """
+    在单个线程的事件循环中下载瓦片，最多保持inflight个请求在途
+    :param tasks: 可迭代的(url, headers, x, y, key)，key为(source, zoom, tileX, tileY)
+    :param sink: 瓦片写入目标，见utils.download中的*Sink
+    :param nproc: 解码写入线程数
+    :param max_failures: 失败数达到该值后停止派发新请求
+    :param policy: utils.policy.AdaptivePolicy，指定时按主机自适应控制并发与超时，每个瓦片只请求一次
+    :return: 失败的任务列表
+    """
+    return asyncio.run(_download_all(tasks, sink, pbar, nproc, inflight, max_failures, policy))
@@ -0,0 +1,127 @@
+import threading
+import numpy as np
+
+
+class BatchPlan(object):
+    """
+    批量下载多个位置时的瓦片去重计划：事先求出所有位置瓦片范围的并集，统计可以省下的请求数；
+    按位置顺序下载时，后面位置还要用到的瓦片把原始字节保留在内存中，后面的位置直接取用不再请求，
+    最后一个用到该瓦片的位置完成后即释放，内存中只保留位置之间重叠的部分
+    :param windows: 按下载顺序排列的每个位置的(tileX_tl, tileY_tl, nX, nY)
+    """
+
+    def __init__(self, datasource, zoom, windows):
+        self.datasource = datasource
+        self.zoom = zoom
+        self.windows = [tuple(int(v) for v in window) for window in windows]
+        self.lock = threading.Lock()
+        self.store = {}
+        self.hits = 0
+
+        # 瓦片编码为tileX * 2^zoom + tileY，求出每个瓦片最后一个用到它的位置
+        codes = [self._codes(i) for i in range(len(self.windows))]
+        sizes = [c.size for c in codes]
+        all_codes = np.concatenate([c.ravel() for c in codes]) if codes else np.zeros(0, np.int64)
+        all_jobs = np.repeat(np.arange(len(sizes)), sizes)
+        unique, inverse = np.unique(all_codes, return_inverse=True)
+        last_job = np.full(unique.size, -1, dtype=np.int64)
+        np.maximum.at(last_job, inverse, all_jobs)
+        keep = last_job[inverse] > all_jobs
+        # keep[i][x, y]：第i个位置的瓦片(x, y)之后还会被用到，需要保留
+        self.keep = [k.reshape(c.shape) for k, c in zip(np.split(keep, np.cumsum(sizes)[:-1]), codes)]
+        self.requested = int(all_codes.size)
+        self.unique = int(unique.size)
+
+    def _codes(self, index):
+        tileX_tl, tileY_tl, nX, nY = self.windows[index]
+        tileX = np.arange(tileX_tl, tileX_tl + nX, dtype=np.int64)[:, None]
+        tileY = np.arange(tileY_tl, tileY_tl + nY, dtype=np.int64)[None, :]
+        return (tileX << self.zoom) + tileY
+
+    def summary(self):
+        saved = self.requested - self.unique
+        return {'locations': len(self.windows), 'requested': self.requested, 'unique': self.unique,
+                'saved': saved, 'saved_ratio': saved / self.requested if self.requested else 0.0,
+                'reused': self.hits}
+
+    def report(self):
+        s = self.summary()
+        print(f"批量去重：{s['locations']}个位置共{s['requested']}个瓦片，去重后{s['unique']}个，"
+              f"可省{s['saved']}次请求({s['saved_ratio']:.1%})")
+
+    def job(self, index):
+        return PlannedJob(self, index)
+
+    # store和hits由下载线程共用，统一用self.lock保护
+    def _get(self, code):
+        with self.lock:
+            return self.store.get(code)
+
+    def _put(self, code, input_image_data):
+        with self.lock:
+            self.store[code] = input_image_data
+
+    def _hit(self):
+        with self.lock:
+            self.hits += 1
+
+    def _release(self, index):
+        # 该位置是最后一个用户的瓦片不再需要
+        codes = self._codes(index)[~self.keep[index]]
+        with self.lock:
+            for code in codes.tolist():
+                self.store.pop(code, None)
+
+
+class PlannedJob(object):
+    """
+    BatchPlan中的一个位置，传给download_grid的batch参数
+    """
+
+    def __init__(self, plan, index):
+        self.plan = plan
+        self.index = index
+        self.tileX_tl, self.tileY_tl, self.nX, self.nY = plan.windows[index]
+
+    def check(self, datasource, tileX_tl, tileY_tl, nX, nY, zoom):
+        if (datasource, zoom) != (self.plan.datasource, self.plan.zoom) or \
+                (tileX_tl, tileY_tl, nX, nY) != (self.tileX_tl, self.tileY_tl, self.nX, self.nY):
+            raise ValueError("batch job {} does not match the download range".format(self.index))
+
+    def wrap(self, sink):
+        return PlannedSink(sink, self)
+
+    def release(self):
+        self.plan._release(self.index)
+
+
+class PlannedSink(object):
+    """
+    exists时先在计划的共享瓦片中查找，找到则直接写入sink；write成功后保留后续位置还要用到的瓦片
+    """
+
+    def __init__(self, sink, job):
+        self.sink = sink
+        self.job = job
+        self.keep = job.plan.keep[job.index]
+
+    def _code(self, x, y):
+        return ((self.job.tileX_tl + x) << self.job.plan.zoom) + self.job.tileY_tl + y
+
+    def exists(self, x, y):
+        if self.sink.exists(x, y):
+            return True
+        input_image_data = self.job.plan._get(self._code(x, y))
+        if input_image_data is not None and self.sink.write(input_image_data, x, y) == 0:
+            self.job.plan._hit()
+            return True
+        return False
+
+    def write(self, input_image_data, x, y):
+        status = self.sink.write(input_image_data, x, y)
+        if status == 0 and self.keep[x, y]:
+            self.job.plan._put(self._code(x, y), input_image_data)
+        return status
+
+    def close(self):
+        self.sink.close()
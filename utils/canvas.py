@@ -0,0 +1,70 @@
+import os
+import tempfile
+import weakref
+import numpy as np
+from multiprocessing import shared_memory
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class SharedCanvas(np.ndarray):
+    """
+    由multiprocessing.shared_memory承载的画布，其他进程可按shm.name挂载后直接写入。
+    共享内存的生命周期跟随画布(及其切片视图)，最后一个引用释放时关闭
+    """
+
+    def __array_finalize__(self, obj):
+        self.shm = getattr(obj, 'shm', None)
+
+
+def new_shared_canvas(shape):
+    shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+    canvas = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf).view(SharedCanvas)
+    canvas.shm = shm
+    canvas[:] = 0
+    return canvas
+
+
+def new_canvas(nX, nY, memmap_dir=None, out=None, shared=False, memmap_path=None):
+    """
+    创建nY*256 x nX*256 x 3的画布
+    :param memmap_dir: 指定时画布由该目录下的临时文件np.memmap承载，大小受磁盘而不是内存限制
+    :param out: 调用方提供的缓冲区(ndarray或np.memmap)，形状须为(nY*256, nX*256, 3)、类型uint8
+    :param shared: 为True时画布放在共享内存中(SharedCanvas)，供多进程解码直接写入
+    :param memmap_path: 指定时画布由该文件np.memmap承载且不会自动删除，文件已存在时沿用其中的内容，用于断点续传
+    :return: 与ndarray兼容的画布，可直接用于cv2.imencode等
+    """
+    shape = (nY * 256, nX * 256, 3)
+    if shared:
+        if out is not None or memmap_dir is not None or memmap_path is not None:
+            raise ValueError("shared canvas can not be combined with out, memmap_dir or memmap_path")
+        return new_shared_canvas(shape)
+    if memmap_path is not None:
+        if out is not None:
+            raise ValueError("memmap_path can not be combined with out")
+        mode = 'r+' if os.path.exists(memmap_path) else 'w+'
+        return np.memmap(memmap_path, dtype=np.uint8, mode=mode, shape=shape)
+    if out is not None:
+        if tuple(out.shape) != shape or out.dtype != np.uint8:
+            raise ValueError("canvas buffer must be uint8 with shape {}, got {} {}".format(shape, out.dtype,
+                                                                                      out.shape))
+        return out
+    if memmap_dir is None:
+        return np.zeros(shape, dtype=np.uint8)
+
+    os.makedirs(memmap_dir, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix='.canvas', dir=memmap_dir)
+    os.close(fd)
+    # w+模式新建的文件内容为0，不需要再清零
+    canvas = np.memmap(path, dtype=np.uint8, mode='w+', shape=shape)
+    if os.name == 'posix':
+        # 映射建立后即可删除文件，进程退出时空间自动回收
+        _remove_file(path)
+    else:
+        weakref.finalize(canvas, _remove_file, path)
+    return canvas
@@ -0,0 +1,183 @@
+import cv2
+import numpy as np
+from tqdm import tqdm
+from osgeo import gdal, osr
+from utils.merge import readTileBlock, gdal_config, create_mask_band
+from utils.tile_store import open_tile_source
+from utils.metrics import timed
+
+supported_cog_compress = ['JPEG', 'WEBP', 'ZSTD']
+supported_cog_blocksize = [256, 512]
+# 每次组装chunk*chunk个瓦片，块内可直接生成缩小到1/chunk为止的各级金字塔
+chunk = 16
+
+
+def _overview_factors(width, height, blocksize):
+    # 与gdaladdo/COG驱动一致，缩小到一个块能装下为止
+    factors = []
+    factor = 2
+    while (width + factor // 2 - 1) // (factor // 2) > blocksize or \
+            (height + factor // 2 - 1) // (factor // 2) > blocksize:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def _write_rgb(dataset, x, y, img):
+    dataset.WriteRaster(x, y, img.shape[1], img.shape[0], img.tobytes(), band_list=[1, 2, 3],
+                        buf_pixel_space=3, buf_line_space=img.shape[1] * 3, buf_band_space=1)
+
+
+def _write_overview(dataset, level, x, y, img):
+    # GTiff的内部概览本身是一个数据集，三个波段一次写入，像素交错的块只编码一次
+    overview = dataset.GetRasterBand(1).GetOverview(level).GetDataset()
+    w = min(img.shape[1], overview.RasterXSize - x)
+    h = min(img.shape[0], overview.RasterYSize - y)
+    if w > 0 and h > 0:
+        _write_rgb(overview, x, y, np.ascontiguousarray(img[:h, :w]))
+
+
+def _half(img):
+    h, w = img.shape[:2]
+    return cv2.resize(img, ((w + 1) // 2, (h + 1) // 2), interpolation=cv2.INTER_AREA)
+
+
+def _mask_block(placeholder_mask, start_x, end_x, start_y, end_y):
+    # 块内的全分辨率掩膜，占位瓦片处为0
+    valid = np.where(placeholder_mask[start_x:end_x, start_y:end_y].T, 0, 255).astype(np.uint8)
+    return valid.repeat(256, axis=0).repeat(256, axis=1)
+
+
+def _half_mask(mask):
+    # 缩小后只要覆盖到有效像素即为有效
+    return np.where(_half(mask) > 0, 255, 0).astype(np.uint8)
+
+
+def _write_mask(mask_band, level, x, y, mask):
+    band = mask_band if level is None else mask_band.GetOverview(level)
+    w = min(mask.shape[1], band.XSize - x)
+    h = min(mask.shape[0], band.YSize - y)
+    if w > 0 and h > 0:
+        band.WriteRaster(x, y, w, h, np.ascontiguousarray(mask[:h, :w]).tobytes())
+
+
+def _tiff_options(compress, blocksize, quality):
+    # 中间文件与输出文件使用同样的压缩、分块和质量参数
+    options = ['TILED=YES', f'BLOCKXSIZE={blocksize}', f'BLOCKYSIZE={blocksize}', 'INTERLEAVE=PIXEL',
+               f'COMPRESS={compress}', 'BIGTIFF=IF_SAFER']
+    if compress == 'JPEG':
+        options += ['PHOTOMETRIC=YCBCR', f'JPEG_QUALITY={quality}']
+    elif compress == 'WEBP':
+        options.append(f'WEBP_LEVEL={quality}')
+    return options
+
+
+def _overview_config(compress, blocksize, quality):
+    config = {'GDAL_TIFF_OVR_BLOCKSIZE': str(blocksize), 'COMPRESS_OVERVIEW': compress,
+              'INTERLEAVE_OVERVIEW': 'PIXEL'}
+    if compress == 'JPEG':
+        config.update({'PHOTOMETRIC_OVERVIEW': 'YCBCR', 'JPEG_QUALITY_OVERVIEW': str(quality)})
+    elif compress == 'WEBP':
+        config['WEBP_LEVEL_OVERVIEW'] = str(quality)
+    return config
+
+
+@timed('merge_cog')
+def mergeTiles2COG(tmpdir, tiff_filename, nX, nY, gt, epsg=3857, compress='JPEG', blocksize=512, quality=90,
+                   placeholder_mask=None):
+    """
+    由暂存的瓦片生成Cloud Optimized GeoTIFF
+    - 按chunk*chunk个瓦片组装，写入全分辨率图像的同时逐级缩小写入金字塔，不需要再整体读一遍做gdaladdo；
+      块内放不下整块的金字塔级别由内存中的缩略图生成(缩略图为原图的1/64(blocksize=512)或1/256)
+    - 中间文件与输出的压缩、分块、质量参数相同，每个块只在组装时编码一次；
+      最后用GTiff驱动的COPY_SRC_OVERVIEWS=YES复制为"金字塔在前、块按行排列"的布局，适合HTTP按字节范围读取
+    - 复制时仍要把中间文件顺序读一遍、写一遍，磁盘上临时需要约两倍输出文件大小的空间；
+      GDAL能直接复制压缩块时不重新编码，否则JPEG/WEBP会以同样的质量再编码一次
+    :param tmpdir: 瓦片临时目录、TmpdirSink或MBTilesStore
+    :param compress: "JPEG" "WEBP" "ZSTD"
+    :param blocksize: 内部分块大小，256或512
+    :param quality: JPEG/WEBP的压缩质量
+    :param placeholder_mask: (nX, nY)的bool数组，指定时创建内部掩膜(含各级金字塔)，占位瓦片处为nodata
+    """
+    if compress not in supported_cog_compress:
+        raise ValueError("unknow cog compress, {}".format(compress))
+    if blocksize not in supported_cog_blocksize:
+        raise ValueError("unsupported cog blocksize, {}".format(blocksize))
+    tmpdir = open_tile_source(tmpdir)
+    width = nX * 256
+    height = nY * 256
+    factors = _overview_factors(width, height, blocksize)
+    print('start merge tiles to cog')
+    print(f"width={width},height={height},overviews={factors}")
+
+    tmp_filename = tiff_filename + '.tmp.tif'
+    options = _tiff_options(compress, blocksize, quality)
+    driver = gdal.GetDriverByName('GTiff')
+    dataset = driver.Create(tmp_filename, width, height, 3, gdal.GDT_Byte, options)
+    dataset.SetGeoTransform(gt)
+    proj = osr.SpatialReference()
+    proj.ImportFromEPSG(epsg)
+    dataset.SetProjection(proj.ExportToWkt())
+    mask_band = None
+    if placeholder_mask is not None:
+        # 掩膜须在建立金字塔之前创建，才会同时建立掩膜的金字塔
+        mask_band = create_mask_band(dataset)
+    if factors:
+        # 只建立空的金字塔，内容在组装时写入
+        with gdal_config(GDAL_TIFF_INTERNAL_MASK='YES', **_overview_config(compress, blocksize, quality)):
+            dataset.BuildOverviews('NONE', factors)
+
+    # 块内能生成的级别，每级在块内的范围须为整块，有损压缩的块不会被写两次；剩余级别由thumbnail生成
+    levels_in_chunk = min(len(factors), int(np.log2(chunk)), int(np.log2(chunk * 256 // blocksize)))
+    thumbnail = None
+    thumbnail_mask = None
+    if len(factors) > levels_in_chunk:
+        f = 2 ** levels_in_chunk
+        thumbnail = np.zeros(((height + f - 1) // f, (width + f - 1) // f, 3), dtype=np.uint8)
+        if mask_band is not None:
+            thumbnail_mask = np.zeros(thumbnail.shape[:2], dtype=np.uint8)
+
+    num_steps_x = (nX + chunk - 1) // chunk
+    num_steps_y = (nY + chunk - 1) // chunk
+    with tqdm(total=num_steps_x * num_steps_y) as pbar:
+        for step_y in range(num_steps_y):
+            for step_x in range(num_steps_x):
+                start_x = step_x * chunk
+                start_y = step_y * chunk
+                end_x = min(start_x + chunk, nX)
+                end_y = min(start_y + chunk, nY)
+                img = cv2.cvtColor(readTileBlock(tmpdir, start_x, end_x, start_y, end_y), cv2.COLOR_BGR2RGB)
+                _write_rgb(dataset, start_x * 256, start_y * 256, img)
+                mask = None
+                if mask_band is not None:
+                    mask = _mask_block(placeholder_mask, start_x, end_x, start_y, end_y)
+                    _write_mask(mask_band, None, start_x * 256, start_y * 256, mask)
+                for level in range(levels_in_chunk):
+                    img = _half(img)
+                    f = 2 ** (level + 1)
+                    _write_overview(dataset, level, start_x * 256 // f, start_y * 256 // f, img)
+                    if mask is not None:
+                        mask = _half_mask(mask)
+                        _write_mask(mask_band, level, start_x * 256 // f, start_y * 256 // f, mask)
+                if thumbnail is not None:
+                    f = 2 ** levels_in_chunk
+                    y0, x0 = start_y * 256 // f, start_x * 256 // f
+                    thumbnail[y0:y0 + img.shape[0], x0:x0 + img.shape[1]] = img[:thumbnail.shape[0] - y0,
+                                                                               :thumbnail.shape[1] - x0]
+                    if mask is not None:
+                        thumbnail_mask[y0:y0 + mask.shape[0], x0:x0 + mask.shape[1]] = \
+                            mask[:thumbnail.shape[0] - y0, :thumbnail.shape[1] - x0]
+                pbar.update(1)
+    for level in range(levels_in_chunk, len(factors)):
+        thumbnail = _half(thumbnail)
+        _write_overview(dataset, level, 0, 0, thumbnail)
+        if thumbnail_mask is not None:
+            thumbnail_mask = _half_mask(thumbnail_mask)
+            _write_mask(mask_band, level, 0, 0, thumbnail_mask)
+    dataset.FlushCache()
+
+    # 压缩和分块参数与中间文件一致，按COG布局复制
+    driver.CreateCopy(tiff_filename, dataset, options=options + ['COPY_SRC_OVERVIEWS=YES'])
+    dataset = None
+    driver.Delete(tmp_filename)
+    print("保存完成：" + tiff_filename)
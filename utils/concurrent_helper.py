@@ -1,11 +1,181 @@
+import heapq
+import random
+import cProfile
+import pstats
 import logging
 import time
+import threading
+import contextvars
 import traceback
 import queue as Q
 from collections import OrderedDict
+from functools import partial
+from contextlib import contextmanager
 from multiprocessing import Process, Queue
 from concurrent import futures
 
+# 见utils.metrics._active_metrics，按线程/协程的上下文隔离
+_active_observer = contextvars.ContextVar('observer', default=None)
+# 同一进程内同时只剖析一个任务，其余抽中的任务照常运行
+_profile_lock = threading.Lock()
+
+
+class TaskObserver(object):
+    """
+    run_with_concurrent/run_with_message_queue的任务回调，默认什么都不做，按需重写。
+    thread/single方式下回调在执行任务的线程中调用，须线程安全；
+    process/independent-process方式下在主进程中调用，on_start在提交任务时调用，on_failure的seconds为None
+    :param profile_rate: 用cProfile剖析的任务比例，剖析结果交给on_profile
+    """
+    profile_rate = 0.0
+
+    def on_start(self, name, idx, args):
+        pass
+
+    def on_end(self, name, idx, args, seconds):
+        pass
+
+    def on_failure(self, name, idx, args, seconds, error):
+        pass
+
+    def on_profile(self, name, stats):
+        """
+        :param stats: cProfile.Profile.create_stats()之后的stats字典，可以跨进程传递
+        """
+        pass
+
+
+class _RawStats(object):
+    # 让pstats.Stats可以直接加载stats字典
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def _describe(args, limit=120):
+    # 只保留字符串和数字参数(url、路径、瓦片坐标)，sink、数据集等对象省略
+    text = ", ".join(repr(a) for a in args if isinstance(a, (str, int, float)))
+    return text[:limit]
+
+
+class _FuncStats(object):
+    def __init__(self, slowest):
+        self.count = 0
+        self.failures = 0
+        self.total = 0.0
+        self.durations = []
+        self.slowest = []
+        self.keep = slowest
+
+    def add(self, seconds, idx, args):
+        self.count += 1
+        self.total += seconds
+        self.durations.append(seconds)
+        item = (seconds, idx, _describe(args))
+        if len(self.slowest) < self.keep:
+            heapq.heappush(self.slowest, item)
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, item)
+
+    def percentile(self, q):
+        if not self.durations:
+            return None
+        ordered = sorted(self.durations)
+        return ordered[int(q * (len(ordered) - 1))]
+
+
+class TaskStats(TaskObserver):
+    """
+    按任务函数汇总耗时：次数、失败数、总耗时、分位数和最慢的若干个任务，可选按比例用cProfile剖析
+    :param slowest: 每个函数保留的最慢任务数
+    :param profile_rate: 剖析的任务比例，如0.05；为0时不剖析
+    """
+
+    def __init__(self, slowest=5, profile_rate=0.0):
+        self.slowest = slowest
+        self.profile_rate = profile_rate
+        self.funcs = OrderedDict()
+        self.profile = None
+        self.profiled = 0
+        self.lock = threading.Lock()
+
+    def _func(self, name):
+        if name not in self.funcs:
+            self.funcs[name] = _FuncStats(self.slowest)
+        return self.funcs[name]
+
+    def on_end(self, name, idx, args, seconds):
+        with self.lock:
+            self._func(name).add(seconds, idx, args)
+
+    def on_failure(self, name, idx, args, seconds, error):
+        with self.lock:
+            func = self._func(name)
+            func.failures += 1
+            if seconds is not None:
+                func.add(seconds, idx, args)
+
+    def on_profile(self, name, stats):
+        with self.lock:
+            if self.profile is None:
+                self.profile = pstats.Stats(_RawStats(stats))
+            else:
+                self.profile.add(_RawStats(stats))
+            self.profiled += 1
+
+    def summary(self):
+        with self.lock:
+            return {name: {'count': f.count, 'failures': f.failures, 'total': f.total,
+                           'mean': f.total / f.count if f.count else None,
+                           'p50': f.percentile(0.5), 'p90': f.percentile(0.9), 'p99': f.percentile(0.99),
+                           'slowest': [{'seconds': s, 'idx': i, 'args': a} for s, i, a in sorted(f.slowest, reverse=True)]}
+                    for name, f in self.funcs.items()}
+
+    def report(self, slowest=3):
+        for name, f in self.summary().items():
+            if f['count'] == 0:
+                print(f"{name}: {f['failures']} failures")
+                continue
+            print(f"{name}: {f['count']} tasks, {f['failures']} failures, total {f['total']:.2f}s, "
+                  f"mean {f['mean'] * 1000:.1f}ms, p50 {f['p50'] * 1000:.1f}ms, p90 {f['p90'] * 1000:.1f}ms, "
+                  f"p99 {f['p99'] * 1000:.1f}ms")
+            for task in f['slowest'][:slowest]:
+                print(f"    {task['seconds']:.3f}s  #{task['idx']}  {task['args']}")
+
+    def print_profile(self, sort='cumulative', limit=20):
+        if self.profile is None:
+            print("no task profiled")
+            return
+        print(f"cProfile of {self.profiled} sampled tasks:")
+        self.profile.sort_stats(sort).print_stats(limit)
+
+    def dump_profile(self, path):
+        """
+        保存为pstats文件，可用snakeviz等工具查看
+        """
+        if self.profile is not None:
+            self.profile.dump_stats(path)
+
+
+def get_observer():
+    return _active_observer.get()
+
+
+@contextmanager
+def observer_scope(observer):
+    """
+    在作用域内未指定observer的run_with_concurrent/run_with_message_queue都使用该observer，
+    瓦片下载(download_tile)、mergeJPG2TIF_thread等调用方无需修改即可统计
+    :param observer: TaskObserver，为None时不启用
+    """
+    token = _active_observer.set(observer)
+    try:
+        yield observer
+    finally:
+        _active_observer.reset(token)
+
 
 def _run_func_and_time_it(func, *args):
     s = time.time()
@@ -21,6 +191,41 @@ def _run_func_and_time_it(func, *args):
     return e - s, rtv
 
 
+def _run_observed(func, idx, observer, profile, *args):
+    """
+    与_run_func_and_time_it相同，另外在执行线程中调用observer(thread/single方式)，
+    profile为True时用cProfile运行，返回(耗时, 返回值, stats字典或None)
+    """
+    if observer is not None:
+        observer.on_start(func.__name__, idx, args)
+    profiler = None
+    if profile and _profile_lock.acquire(blocking=False):
+        profiler = cProfile.Profile()
+    s = time.time()
+    try:
+        if profiler is not None:
+            rtv = profiler.runcall(func, *args)
+        else:
+            rtv = func(*args)
+    except Exception as e:
+        traceback.print_exc()
+        logging.error(str(traceback.format_exc()))
+        if observer is not None:
+            observer.on_failure(func.__name__, idx, args, time.time() - s, e)
+        raise
+    finally:
+        if profiler is not None:
+            _profile_lock.release()
+    used_time = time.time() - s
+    if observer is not None:
+        observer.on_end(func.__name__, idx, args, used_time)
+    stats = None
+    if profiler is not None:
+        profiler.create_stats()
+        stats = profiler.stats
+    return used_time, rtv, stats
+
+
 def independent_process_wrap(func, idx, queue_rtv, *args):
     try:
         rtv = func(*args)
@@ -78,7 +283,7 @@ def check_independent_future_as_completed(todo, executor):
 
     while True:
         if executor.finished_num >= len(executor.all_tasks):
-            raise StopIteration()
+            return
 
         idx, rtv = executor.queue_rtv.get()
         finished_future = executor.all_tasks[idx]
@@ -130,6 +335,11 @@ def _check_as_compeleted(todo, concurrent_type, executor):
             yield rtv
 
 
+def _submit_in_context(executor, fn, *args):
+    # 线程池不传递contextvars，每个任务复制一份提交时的上下文，工作线程中get_cache/get_metrics等与调用方一致
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+
 def run_with_concurrent(
         func,
         args_list,
@@ -137,9 +347,16 @@ def run_with_concurrent(
         concurrent_num=1,
         show_process="",  # ["", "tqdm", "print"]
         raise_exception=True,
+        observer=None,
 ):
+    """
+    :param observer: TaskObserver，每个任务开始、结束和失败时回调，为None时使用observer_scope中的observer，
+        为False时不回调
+    """
     if not args_list:
         return []
+    if observer is None:
+        observer = _active_observer.get()
 
     if concurrent_type == "thread":
         concurrent_executor = futures.ThreadPoolExecutor
@@ -155,25 +372,43 @@ def run_with_concurrent(
     start_time = time.time()
     rtv = [None] * len(args_list)
 
+    # thread/single方式在执行任务的线程中回调，进程方式在主进程中回调
+    in_worker = concurrent_type in ("thread", "single")
     with concurrent_executor(max_workers=concurrent_num) as executor:
+        submit = executor.submit
+        if concurrent_type == "thread":
+            submit = partial(_submit_in_context, executor)
         to_do = OrderedDict()
         for idx, args in enumerate(args_list):
             if type(args) not in (tuple, list):
                 args = (args,)
-            to_do[executor.submit(_run_func_and_time_it, func, *args)] = idx
+            if not observer:
+                to_do[submit(_run_func_and_time_it, func, *args)] = idx
+                continue
+            profile = observer.profile_rate > 0 and random.random() < observer.profile_rate
+            if not in_worker:
+                observer.on_start(func.__name__, idx, args)
+            to_do[submit(_run_observed, func, idx, observer if in_worker else None, profile, *args)] = idx
 
         for fns_idx, future in enumerate(
                 _check_as_compeleted(to_do, concurrent_type, executor), 1
         ):
             used_time = -1
+            idx = to_do[future]
 
             try:
-                used_time, real_rtv = future.result()
-                rtv[to_do[future]] = real_rtv
+                result = future.result()
+                used_time, real_rtv = result[0], result[1]
+                rtv[idx] = real_rtv
             except Exception as e:
-                rtv[to_do[future]] = e
+                rtv[idx] = e
+                if observer and not in_worker:
+                    observer.on_failure(func.__name__, idx, _as_args(args_list[idx]), None, e)
                 if raise_exception:
                     raise
+            else:
+                if observer:
+                    _observe_result(observer, func.__name__, idx, _as_args(args_list[idx]), result, in_worker)
 
             if show_process == "print":
                 print(
@@ -202,12 +437,34 @@ def run_with_concurrent(
     return rtv
 
 
-def _run_with_mq_wrap(init_func, init_args, func, task_q):
+def _as_args(args):
+    return args if type(args) in (tuple, list) else (args,)
+
+
+def _observe_result(observer, name, idx, args, result, in_worker):
+    # 进程方式的结束回调和所有方式的剖析结果在主进程中处理
+    if len(result) < 3:
+        # independent-process方式中任务异常时返回(-1, 异常)
+        if isinstance(result[1], Exception):
+            observer.on_failure(name, idx, args, None, result[1])
+        return
+    used_time, _, stats = result
+    if not in_worker:
+        observer.on_end(name, idx, args, used_time)
+    if stats is not None:
+        observer.on_profile(name, stats)
+
+
+def _run_with_mq_wrap(init_func, init_args, func, task_q, observer=None):
+    """
+    :param observer: thread/single方式时直接回调；进程方式时为None，各任务的耗时随返回值交给主进程
+    """
     if type(init_args) not in (tuple, list):
         init_args = (init_args,)
 
     init_func(*init_args)
     rtv_dict = {}
+    timings = []
 
     while True:
         if task_q.qsize() == 0:
@@ -218,14 +475,24 @@ def _run_with_mq_wrap(init_func, init_args, func, task_q):
         except Q.Empty as _:
             break
 
+        if observer is not None:
+            observer.on_start(func.__name__, idx, args)
+        s = time.time()
         try:
             rtv = func(*args)
             rtv_dict[idx] = rtv
         except Exception as e:
             logging.error(str(traceback.format_exc()))
             rtv_dict[idx] = e
+        used_time = time.time() - s
+        if observer is None:
+            timings.append((idx, used_time))
+        elif isinstance(rtv_dict[idx], Exception):
+            observer.on_failure(func.__name__, idx, args, used_time, rtv_dict[idx])
+        else:
+            observer.on_end(func.__name__, idx, args, used_time)
 
-    return rtv_dict
+    return rtv_dict, timings
 
 
 def run_with_message_queue(
@@ -236,9 +503,17 @@ def run_with_message_queue(
         concurrent_type="independent-process",  # support "single","thread","independent-process"
         show_process="",  # support ["", "tqdm", "print"]
         raise_exception=True,
+        observer=None,
 ):
+    """
+    :param observer: TaskObserver，回调的是func的每个任务而不是各worker，参数见run_with_concurrent；
+        不支持cProfile剖析
+    """
     if concurrent_type not in ("single", "thread", "independent-process"):
         raise ValueError("not support concurrent type in run_with_mq")
+    if observer is None:
+        observer = _active_observer.get()
+    in_worker = concurrent_type in ("single", "thread")
 
     task_q = Queue()
     for idx, args in enumerate(args_list):
@@ -247,16 +522,37 @@ def run_with_message_queue(
     concurrent_num = len(init_args_list)
     rtvs = run_with_concurrent(
         _run_with_mq_wrap,
-        [(init_func, init_args_list[i], func, task_q) for i in range(concurrent_num)],
+        [(init_func, init_args_list[i], func, task_q, observer if observer and in_worker else None)
+         for i in range(concurrent_num)],
         concurrent_type,
         concurrent_num,
         show_process,
         raise_exception,
+        observer=False,
     )
 
     total_rtvs = [None] * len(args_list)
-    for d in rtvs:
+    for rtv in rtvs:
+        # worker本身失败(如init_func异常)：raise_exception=False时run_with_concurrent返回异常对象，
+        # independent-process方式返回(-1, 异常)
+        error = rtv if isinstance(rtv, Exception) else None
+        if isinstance(rtv, tuple) and isinstance(rtv[-1], Exception):
+            error = rtv[-1]
+        if error is not None:
+            if raise_exception:
+                raise error
+            # 该worker取走的任务没有返回值，保持为None
+            continue
+        d, timings = rtv
         for k, v in d.items():
             total_rtvs[k] = v
+        if observer and not in_worker:
+            for idx, used_time in timings:
+                args = args_list[idx]
+                observer.on_start(func.__name__, idx, args)
+                if isinstance(total_rtvs[idx], Exception):
+                    observer.on_failure(func.__name__, idx, args, used_time, total_rtvs[idx])
+                else:
+                    observer.on_end(func.__name__, idx, args, used_time)
 
     return total_rtvs
@@ -0,0 +1,78 @@
+import threading
+from concurrent import futures
+from multiprocessing import shared_memory
+import numpy as np
+from utils.download import decode_tile, CanvasSink
+from utils.metrics import record_queue
+
+# 解码进程中挂载的共享画布
+_shm = None
+_canvas = None
+
+
+def _attach_canvas(shm_name, shape):
+    global _shm, _canvas
+    _shm = shared_memory.SharedMemory(name=shm_name)
+    _canvas = np.ndarray(shape, dtype=np.uint8, buffer=_shm.buf)
+
+
+def _decode_into(input_image_data, x, y):
+    try:
+        tile = decode_tile(input_image_data)
+        _canvas[y * 256:(y + 1) * 256, x * 256:(x + 1) * 256, :] = tile
+    except Exception as e:
+        print(str(e))
+        return -1
+    return 0
+
+
+class ProcessDecodeSink(object):
+    """
+    下载线程只负责取回字节，解码交给进程池，解码进程直接写入共享内存画布(utils.canvas.SharedCanvas)，
+    解码吞吐随CPU核数增长而不受GIL限制
+    """
+
+    def __init__(self, canvas, nproc=4):
+        self.canvas = canvas
+        self.executor = futures.ProcessPoolExecutor(max_workers=nproc, initializer=_attach_canvas,
+                                                    initargs=(canvas.shm.name, canvas.shape))
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def exists(self, x, y):
+        return False
+
+    def write(self, input_image_data, x, y):
+        # 调用方是下载线程，等待结果时不占用GIL
+        with self.lock:
+            self.pending += 1
+            record_queue('decode_pool', self.pending)
+        try:
+            return self.executor.submit(_decode_into, bytes(input_image_data), x, y).result()
+        except Exception as e:
+            print(str(e))
+            return -1
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+    def close(self):
+        self.executor.shutdown()
+        # 解码进程都已退出，释放共享内存的名字，内存随画布最后一个引用释放
+        self.canvas.shm.unlink()
+
+
+def open_canvas_sink(canvas, decode_workers=0):
+    """
+    decode_workers>0时返回多进程解码的ProcessDecodeSink(画布须由new_canvas(shared=True)创建)，
+    否则在下载线程中解码
+    """
+    if decode_workers > 0:
+        return ProcessDecodeSink(canvas, decode_workers)
+    return CanvasSink(canvas)
@@ -1,86 +1,298 @@
-import requests
 import cv2
 import numpy as np
 import os
+import time
+import shutil
+import struct
+from utils.session import get_session
+from utils.tile_cache import get_cache
+from utils.hedge import get_hedge
+from utils.metrics import record_request, record_retry, record_time, record_tile
 
 retry_limit = 3
 timeout = 2
 
 
-def download(url, headers, x, y, canvas, pbar):
-    pbar.update(1)
-    response = None
-    retry = 0
-    while response is None or response.status_code != 200:
-        if retry == retry_limit:
-            print("Failed to get {} with retry={}.".format(url, retry))
-            return -1
+def fetch_once(url, headers, policy):
+    """
+    按policy的并发与超时控制请求一次，失败时直接返回None，由调用方推迟重试
+    """
+    controller = policy.controller(url)
+    controller.acquire()
+    try:
+        s = time.time()
         try:
-            response = requests.get(url, headers=headers, timeout=timeout)
+            response = get_session().get(url, headers=headers, timeout=controller.timeout())
         except Exception as e:
-            pass
-        retry += 1
+            controller.on_failure()
+            record_request(url, 'error', time.time() - s)
+            return None
+        latency = time.time() - s
+        record_request(url, response.status_code, latency, len(response.content))
+        if response.status_code != 200:
+            controller.on_failure(response.status_code)
+            return None
+        controller.on_success(latency)
+        return response.content
+    finally:
+        controller.release()
+
+
+def _get_once(url, headers):
+    s = time.time()
     try:
-        input_image_data = response.content
-        np_arr = np.asarray(bytearray(input_image_data), np.uint8).reshape(1, -1)
-        tile = cv2.imdecode(np_arr, cv2.IMREAD_UNCHANGED)
-        canvas[y * 256:(y + 1) * 256, x * 256:(x + 1) * 256, :] = tile
+        response = get_session().get(url, headers=headers, timeout=timeout)
     except Exception as e:
-        print(str(e))
-        return -1
-    return 0
+        record_request(url, 'error', time.time() - s)
+        return None
+    record_request(url, response.status_code, time.time() - s, len(response.content))
+    return response.content if response.status_code == 200 else None
 
 
-def download_save2tmpdir(url, headers, x, y, tmpdir, pbar):
-    pbar.update(1)
-    response = None
-    retry = 0
-    img_savepath = os.path.join(tmpdir, f"{x}_{y}.jpg")
-    if os.path.exists(img_savepath):
-        return 0
-    while response is None or response.status_code != 200:
-        if retry == retry_limit:
-            print("Failed to get {} with retry={}.".format(url, retry))
-            return -1
+def fetch(url, headers, policy=None):
+    """
+    通过共享Session请求瓦片，失败时重试，返回响应内容，重试耗尽返回None
+    :param policy: utils.policy.AdaptivePolicy，指定时只请求一次，重试由调用方推迟进行
+    在utils.hedge.hedge_scope内时每次请求都是对冲请求
+    """
+    hedge = get_hedge()
+    if policy is not None:
+        if hedge is not None:
+            return hedge.fetch(lambda u, h: fetch_once(u, h, policy), url, headers)
+        return fetch_once(url, headers, policy)
+    for retry in range(retry_limit):
+        if retry > 0:
+            record_retry(url)
+        if hedge is not None:
+            input_image_data = hedge.fetch(_get_once, url, headers)
+        else:
+            input_image_data = _get_once(url, headers)
+        if input_image_data is not None:
+            return input_image_data
+    print("Failed to get {} with retry={}.".format(url, retry_limit))
+    return None
+
+
+# 小于该字节数的响应不可能是正常瓦片
+min_tile_bytes = 100
+_jpeg_soi = b'\xff\xd8\xff'
+_jpeg_eoi = b'\xff\xd9'
+_png_signature = b'\x89PNG\r\n\x1a\n'
+# JPEG中携带宽高的SOF标记(排除DHT/JPG/DAC)
+_jpeg_sof = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def tile_size(input_image_data):
+    """
+    只解析文件头得到瓦片的(宽, 高)，不解码；无法识别的格式返回None
+    """
+    if input_image_data[:8] == _png_signature and len(input_image_data) >= 24:
+        return struct.unpack('>II', input_image_data[16:24])
+    if input_image_data[:3] == _jpeg_soi:
+        i = 2
+        while i + 9 <= len(input_image_data):
+            if input_image_data[i] != 0xFF:
+                return None
+            marker = input_image_data[i + 1]
+            if marker in _jpeg_sof:
+                h, w = struct.unpack('>HH', input_image_data[i + 5:i + 9])
+                return w, h
+            i += 2 + struct.unpack('>H', input_image_data[i + 2:i + 4])[0]
+    return None
+
+
+def jpeg_subsampling(input_image_data):
+    """
+    基线(SOF0/SOF1)三通道JPEG返回亮度分量的(水平, 垂直)采样因子，如4:2:0为(2, 2)；其他情况返回None
+    """
+    if input_image_data[:3] != _jpeg_soi:
+        return None
+    i = 2
+    while i + 4 <= len(input_image_data):
+        if input_image_data[i] != 0xFF:
+            return None
+        marker = input_image_data[i + 1]
+        if marker in _jpeg_sof:
+            if marker not in (0xC0, 0xC1) or i + 19 > len(input_image_data) or input_image_data[i + 9] != 3:
+                return None
+            # 色度分量须为1x1采样
+            if input_image_data[i + 14] != 0x11 or input_image_data[i + 17] != 0x11:
+                return None
+            sampling = input_image_data[i + 11]
+            return sampling >> 4, sampling & 0x0F
+        i += 2 + struct.unpack('>H', input_image_data[i + 2:i + 4])[0]
+    return None
+
+
+def check_tile(input_image_data):
+    """
+    不解码的快速检查：格式可识别、尺寸为256*256，且有结束标记(未被截断)
+    """
+    if len(input_image_data) < min_tile_bytes or tile_size(input_image_data) != (256, 256):
+        return False
+    if input_image_data[:3] == _jpeg_soi:
+        return _jpeg_eoi in input_image_data[-16:]
+    return b'IEND' in input_image_data[-12:]
+
+
+def decode_tile(input_image_data):
+    s = time.perf_counter()
+    np_arr = np.asarray(bytearray(input_image_data), np.uint8).reshape(1, -1)
+    tile = cv2.imdecode(np_arr, cv2.IMREAD_UNCHANGED)
+    record_time('decode', time.perf_counter() - s)
+    return tile
+
+
+# 瓦片写入目标，exists用于跳过已有瓦片，write返回0表示成功，-1表示失败
+class CanvasSink(object):
+    def __init__(self, canvas):
+        self.canvas = canvas
+
+    def exists(self, x, y):
+        return False
+
+    def close(self):
+        pass
+
+    def write(self, input_image_data, x, y):
         try:
-            response = requests.get(url, headers=headers, timeout=timeout)
+            tile = decode_tile(input_image_data)
+            self.canvas[y * 256:(y + 1) * 256, x * 256:(x + 1) * 256, :] = tile
         except Exception as e:
-            pass
-        retry += 1
-    try:
-        input_image_data = response.content
-        np_arr = np.asarray(bytearray(input_image_data), np.uint8).reshape(1, -1)
-        tile = cv2.imdecode(np_arr, cv2.IMREAD_UNCHANGED)
-        cv2.imwrite(img_savepath, tile)
-    except Exception as e:
-        print(str(e))
-        return -1
-    return 0
+            print(str(e))
+            return -1
+        return 0
 
 
-def download_tiff(url, headers, x, y, dataset, pbar):
-    pbar.update(1)
-    response = None
-    retry = 0
-    while response is None or response.status_code != 200:
-        if retry == retry_limit:
-            print("Failed to get {} with retry={}.".format(url, retry))
+class TmpdirSink(object):
+    """
+    :param passthrough: 为True时通过check_tile检查后直接保存服务器返回的字节，不解码也不重新编码，
+        只在合并时解码一次；格式无法识别时退回解码后imwrite
+    """
+
+    def __init__(self, tmpdir, passthrough=True):
+        self.tmpdir = tmpdir
+        self.path = tmpdir
+        self.passthrough = passthrough
+
+    def tile_path(self, x, y):
+        return os.path.join(self.tmpdir, f"{x}_{y}.jpg")
+
+    def exists(self, x, y):
+        return os.path.exists(self.tile_path(x, y))
+
+    def count(self):
+        return sum(1 for _ in self.tiles())
+
+    def tiles(self):
+        # 已保存瓦片的(x, y)，忽略未写完的.part文件
+        for file_name in os.listdir(self.tmpdir):
+            name, ext = os.path.splitext(file_name)
+            if ext == '.jpg':
+                x, y = name.split('_')
+                yield int(x), int(y)
+
+    def close(self):
+        pass
+
+    def remove(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, input_image_data, x, y):
+        try:
+            img_savepath = self.tile_path(x, y)
+            if not (self.passthrough and check_tile(input_image_data)):
+                ok, encoded = cv2.imencode('.jpg', decode_tile(input_image_data))
+                if not ok:
+                    raise ValueError("encode tile failed, {}".format(img_savepath))
+                input_image_data = encoded.tobytes()
+            # 先写临时文件再改名，中断时不会留下被exists误判为完成的半个文件
+            tmp_path = img_savepath + '.part'
+            with open(tmp_path, 'wb') as f:
+                f.write(input_image_data)
+            os.replace(tmp_path, img_savepath)
+        except Exception as e:
+            print(str(e))
             return -1
+        return 0
+
+
+class TiffSink(object):
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def exists(self, x, y):
+        return False
+
+    def write(self, input_image_data, x, y):
         try:
-            response = requests.get(url, headers=headers, timeout=timeout)
+            tile = decode_tile(input_image_data)
+            tile = cv2.cvtColor(tile, cv2.COLOR_BGR2RGB)
+            for band in range(3):
+                self.dataset.GetRasterBand(band + 1).WriteRaster(x * 256, y * 256, 256, 256,
+                                                                 tile[:, :, band].tobytes())
         except Exception as e:
-            pass
-        retry += 1
+            print(str(e))
+            return -1
+        return 0
+
+
+def write_tile(sink, input_image_data, x, y):
+    """
+    写入sink并记录耗时，解码在sink中进行时写入耗时包含解码
+    """
+    s = time.perf_counter()
+    status = sink.write(input_image_data, x, y)
+    record_time('write', time.perf_counter() - s)
+    return status
+
+
+def cacheable(source, input_image_data):
+    """
+    占位瓦片(包括已由父瓦片补齐的)不进入本地缓存，否则之后的运行命中缓存，不会再请求真实影像
+    """
+    # placeholder依赖本模块，在函数内导入
+    from utils.placeholder import get_placeholders
+    registry = get_placeholders()
+    return registry is None or not registry.known(source, input_image_data)
+
+
+def download_tile(url, headers, x, y, sink, pbar, policy=None, key=None):
+    """
+    :param key: (source, zoom, tileX, tileY)，启用本地缓存(utils.tile_cache.cache_scope)时用于查询缓存
+    """
     try:
-        input_image_data = response.content
-        np_arr = np.asarray(bytearray(input_image_data), np.uint8).reshape(1, -1)
-        tile = cv2.imdecode(np_arr, cv2.IMREAD_UNCHANGED)
-        # tile = tile.transpose((1,0,2))
-        # canvas[y * 256:(y + 1) * 256, x * 256:(x + 1) * 256, :] = tile
-        tile = cv2.cvtColor(tile, cv2.COLOR_BGR2RGB)
-        for band in range(3):
-            dataset.GetRasterBand(band + 1).WriteRaster(x * 256, y * 256, 256, 256, tile[:, :, band].tobytes())
-    except Exception as e:
-        print(str(e))
-        return -1
-    return 0
+        if sink.exists(x, y):
+            record_tile('skipped')
+            return 0
+        cache = get_cache() if key is not None else None
+        if cache is not None:
+            input_image_data = cache.get(*key)
+            if input_image_data is not None and cacheable(key[0], input_image_data) and write_tile(sink, input_image_data, x, y) == 0:
+                record_tile('cached')
+                return 0
+        input_image_data = fetch(url, headers, policy)
+        if input_image_data is None:
+            record_tile('failed')
+            return -1
+        status = write_tile(sink, input_image_data, x, y)
+        record_tile('done' if status == 0 else 'failed')
+        # 只缓存能正常写入(解码)的瓦片
+        if status == 0 and cache is not None and cacheable(key[0], input_image_data):
+            cache.put(*key, input_image_data)
+        return status
+    finally:
+        # 瓦片处理完成后才更新进度
+        pbar.update(1)
+
+
+def download(url, headers, x, y, canvas, pbar):
+    return download_tile(url, headers, x, y, CanvasSink(canvas), pbar)
+
+
+def download_save2tmpdir(url, headers, x, y, tmpdir, pbar):
+    return download_tile(url, headers, x, y, TmpdirSink(tmpdir), pbar)
+
+
+def download_tiff(url, headers, x, y, dataset, pbar):
+    return download_tile(url, headers, x, y, TiffSink(dataset), pbar)
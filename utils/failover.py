@@ -0,0 +1,112 @@
+import json
+import numpy as np
+from utils.url import max_zoom
+from utils.download import min_tile_bytes
+
+# 瓦片来源：数据源在sources中的序号，以及以下两个特殊值
+MISSING = 255
+# 之前的运行中已完成的瓦片，来源未知
+EXISTING = 254
+
+
+class SourceChain(object):
+    """
+    按顺序的数据源链：先从download_grid的datasource下载，失败或返回空白的瓦片依次由fallback中
+    支持该级别的下一个数据源补齐。origin记录每个瓦片实际来自哪个数据源。
+    同一个对象可以在多次下载之间复用，每次下载开始时重置origin。
+    :param fallback: 备用数据源列表，如['bing', 'arcgis']
+    """
+
+    def __init__(self, fallback):
+        self.fallback = list(fallback)
+        self.sources = None
+        self.origin = None
+
+    def start(self, datasource, zoom, nX, nY, manifest=None):
+        self.sources = [datasource]
+        for source in self.fallback:
+            if source in self.sources:
+                continue
+            if zoom > max_zoom.get(source, -1):
+                print(f"skip fallback source {source}, max_zoom={max_zoom.get(source)}")
+                continue
+            self.sources.append(source)
+        self.origin = np.full((nX, nY), MISSING, dtype=np.uint8)
+        if manifest is not None:
+            self.origin[manifest.done_mask()] = EXISTING
+
+    def wrap(self, sink, index):
+        return SourceSink(sink, self, index)
+
+    def missing(self, tile_mask=None):
+        missing = self.origin == MISSING
+        return missing if tile_mask is None else missing & tile_mask
+
+    def tile_source(self, x, y):
+        """
+        :return: 瓦片(x, y)的数据源名称，之前运行中已完成的为"existing"，没有下载到的为None
+        """
+        value = int(self.origin[x, y])
+        if value == MISSING:
+            return None
+        if value == EXISTING:
+            return 'existing'
+        return self.sources[value]
+
+    def counts(self):
+        counts = {source: int(np.count_nonzero(self.origin == i)) for i, source in enumerate(self.sources)}
+        counts['existing'] = int(np.count_nonzero(self.origin == EXISTING))
+        counts['missing'] = int(np.count_nonzero(self.origin == MISSING))
+        return counts
+
+    def report(self):
+        print("tile sources: " + ", ".join(f"{k}={v}" for k, v in self.counts().items() if v))
+
+    def save(self, path):
+        """
+        保存每个瓦片的来源，origin[y][x]为数据源在sources中的序号，254为之前运行中已完成、255为缺失
+        """
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'sources': self.sources, 'counts': self.counts(), 'origin': self.origin.T.tolist()}, f)
+
+
+class SourceSink(object):
+    """
+    记录写入成功的瓦片来自sources中的第index个数据源。
+    后面还有备用数据源时，过小的响应视为空白瓦片，按失败处理交给下一个数据源
+    """
+
+    def __init__(self, sink, chain, index):
+        self.sink = sink
+        self.chain = chain
+        self.index = index
+        self.last = index == len(chain.sources) - 1
+
+    def exists(self, x, y):
+        if self.sink.exists(x, y):
+            if self.chain.origin[x, y] == MISSING:
+                self.chain.origin[x, y] = EXISTING
+            return True
+        return False
+
+    def write(self, input_image_data, x, y):
+        if not self.last and len(input_image_data) < min_tile_bytes:
+            return -1
+        status = self.sink.write(input_image_data, x, y)
+        if status == 0:
+            self.chain.origin[x, y] = self.index
+        return status
+
+    def close(self):
+        self.sink.close()
+
+
+def as_chain(fallback):
+    """
+    get_img_*的fallback参数：备用数据源列表或SourceChain，为空时不启用
+    """
+    if not fallback:
+        return None
+    if isinstance(fallback, SourceChain):
+        return fallback
+    return SourceChain(fallback)
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import math
+import numpy as np
 
 # 设置常量
 pi = 3.141592653589793234  # π
@@ -152,6 +153,138 @@ def main(lon, lat, fromCoord, toCoord):
         return [lon, lat]
 
 
+# 以下*_array函数为上面各函数的numpy版本，lon、lat为标量或可广播的数组，返回(经度数组, 纬度数组)
+def _as_float_arrays(lon, lat):
+    return np.broadcast_arrays(np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64))
+
+
+def _sin3(s):
+    # sin(3θ) = 3sin(θ) - 4sin(θ)^3，少算一次sin
+    return s * (3.0 - 4.0 * s * s)
+
+
+def transform_array(lon, lat):
+    """
+    transformlat和transformlng的numpy版本，两者共用的正弦项只算一次，返回(tlat, tlng)
+    """
+    s2x = np.sin(2.0 * lon * pi)
+    sx3 = np.sin(lon / 3.0 * pi)
+    sy3 = np.sin(lat / 3.0 * pi)
+    common = (20.0 * _sin3(s2x) + 20.0 * s2x) * 2.0 / 3.0
+    r = -100.0 + 2.0 * lon + 3.0 * lat + 0.2 * lat * lat + 0.1 * lon * lat + 0.2 * np.sqrt(np.abs(lon))
+    r += common
+    r += (20.0 * _sin3(sy3) + 40.0 * sy3) * 2.0 / 3.0
+    r += (160.0 * np.sin(lat / 12.0 * pi) + 320 * np.sin(lat * pi / 30.0)) * 2.0 / 3.0
+    tlat = r
+    r = 300.0 + lon + 2.0 * lat + 0.1 * lon * lon + 0.1 * lon * lat + 0.1 * np.sqrt(np.abs(lon))
+    r += common
+    r += (20.0 * _sin3(sx3) + 40.0 * sx3) * 2.0 / 3.0
+    r += (150.0 * np.sin(lon / 12.0 * pi) + 300.0 * np.sin(lon / 30.0 * pi)) * 2.0 / 3.0
+    return tlat, r
+
+
+# 不在中国的点为True
+def judge_China_array(lon, lat):
+    return (lon < 70) | (lon > 140) | (lat < 0) | (lat > 55)
+
+
+# gcj02与wgs84之间的偏移量
+def _gcj02_offset_array(lon, lat):
+    tlat, tlng = transform_array(lon - 105.0, lat - 35.0)
+    rlat = lat / 180.0 * pi
+    m = np.sin(rlat)
+    m = 1 - ob * m * m
+    sm = np.sqrt(m)
+    tlat = (tlat * 180.0) / ((la * (1 - ob)) / (m * sm) * pi)
+    tlng = (tlng * 180.0) / (la / sm * np.cos(rlat) * pi)
+    return tlng, tlat
+
+
+def gcj02_bd09_array(lon_gcj02, lat_gcj02):
+    lon_gcj02, lat_gcj02 = _as_float_arrays(lon_gcj02, lat_gcj02)
+    b = np.sqrt(lon_gcj02 * lon_gcj02 + lat_gcj02 * lat_gcj02) + 0.00002 * np.sin(lat_gcj02 * r_pi)
+    o = np.arctan2(lat_gcj02, lon_gcj02) + 0.000003 * np.cos(lon_gcj02 * r_pi)
+    return b * np.cos(o) + 0.0065, b * np.sin(o) + 0.006
+
+
+def bd09_gcj02_array(lon_bd09, lat_bd09):
+    lon_bd09, lat_bd09 = _as_float_arrays(lon_bd09, lat_bd09)
+    m = lon_bd09 - 0.0065
+    n = lat_bd09 - 0.006
+    c = np.sqrt(m * m + n * n) - 0.00002 * np.sin(n * r_pi)
+    o = np.arctan2(n, m) - 0.000003 * np.cos(m * r_pi)
+    return c * np.cos(o), c * np.sin(o)
+
+
+def wgs84_gcj02_array(lon_wgs84, lat_wgs84):
+    lon_wgs84, lat_wgs84 = _as_float_arrays(lon_wgs84, lat_wgs84)
+    tlng, tlat = _gcj02_offset_array(lon_wgs84, lat_wgs84)
+    outside = judge_China_array(lon_wgs84, lat_wgs84)
+    return np.where(outside, lon_wgs84, lon_wgs84 + tlng), np.where(outside, lat_wgs84, lat_wgs84 + tlat)
+
+
+def gcj02_wgs84_array(lon_gcj02, lat_gcj02):
+    lon_gcj02, lat_gcj02 = _as_float_arrays(lon_gcj02, lat_gcj02)
+    tlng, tlat = _gcj02_offset_array(lon_gcj02, lat_gcj02)
+    outside = judge_China_array(lon_gcj02, lat_gcj02)
+    # 与标量版本的计算顺序保持一致
+    lon_wgs84 = 2 * lon_gcj02 - (lon_gcj02 + tlng)
+    lat_wgs84 = 2 * lat_gcj02 - (lat_gcj02 + tlat)
+    return np.where(outside, lon_gcj02, lon_wgs84), np.where(outside, lat_gcj02, lat_wgs84)
+
+
+def wgs84_bd09_array(lon_wgs84, lat_wgs84):
+    return gcj02_bd09_array(*wgs84_gcj02_array(lon_wgs84, lat_wgs84))
+
+
+def bd09_wgs84_array(lon_bd09, lat_bd09):
+    return gcj02_wgs84_array(*bd09_gcj02_array(lon_bd09, lat_bd09))
+
+
+_transforms_array = {
+    (0, 1): gcj02_wgs84_array,
+    (0, 2): gcj02_bd09_array,
+    (1, 0): wgs84_gcj02_array,
+    (1, 2): wgs84_bd09_array,
+    (2, 0): bd09_gcj02_array,
+    (2, 1): bd09_wgs84_array,
+}
+
+
+# main函数的numpy版本，坐标系编号相同：0->gcj02 1->wgs84 2->bd09
+def main_array(lon, lat, fromCoord, toCoord):
+    fromCoord = int(fromCoord)
+    toCoord = int(toCoord)
+    if fromCoord == toCoord:
+        return _as_float_arrays(lon, lat)
+    return _transforms_array[(fromCoord, toCoord)](lon, lat)
+
+
+def convert_dataframe(data, fromCoord, toCoord, lon_col='lng', lat_col='lat', out_lon_col=None, out_lat_col=None):
+    """
+    整列转换DataFrame中的经纬度
+    :param out_lon_col: 结果写入的列名，默认覆盖lon_col/lat_col
+    :return: 转换后的DataFrame副本
+    """
+    data = data.copy()
+    lon, lat = main_array(data[lon_col].to_numpy(), data[lat_col].to_numpy(), fromCoord, toCoord)
+    data[out_lon_col or lon_col] = lon
+    data[out_lat_col or lat_col] = lat
+    return data
+
+
+def convert_csv(csv_path, out_path, fromCoord, toCoord, lon_col='lng', lat_col='lat', encoding='utf-8'):
+    """
+    转换csv中的经纬度列并另存，例如把高德/百度坐标的位置表转为下载使用的wgs84
+    """
+    import pandas as pd
+
+    data = pd.read_csv(csv_path, encoding=encoding)
+    data = convert_dataframe(data, fromCoord, toCoord, lon_col, lat_col)
+    data.to_csv(out_path, index=False, encoding=encoding)
+    return data
+
+
 if __name__ == '__main__':
     # 高德: GCJ  谷歌: WGS
     # 原坐标
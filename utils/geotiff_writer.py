@@ -0,0 +1,133 @@
+import queue
+import threading
+import cv2
+from osgeo import gdal, osr
+from utils import tile_utils
+from utils.download import decode_tile
+from utils.tile_grid import download_grid
+from utils.merge import create_mask_band
+from utils.placeholder import get_placeholders
+from utils.metrics import record_queue
+
+# 解码后等待写入的瓦片数上限，约queue_size*192KB内存
+queue_size = 1024
+_valid_mask = b'\xff' * (256 * 256)
+_invalid_mask = b'\x00' * (256 * 256)
+
+
+class GeoTiffSink(object):
+    """
+    流式写入GeoTIFF：下载线程解码后把瓦片放入有界队列，由唯一的写线程写入，
+    GDAL数据集只在一个线程中使用。输出为256*256分块、像素交错、压缩的GeoTIFF，
+    每个瓦片正好对应一个块，一次WriteRaster写入三个波段；文件可能超过4GB时自动使用BigTIFF。
+    坐标系为瓦片本身的Web墨卡托(EPSG:3857)。
+    :param masked: 为True时创建内部掩膜波段，只有写入过的瓦片有效，其余位置和invalidate的瓦片为nodata
+    write在瓦片进入队列后即返回成功，写线程中失败的瓦片记录在errors中，close之后由调用方检查
+    """
+
+    def __init__(self, tiff_filename, tileX_tl, tileY_tl, nX, nY, zoom, compress='LZW', creation_options=None,
+                 masked=False):
+        self.tiff_filename = tiff_filename
+        options = ['TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256', 'INTERLEAVE=PIXEL',
+                   f'COMPRESS={compress}', 'BIGTIFF=IF_SAFER']
+        if compress == 'JPEG':
+            options.append('PHOTOMETRIC=YCBCR')
+        options.extend(creation_options or [])
+        driver = gdal.GetDriverByName('GTiff')
+        self.dataset = driver.Create(tiff_filename, nX * 256, nY * 256, 3, gdal.GDT_Byte, options)
+        self.dataset.SetGeoTransform(tile_utils.getMercatorGeoTransform(tileX_tl, tileY_tl, zoom))
+        proj = osr.SpatialReference()
+        proj.ImportFromEPSG(3857)
+        self.dataset.SetProjection(proj.ExportToWkt())
+        self.mask_band = None
+        if masked:
+            self.mask_band = create_mask_band(self.dataset)
+
+        self.errors = []
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            x, y, tile = item
+            try:
+                if tile is None:
+                    # invalidate：只把该瓦片的掩膜置为无效
+                    if self.mask_band is not None:
+                        self.mask_band.WriteRaster(x * 256, y * 256, 256, 256, _invalid_mask)
+                    continue
+                # 一次写入一个完整的块，三个波段交错排列
+                self.dataset.WriteRaster(x * 256, y * 256, 256, 256, tile.tobytes(),
+                                         band_list=[1, 2, 3], buf_pixel_space=3,
+                                         buf_line_space=256 * 3, buf_band_space=1)
+                if self.mask_band is not None:
+                    self.mask_band.WriteRaster(x * 256, y * 256, 256, 256, _valid_mask)
+            except Exception as e:
+                print(str(e))
+                self.errors.append((x, y))
+
+    def exists(self, x, y):
+        return False
+
+    def write(self, input_image_data, x, y):
+        try:
+            tile = cv2.cvtColor(decode_tile(input_image_data), cv2.COLOR_BGR2RGB)
+        except Exception as e:
+            print(str(e))
+            return -1
+        # 队列满时阻塞下载线程，内存占用有上限
+        self.queue.put((x, y, tile))
+        record_queue('geotiff_write', self.queue.qsize())
+        return 0
+
+    def invalidate(self, x, y):
+        """
+        已写入的瓦片在掩膜中标为无效(如由父瓦片补齐的占位瓦片)，像素保留；与write按顺序在写线程中执行
+        """
+        self.queue.put((x, y, None))
+
+    def close(self):
+        if self.dataset is None:
+            return
+        self.queue.put(None)
+        self.writer.join()
+        self.dataset.FlushCache()
+        self.mask_band = None
+        self.dataset = None
+        if self.errors:
+            print(f"Failed to write {len(self.errors)} tiles into {self.tiff_filename}")
+
+
+def download_to_geotiff(tiff_filename, datasource, tileX_tl, tileY_tl, nX, nY, zoom, nproc=8,
+                        engine='thread', policy=None, compress='LZW', tile_mask=None, batch=None,
+                        fallback=None):
+    """
+    不经过临时瓦片和合并，直接从网络流式写入GeoTIFF
+    :param tile_mask: (nX, nY)的bool数组，指定时只下载为True的瓦片，其余位置在掩膜中为nodata
+    启用占位瓦片识别(utils.placeholder.placeholder_scope)时同样带掩膜，占位瓦片处为nodata
+    :param batch: 见utils.tile_grid.download_grid
+    :param fallback: 见utils.tile_grid.download_grid
+    :return: 失败瓦片达到10%或有瓦片写入失败时返回False
+    """
+    masked = tile_mask is not None or get_placeholders() is not None
+    with GeoTiffSink(tiff_filename, tileX_tl, tileY_tl, nX, nY, zoom, compress, masked=masked) as sink:
+        success = download_grid(sink, datasource, tileX_tl, tileY_tl, nX, nY, zoom, nproc,
+                                engine=engine, policy=policy, tile_mask=tile_mask, batch=batch,
+                                fallback=fallback)
+    if sink.errors:
+        # 这些瓦片入队时已被download_grid计为完成，不会再重试，输出中缺失，整个任务按失败处理
+        print(f"{tiff_filename} is incomplete, tiles failed to write: {sink.errors[:10]}")
+        success = False
+    if success:
+        print("保存完成：" + tiff_filename)
+    return success
@@ -0,0 +1,146 @@
+import time
+import threading
+import contextvars
+from collections import deque
+from concurrent import futures
+from contextlib import contextmanager
+from utils.url import mirror_url
+from utils.policy import _percentile
+
+# 见utils.metrics._active_metrics，按线程/协程的上下文隔离
+_active_hedge = contextvars.ContextVar('hedge', default=None)
+
+
+class HedgePolicy(object):
+    """
+    对冲请求：瓦片在阈值时间内没有响应时，向同一数据源的另一个镜像子域名再发一次，
+    取先返回的正常结果并取消另一个。阈值为最近正常响应延迟的percentile分位数，
+    对冲请求数不超过总请求数的max_ratio，避免服务整体变慢时请求量翻倍。
+    线程引擎中已发出的同步请求无法中断，落后的一方结果直接丢弃；async引擎中直接取消。
+    """
+
+    def __init__(self,
+                 percentile=0.95,
+                 initial_delay=0.5,
+                 min_delay=0.05,
+                 max_delay=2.0,
+                 max_ratio=0.1,
+                 window=500,
+                 min_samples=20,
+                 max_workers=64):
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.max_ratio = max_ratio
+        self.min_samples = min_samples
+        self.max_workers = max_workers
+        self.latencies = deque(maxlen=window)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.primary_wins = 0
+        self.failed = 0
+        self._executor = None
+
+    def delay(self):
+        with self.lock:
+            if len(self.latencies) < self.min_samples:
+                return self.initial_delay
+            t = _percentile(self.latencies, self.percentile)
+        return min(self.max_delay, max(self.min_delay, t))
+
+    def observe(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def start(self):
+        with self.lock:
+            self.requests += 1
+
+    def try_hedge(self):
+        with self.lock:
+            if self.hedges + 1 > self.max_ratio * self.requests:
+                return False
+            self.hedges += 1
+            return True
+
+    def finish(self, hedged, hedge_won, success):
+        with self.lock:
+            if not success:
+                self.failed += 1
+            elif hedge_won:
+                self.hedge_wins += 1
+            elif hedged:
+                self.primary_wins += 1
+
+    def summary(self):
+        delay = self.delay()
+        with self.lock:
+            return {'requests': self.requests, 'hedges': self.hedges,
+                    'hedge_ratio': self.hedges / self.requests if self.requests else 0.0,
+                    'hedge_wins': self.hedge_wins, 'primary_wins': self.primary_wins,
+                    'hedge_win_ratio': self.hedge_wins / self.hedges if self.hedges else 0.0,
+                    'failed': self.failed, 'delay': round(delay, 3)}
+
+    def _get_executor(self):
+        with self.lock:
+            if self._executor is None:
+                self._executor = futures.ThreadPoolExecutor(max_workers=self.max_workers)
+            return self._executor
+
+    def close(self):
+        with self.lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def fetch(self, attempt, url, headers):
+        """
+        线程引擎的对冲请求
+        :param attempt: 请求一次的函数attempt(url, headers)，失败返回None
+        """
+        self.start()
+        executor = self._get_executor()
+        # 对冲线程池由多次下载共用，按提交时的上下文记录指标
+        pending = {executor.submit(contextvars.copy_context().run, attempt, url, headers): time.time()}
+        done, _ = futures.wait(pending, timeout=self.delay())
+        hedge = None
+        if not done:
+            hedge_url = mirror_url(url)
+            if hedge_url is not None and self.try_hedge():
+                hedge = executor.submit(contextvars.copy_context().run, attempt, hedge_url, headers)
+                pending[hedge] = time.time()
+        while pending:
+            done, _ = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+            for f in done:
+                s = pending.pop(f)
+                input_image_data = f.result()
+                if input_image_data is not None:
+                    self.observe(time.time() - s)
+                    for other in pending:
+                        other.cancel()
+                    self.finish(hedge is not None, f is hedge, True)
+                    return input_image_data
+        self.finish(hedge is not None, False, False)
+        return None
+
+
+def get_hedge():
+    return _active_hedge.get()
+
+
+@contextmanager
+def hedge_scope(hedge):
+    """
+    在作用域内所有下载路径都使用对冲请求
+    :param hedge: HedgePolicy，为None时不启用
+    """
+    token = _active_hedge.set(hedge)
+    try:
+        yield hedge
+    finally:
+        _active_hedge.reset(token)
+        if hedge is not None:
+            hedge.close()
@@ -0,0 +1,175 @@
+import os
+import struct
+import cv2
+import numpy as np
+from tqdm import tqdm
+from utils.download import check_tile, decode_tile, jpeg_subsampling
+from utils.tile_store import MBTilesStore, open_tile_source
+from utils.metrics import timed
+
+# 回退编码时与文件一致的色度采样
+_sampling_factor = {
+    (1, 1): cv2.IMWRITE_JPEG_SAMPLING_FACTOR_444,
+    (2, 1): cv2.IMWRITE_JPEG_SAMPLING_FACTOR_422,
+    (2, 2): cv2.IMWRITE_JPEG_SAMPLING_FACTOR_420,
+    (1, 2): cv2.IMWRITE_JPEG_SAMPLING_FACTOR_440,
+}
+fallback_quality = 95
+# 探测采样方式时最多查看的瓦片数
+probe_tiles = 64
+
+# TIFF字段类型
+_SHORT = 3
+_LONG = 4
+_RATIONAL = 5
+_DOUBLE = 12
+_LONG8 = 16
+_type_format = {_SHORT: 'H', _LONG: 'I', _RATIONAL: 'II', _DOUBLE: 'd', _LONG8: 'Q'}
+
+
+def _iter_tile_bytes(source, nX, nY):
+    # 按TIFF瓦片顺序(逐行、从左到右)读取原始瓦片字节，缺失为None
+    for y in range(nY):
+        if isinstance(source, MBTilesStore):
+            row = {x: data for x, _, data in source.iter_tiles(0, nX, y, y + 1)}
+            for x in range(nX):
+                yield row.get(x)
+            continue
+        for x in range(nX):
+            img_path = os.path.join(source, f"{x}_{y}.jpg")
+            if not os.path.exists(img_path):
+                yield None
+                continue
+            with open(img_path, 'rb') as f:
+                yield f.read()
+
+
+def _probe_subsampling(source, nX, nY):
+    for i, data in enumerate(_iter_tile_bytes(source, nX, nY)):
+        if i >= probe_tiles:
+            break
+        if data is not None and check_tile(data):
+            subsampling = jpeg_subsampling(data)
+            if subsampling in _sampling_factor:
+                return subsampling
+    return 2, 2
+
+
+def _encode_tile(img, subsampling):
+    if img is None:
+        img = np.zeros((256, 256, 3), dtype=np.uint8)
+    elif img.ndim == 2:
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    elif img.shape[2] == 4:
+        img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+    if img.shape[:2] != (256, 256):
+        img = cv2.resize(img, (256, 256), interpolation=cv2.INTER_AREA)
+    return cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, fallback_quality,
+                                      cv2.IMWRITE_JPEG_SAMPLING_FACTOR, _sampling_factor[subsampling]])[1].tobytes()
+
+
+def write_jpeg_tiff(tiff_filename, tiles, nX, nY, subsampling, gt, epsg=3857, bigtiff=False):
+    """
+    把已编码好的256*256 JPEG瓦片顺序写入JPEG压缩(YCbCr)的分块GeoTIFF，每个JPEG即一个TIFF瓦片
+    :param tiles: 按行、从左到右的nX*nY个JPEG字节，采样方式须与subsampling一致
+    :param gt: 仿射变换(无旋转)
+    """
+    offset_format, offset_type = ('Q', _LONG8) if bigtiff else ('I', _LONG)
+    offsets = []
+    bytecounts = []
+    with open(tiff_filename, 'wb') as f:
+        # 文件头，IFD位置最后回填
+        if bigtiff:
+            f.write(b'II+\x00' + struct.pack('<HHQ', 8, 0, 0))
+        else:
+            f.write(b'II*\x00' + struct.pack('<I', 0))
+        for data in tiles:
+            offsets.append(f.tell())
+            bytecounts.append(len(data))
+            f.write(data)
+        if len(offsets) != nX * nY:
+            raise ValueError("expect {} tiles, got {}".format(nX * nY, len(offsets)))
+
+        geokeys = [1, 1, 0, 3, 1024, 0, 1, 1, 1025, 0, 1, 1, 3072, 0, 1, epsg]
+        tags = [
+            (256, _LONG, [nX * 256]),
+            (257, _LONG, [nY * 256]),
+            (258, _SHORT, [8, 8, 8]),
+            (259, _SHORT, [7]),  # JPEG
+            (262, _SHORT, [6]),  # YCbCr
+            (277, _SHORT, [3]),
+            (284, _SHORT, [1]),
+            (322, _LONG, [256]),
+            (323, _LONG, [256]),
+            (324, offset_type, offsets),
+            (325, offset_type, bytecounts),
+            (530, _SHORT, list(subsampling)),
+            (532, _RATIONAL, [0, 1, 255, 1, 128, 1, 255, 1, 128, 1, 255, 1]),
+            (33550, _DOUBLE, [gt[1], -gt[5], 0.0]),
+            (33922, _DOUBLE, [0.0, 0.0, 0.0, gt[0], gt[3], 0.0]),
+            (34735, _SHORT, geokeys),
+        ]
+        inline_size = 8 if bigtiff else 4
+        entries = []
+        for tag, value_type, values in tags:
+            count = len(values) // 2 if value_type == _RATIONAL else len(values)
+            data = struct.pack('<' + _type_format[value_type][0] * len(values), *values)
+            if len(data) <= inline_size:
+                entries.append((tag, value_type, count, data.ljust(inline_size, b'\x00')))
+                continue
+            # 放不下的值写在IFD之前，按字对齐
+            if f.tell() % 2:
+                f.write(b'\x00')
+            entries.append((tag, value_type, count, struct.pack('<' + offset_format, f.tell())))
+            f.write(data)
+
+        if f.tell() % 2:
+            f.write(b'\x00')
+        ifd_offset = f.tell()
+        if bigtiff:
+            f.write(struct.pack('<Q', len(entries)))
+            for tag, value_type, count, value in entries:
+                f.write(struct.pack('<HHQ', tag, value_type, count) + value)
+            f.write(struct.pack('<Q', 0))
+            f.seek(8)
+            f.write(struct.pack('<Q', ifd_offset))
+        else:
+            f.write(struct.pack('<H', len(entries)))
+            for tag, value_type, count, value in entries:
+                f.write(struct.pack('<HHI', tag, value_type, count) + value)
+            f.write(struct.pack('<I', 0))
+            f.seek(4)
+            f.write(struct.pack('<I', ifd_offset))
+
+
+@timed('merge_jpeg_tiff')
+def mergeTiles2JPEGTIF(tmpdir, tiff_filename, nX, nY, gt, epsg=3857):
+    """
+    JPEG-in-TIFF：下载得到的256*256基线JPEG瓦片原样作为TIFF瓦片写入，不解码也不重新压缩。
+    格式不符(PNG、渐进式、灰度、采样方式与文件不一致)或缺失的瓦片解码一次后按文件的采样方式重新编码
+    :param tmpdir: 瓦片临时目录、TmpdirSink或MBTilesStore
+    """
+    source = open_tile_source(tmpdir)
+    subsampling = _probe_subsampling(source, nX, nY)
+    blank = _encode_tile(None, subsampling)
+    print('start merge tiles to jpeg tiff')
+    print(f"width={nX * 256},height={nY * 256},subsampling={subsampling}")
+    stats = {'passthrough': 0, 'reencoded': 0, 'missing': 0}
+
+    def tiles():
+        for data in tqdm(_iter_tile_bytes(source, nX, nY), total=nX * nY):
+            if data is None:
+                stats['missing'] += 1
+                yield blank
+            elif check_tile(data) and jpeg_subsampling(data) == subsampling:
+                stats['passthrough'] += 1
+                yield data
+            else:
+                stats['reencoded'] += 1
+                yield _encode_tile(decode_tile(data), subsampling)
+
+    # 原始JPEG不会大于未压缩的数据量，按此估计是否需要BigTIFF
+    bigtiff = nX * nY * 256 * 256 * 3 >= 2 ** 32 - 2 ** 26
+    write_jpeg_tiff(tiff_filename, tiles(), nX, nY, subsampling, gt, epsg, bigtiff)
+    print(f"passthrough={stats['passthrough']}, reencoded={stats['reencoded']}, missing={stats['missing']}")
+    print("保存完成：" + tiff_filename)
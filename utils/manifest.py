@@ -0,0 +1,150 @@
+import os
+import json
+import numpy as np
+from utils import tile_utils
+from utils.download import TmpdirSink
+from utils.tile_store import MBTilesStore
+
+# 每个瓦片一个字节的状态
+PENDING = 0
+DONE = 1
+# 已尝试但还没有成功写入
+FAILED = 2
+# 数据源返回的是占位瓦片(无影像)，输出中为nodata，不再重新下载
+NODATA = 3
+# 数据源返回的是占位瓦片，已由低级别的父瓦片放大补齐；不算完成，之后的运行会重新下载，有真实影像时替换
+OVERZOOM = 4
+# 文件开头为定长的json任务描述，之后是nX*nY字节的状态表
+header_size = 4096
+
+
+class JobManifest(object):
+    """
+    下载任务清单：记录任务范围(数据源、级别、左上角瓦片和网格大小、经纬度范围)以及每个瓦片的完成/失败状态。
+    状态表通过np.memmap映射，更新只是改一个字节，进程崩溃后仍保留在文件中；
+    重新运行同一个任务时直接由状态表得到进度，跳过已完成的瓦片，不需要逐个检查文件。
+    """
+
+    def __init__(self, path, datasource, zoom, tileX_tl, tileY_tl, nX, nY):
+        self.path = path
+        lng_l, lat_t = tile_utils.tileToLnglat(tileX_tl, tileY_tl, zoom)
+        lng_r, lat_b = tile_utils.tileToLnglat(tileX_tl + nX, tileY_tl + nY, zoom)
+        self.job = {
+            'datasource': datasource,
+            'zoom': zoom,
+            'tileX_tl': tileX_tl,
+            'tileY_tl': tileY_tl,
+            'nX': nX,
+            'nY': nY,
+            'bounds': [lng_l, lat_b, lng_r, lat_t],
+        }
+        self.created = not os.path.exists(path)
+        if self.created:
+            header = json.dumps(self.job).encode('utf-8')
+            if len(header) > header_size:
+                raise ValueError("job description is too long for manifest {}".format(path))
+            with open(path, 'wb') as f:
+                f.write(header.ljust(header_size, b' '))
+                f.truncate(header_size + nX * nY)
+        else:
+            with open(path, 'rb') as f:
+                stored = json.loads(f.read(header_size).decode('utf-8'))
+            if stored != json.loads(json.dumps(self.job)):
+                raise ValueError("manifest {} was created for another job {}".format(path, stored))
+        self.state = np.memmap(path, dtype=np.uint8, mode='r+', offset=header_size, shape=(nX, nY))
+
+    def is_done(self, x, y):
+        return self.state[x, y] in (DONE, NODATA)
+
+    def done_mask(self):
+        return (self.state == DONE) | (self.state == NODATA)
+
+    def placeholder_mask(self):
+        """
+        :return: (nX, nY)的bool数组，数据源返回占位瓦片(NODATA或由父瓦片补齐的OVERZOOM)的位置为True，输出时在掩膜中置为无效
+        """
+        return np.array((self.state == NODATA) | (self.state == OVERZOOM))
+
+    def mark(self, x, y, state):
+        self.state[x, y] = state
+
+    def done_count(self):
+        return int(np.count_nonzero(self.done_mask()))
+
+    def nodata_count(self):
+        return int(np.count_nonzero(self.state == NODATA))
+
+    def failed_count(self):
+        return int(np.count_nonzero(self.state == FAILED))
+
+    def overzoom_count(self):
+        return int(np.count_nonzero(self.state == OVERZOOM))
+
+    def is_complete(self):
+        return self.done_count() == self.state.size
+
+    def summary(self):
+        done = self.done_count()
+        failed = self.failed_count()
+        overzoom = self.overzoom_count()
+        return {'total': int(self.state.size), 'done': done, 'nodata': self.nodata_count(), 'failed': failed,
+                'overzoom': overzoom, 'pending': int(self.state.size) - done - failed - overzoom}
+
+    def sync(self, tiles):
+        """
+        以sink中实际存在的瓦片为准更新状态表，由父瓦片补齐的瓦片保持OVERZOOM
+        :param tiles: 已存在瓦片的(x, y)
+        """
+        self.state[self.state == DONE] = PENDING
+        for x, y in tiles:
+            if 0 <= x < self.state.shape[0] and 0 <= y < self.state.shape[1] and self.state[x, y] != OVERZOOM:
+                self.state[x, y] = DONE
+
+    def flush(self):
+        self.state.flush()
+
+    def close(self):
+        if self.state is not None:
+            self.state.flush()
+            self.state = None
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class ManifestSink(object):
+    """
+    在sink前加一层清单：exists只查状态表，write成功后记为完成。
+    开始下载一个瓦片时先记为失败，成功写入后改为完成，任务结束时仍为失败的即下载失败的瓦片；
+    OVERZOOM的瓦片不算完成，会重新下载，有真实影像时改为完成
+    """
+
+    def __init__(self, sink, manifest):
+        self.sink = sink
+        self.manifest = manifest
+        if isinstance(sink, MBTilesStore):
+            # mbtiles按批提交，崩溃时最后一批可能未入库，以库中实际内容为准
+            manifest.sync(sink.tiles())
+        elif isinstance(sink, TmpdirSink) and manifest.created:
+            # 旧版本留下的临时目录，一次性导入已有的瓦片
+            manifest.sync(sink.tiles())
+
+    def exists(self, x, y):
+        if self.manifest.is_done(x, y):
+            return True
+        # 由父瓦片补齐的瓦片重新下载失败时仍保留OVERZOOM
+        if self.manifest.state[x, y] != OVERZOOM:
+            self.manifest.mark(x, y, FAILED)
+        return False
+
+    def write(self, input_image_data, x, y):
+        status = self.sink.write(input_image_data, x, y)
+        if status == 0:
+            self.manifest.mark(x, y, DONE)
+        return status
+
+    def close(self):
+        self.sink.close()
+        self.manifest.flush()
@@ -1,13 +1,109 @@
 from osgeo import gdal, osr
 import os
+from contextlib import contextmanager
 import cv2
 from tqdm import tqdm
+from concurrent import futures
 import numpy as np
+from utils import tile_utils
 from utils.concurrent_helper import run_with_concurrent
+from utils.download import decode_tile, TmpdirSink
+from utils.tile_store import MBTilesStore, open_tile_source
+from utils.jpeg_tiff import mergeTiles2JPEGTIF
+from utils.vrt import writeTilesVRT, writeBlocksVRT
+from utils.metrics import timed
 
+# *_gdal_GTiff的输出方式："tiff" 合并为普通GeoTIFF；"cog" Cloud Optimized GeoTIFF，见utils.cog；
+# "jpeg" 原始JPEG瓦片直接作为TIFF瓦片写入，见utils.jpeg_tiff；"vrt" 只生成引用瓦片或大块jpg的VRT，见utils.vrt
+supported_output = ['tiff', 'cog', 'jpeg', 'vrt']
 
-def mergeInJPG(tmpdir, nX, nY, stepX, stepY, output_dir):
+
+@contextmanager
+def gdal_config(**options):
+    """
+    在当前线程内临时设置GDAL配置项，退出时恢复原值，不影响其他线程和之后的GDAL调用
+    """
+    previous = {key: gdal.GetThreadLocalConfigOption(key, None) for key in options}
+    for key, value in options.items():
+        gdal.SetThreadLocalConfigOption(key, value)
+    try:
+        yield
+    finally:
+        for key, value in previous.items():
+            gdal.SetThreadLocalConfigOption(key, value)
+
+
+def create_mask_band(dataset):
+    """
+    创建每个数据集一个的内部掩膜(1位，与影像同样分块)
+    :return: 掩膜波段
+    """
+    with gdal_config(GDAL_TIFF_INTERNAL_MASK='YES'):
+        dataset.CreateMaskBand(gdal.GMF_PER_DATASET)
+    return dataset.GetRasterBand(1).GetMaskBand()
+
+
+def write_tile_mask(dataset, placeholder_mask):
+    """
+    为瓦片网格的tiff创建内部掩膜：占位瓦片处为0(nodata)，其余为255
+    :param placeholder_mask: (nX, nY)的bool数组，见JobManifest.placeholder_mask
+    """
+    mask_band = create_mask_band(dataset)
+    nX, nY = placeholder_mask.shape
+    # 逐行瓦片写入，每次256行
+    for y in range(nY):
+        row = np.where(placeholder_mask[:, y], 0, 255).astype(np.uint8).repeat(256)
+        mask_band.WriteRaster(0, y * 256, nX * 256, 256, np.broadcast_to(row, (256, nX * 256)).tobytes())
+    mask_band.FlushCache()
+
+
+def readTileBlock(tmpdir, start_x, end_x, start_y, end_y):
+    """
+    读取[start_x, end_x) x [start_y, end_y)范围内的瓦片拼成一块BGR图像，缺失的瓦片为黑色
+    :param tmpdir: 瓦片临时目录或MBTilesStore
+    """
+    block_image = np.zeros(((end_y - start_y) * 256, (end_x - start_x) * 256, 3), dtype=np.uint8)
+    if isinstance(tmpdir, MBTilesStore):
+        # 一次查询取出整个块的瓦片
+        for x, y, data in tmpdir.iter_tiles(start_x, end_x, start_y, end_y):
+            block_image[(y - start_y) * 256:(y - start_y + 1) * 256,
+            (x - start_x) * 256:(x - start_x + 1) * 256, :] = decode_tile(data)
+        return block_image
+    for x in range(start_x, end_x):
+        for y in range(start_y, end_y):
+            file_name = f"{x}_{y}.jpg"
+            img_path = os.path.join(tmpdir, file_name)
+            if os.path.exists(img_path):
+                img = cv2.imread(img_path)
+                block_image[(y - start_y) * 256:(y - start_y + 1) * 256,
+                (x - start_x) * 256:(x - start_x + 1) * 256, :] = img
+    return block_image
+
+
+# 子进程中按路径缓存打开的瓦片库，每个进程只打开一次
+_worker_sources = {}
+
+
+def _mergeBlock(tmpdir, start_x, end_x, start_y, end_y, block_path):
+    if isinstance(tmpdir, str) and tmpdir.endswith('.mbtiles'):
+        if tmpdir not in _worker_sources:
+            _worker_sources[tmpdir] = MBTilesStore(tmpdir)
+        tmpdir = _worker_sources[tmpdir]
+    # 创建当前块的图像
+    block_image = readTileBlock(tmpdir, start_x, end_x, start_y, end_y)
+    # 保存当前块图像
+    cv2.imwrite(block_path, block_image)
+    return 0
+
+
+@timed('merge_jpg')
+def mergeInJPG(tmpdir, nX, nY, stepX, stepY, output_dir, nproc=1):
+    """
+    :param tmpdir: 瓦片临时目录，或MBTilesStore/.mbtiles文件路径
+    :param nproc: 合并进程数，每个进程每次负责一整块；每块约占stepX*stepY*192KB内存
+    """
     os.makedirs(output_dir, exist_ok=True)
+    tmpdir = open_tile_source(tmpdir)
     nX = int(nX)
     nY = int(nY)
     stepX = int(stepX)
@@ -17,38 +113,39 @@ def mergeInJPG(tmpdir, nX, nY, stepX, stepY, output_dir):
     num_steps_y = int((nY + stepY - 1) // stepY)
 
     print('start merge images to jpg')
-    print(f"nX={nX}, nY={nY}, stepX={stepX}, stepY={stepY}")
-    with tqdm(total=num_steps_x * num_steps_y) as pbar:
-        for step_x in range(num_steps_x):
-            for step_y in range(num_steps_y):
-                # 当前块的范围
-                start_x = step_x * stepX
-                start_y = step_y * stepY
-                end_x = min(start_x + stepX, nX)
-                end_y = min(start_y + stepY, nY)
-
-                block_filename = f"block_{start_x}_{start_y}_{end_x}_{end_y}.jpg"
-                block_path = os.path.join(output_dir, block_filename)
-                if os.path.exists(block_path):
-                    pbar.update(1)
-                    continue
-
-                # 创建当前块的图像
-                block_image = np.zeros(((end_y - start_y) * 256, (end_x - start_x) * 256, 3), dtype=np.uint8)
-
-                for x in range(start_x, end_x):
-                    for y in range(start_y, end_y):
-                        file_name = f"{x}_{y}.jpg"
-                        img_path = os.path.join(tmpdir, file_name)
-                        if os.path.exists(img_path):
-                            img = cv2.imread(img_path)
-                            block_image[(y - start_y) * 256:(y - start_y + 1) * 256,
-                            (x - start_x) * 256:(x - start_x + 1) * 256, :] = img
-
-                # 保存当前块图像
-                cv2.imwrite(block_path, block_image)
+    print(f"nX={nX}, nY={nY}, stepX={stepX}, stepY={stepY}, nproc={nproc}")
+    task_list = []
+    for step_x in range(num_steps_x):
+        for step_y in range(num_steps_y):
+            # 当前块的范围
+            start_x = step_x * stepX
+            start_y = step_y * stepY
+            end_x = min(start_x + stepX, nX)
+            end_y = min(start_y + stepY, nY)
+
+            block_filename = f"block_{start_x}_{start_y}_{end_x}_{end_y}.jpg"
+            block_path = os.path.join(output_dir, block_filename)
+            # 已合并的块跳过，可断点续做
+            if os.path.exists(block_path):
+                continue
+            task_list.append((start_x, end_x, start_y, end_y, block_path))
+
+    total = num_steps_x * num_steps_y
+    with tqdm(total=total, initial=total - len(task_list)) as pbar:
+        if nproc <= 1 or len(task_list) <= 1:
+            for task in task_list:
+                _mergeBlock(tmpdir, *task)
+                pbar.update(1)
+            return
+        # 子进程按路径自行打开瓦片库
+        if isinstance(tmpdir, MBTilesStore):
+            tmpdir.flush()
+            tmpdir = tmpdir.path
+        with futures.ProcessPoolExecutor(max_workers=min(nproc, len(task_list))) as executor:
+            to_do = [executor.submit(_mergeBlock, tmpdir, *task) for task in task_list]
+            for future in futures.as_completed(to_do):
+                future.result()
                 pbar.update(1)
-                # print(f"保存完成：{block_path}")
 
 
 def mergeJPG2TIF_single(jpg_path, tif_dataset, pbar):
@@ -70,6 +167,7 @@ def mergeJPG2TIF_single(jpg_path, tif_dataset, pbar):
 
 
 ## 多线程合并jpg为tiff, 好像不太好使，待改进
+@timed('merge_tiff')
 def mergeJPG2TIF_thread(jpg_dir, tiff_filename, width, height, gt, nproc=8):
     print('start merge images to tiff')
     print(f"width={width},height={height}")
@@ -105,7 +203,20 @@ def mergeJPG2TIF_thread(jpg_dir, tiff_filename, width, height, gt, nproc=8):
     print("保存完成：" + tiff_filename)
 
 
-def mergeJPG2TIF(jpg_dir, tiff_filename, width, height, gt):
+def mergeStore2TIF(store, dataset):
+    # 直接从瓦片库逐个瓦片写入tiff，不经过合并后的大块jpg
+    for x, y, data in tqdm(store.iter_tiles(), total=store.count()):
+        img = cv2.cvtColor(decode_tile(data), cv2.COLOR_BGR2RGB)
+        for band in range(3):
+            dataset.GetRasterBand(band + 1).WriteRaster(x * 256, y * 256, 256, 256, img[:, :, band].tobytes())
+
+
+@timed('merge_tiff')
+def mergeJPG2TIF(jpg_dir, tiff_filename, width, height, gt, placeholder_mask=None):
+    """
+    :param jpg_dir: mergeInJPG输出的块目录，也可以直接传MBTilesStore/.mbtiles文件路径
+    :param placeholder_mask: (nX, nY)的bool数组，有占位瓦片时创建内部掩膜，这些瓦片处为nodata
+    """
     print('start merge images to tiff')
     print(f"width={width},height={height}")
     driver = gdal.GetDriverByName('GTiff')
@@ -119,6 +230,15 @@ def mergeJPG2TIF(jpg_dir, tiff_filename, width, height, gt):
         print("Error: Coordinate system setting failed")
     # dataset.SetMetadataItem("BLOCKXSIZE", str(256))
     # dataset.SetMetadataItem("BLOCKYSIZE", str(256))
+    jpg_dir = open_tile_source(jpg_dir)
+    if isinstance(jpg_dir, MBTilesStore):
+        mergeStore2TIF(jpg_dir, dataset)
+        if placeholder_mask is not None and placeholder_mask.any():
+            write_tile_mask(dataset, placeholder_mask)
+        dataset.FlushCache()
+        dataset = None
+        print("保存完成：" + tiff_filename)
+        return
     files_list = os.listdir(jpg_dir)
     for i in tqdm(range(len(files_list))):
         img_path = files_list[i]
@@ -131,11 +251,14 @@ def mergeJPG2TIF(jpg_dir, tiff_filename, width, height, gt):
         for band in range(3):
             dataset.GetRasterBand(band + 1).WriteRaster(xs * 256, ys * 256, sub_width, sub_height,
                                                         img[:, :, band].tobytes())
+    if placeholder_mask is not None and placeholder_mask.any():
+        write_tile_mask(dataset, placeholder_mask)
     dataset.FlushCache()
     dataset = None
     print("保存完成：" + tiff_filename)
 
 
+@timed('merge_tiff')
 def merge2tiff(tmpdir, tiff_filename, width, height):
     print('start merge images to tiff')
     print(f"width={width},height={height}")
@@ -156,3 +279,75 @@ def merge2tiff(tmpdir, tiff_filename, width, height):
             dataset.GetRasterBand(band + 1).WriteRaster(x * 256, y * 256, 256, 256, img[:, :, band].tobytes())
     dataset.FlushCache()
     print("保存完成：" + tiff_filename)
+
+
+def save_sources(chain, tiff_filename):
+    """
+    保存每个瓦片的来源到{tiff}_sources.json
+    :param chain: utils.failover.SourceChain，为None时不保存
+    """
+    if chain is not None:
+        chain.save(os.path.splitext(tiff_filename)[0] + '_sources.json')
+
+
+def finish_output(spool_sink, manifest, complete, tiff_filename, tileX_tl, tileY_tl, nX, nY, zoom, output='tiff',
+                  cog_compress='JPEG', cog_blocksize=512, merge_nproc=1, chain=None, placeholder_mask=None):
+    """
+    *_gdal_GTiff下载完成后由暂存的瓦片生成输出文件；没有瓦片缺失时删除暂存的瓦片和进度清单
+    :param spool_sink: utils.tile_store.open_spool打开的暂存目录或mbtiles
+    :param manifest: 该次下载的进度清单(已关闭)
+    :param complete: 下载结束时清单中的瓦片是否全部完成
+    :param output: 见supported_output
+    :param chain: 备用数据源utils.failover.SourceChain，每个瓦片的来源保存在{tiff}_sources.json
+    :param placeholder_mask: 下载结束时的JobManifest.placeholder_mask()，有占位瓦片时输出带掩膜，这些瓦片处为nodata
+    """
+    # utils.cog依赖本模块的readTileBlock
+    from utils.cog import mergeTiles2COG
+
+    save_sources(chain, tiff_filename)
+    if placeholder_mask is not None and not placeholder_mask.any():
+        placeholder_mask = None
+    width = nX * 256
+    height = nY * 256
+    # cog/jpeg/vrt直接使用瓦片本身的Web墨卡托(EPSG:3857)坐标，tiff保持原来的EPSG:4326经纬度坐标(见mergeJPG2TIF)
+    mercator_gt = tile_utils.getMercatorGeoTransform(tileX_tl, tileY_tl, zoom)
+    jpg_dir = os.path.join(os.path.dirname(tiff_filename),
+                           os.path.basename(tiff_filename).split('.')[0] + '_merged_images')
+    if output == 'vrt':
+        # 只生成VRT，引用临时目录中的瓦片或合并后的大块jpg，不复制影像数据
+        vrt_filename = os.path.splitext(tiff_filename)[0] + '.vrt'
+        if isinstance(spool_sink, TmpdirSink):
+            writeTilesVRT(spool_sink.tmpdir, vrt_filename, nX, nY, mercator_gt, placeholder_mask=placeholder_mask)
+        else:
+            mergeInJPG(spool_sink, nX, nY, 60, 60, jpg_dir, nproc=merge_nproc)
+            writeBlocksVRT(jpg_dir, vrt_filename, width, height, mercator_gt, placeholder_mask=placeholder_mask)
+        # VRT引用的文件需要保留，需要实体文件时用utils.vrt.materializeVRT转换
+        spool_sink.close()
+        return
+    if output == 'cog':
+        # 由瓦片直接生成COG，金字塔在组装时逐级写入
+        mergeTiles2COG(spool_sink, tiff_filename, nX, nY, mercator_gt, compress=cog_compress,
+                       blocksize=cog_blocksize, placeholder_mask=placeholder_mask)
+    elif output == 'jpeg':
+        # 原始JPEG瓦片直接写入JPEG压缩的tiff，不解码
+        mergeTiles2JPEGTIF(spool_sink, tiff_filename, nX, nY, mercator_gt)
+        if placeholder_mask is not None:
+            # 文件由utils.jpeg_tiff直接写出，掩膜由GDAL追加在文件末尾
+            dataset = gdal.Open(tiff_filename, gdal.GA_Update)
+            write_tile_mask(dataset, placeholder_mask)
+            dataset = None
+    else:
+        # 合并为更大的jpg
+        os.makedirs(jpg_dir, exist_ok=True)
+        mergeInJPG(spool_sink, nX, nY, 60, 60, jpg_dir, nproc=merge_nproc)
+    if complete:
+        print(f"下载合并完成，没有瓦片缺失，删除临时瓦片：{spool_sink.path}")
+        spool_sink.remove()  # 删除临时目录
+        manifest.remove()
+    else:
+        spool_sink.close()
+    if output == 'tiff':
+        # 合并为tiff
+        geoTransform = tile_utils.getGeoTransform(tileX_tl, tileY_tl, nX, nY, zoom)
+        mergeJPG2TIF(jpg_dir, tiff_filename, width, height, geoTransform, placeholder_mask=placeholder_mask)
+    print("保存完成：" + tiff_filename)
@@ -0,0 +1,318 @@
+import os
+import json
+import time
+import bisect
+import threading
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+from utils.url import source_of
+
+# 请求延迟直方图的桶上限(秒)
+latency_buckets = (0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5, 0.75, 1.0, 2.0, 5.0)
+# 解码、写入、合并等阶段耗时直方图的桶上限(秒)
+stage_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0, 300.0)
+
+# 当前作用域的RunMetrics；每个线程/协程有各自的上下文，并发的get_img_*调用互不干扰，
+# 下载工作线程通过contextvars.copy_context()继承调用方的作用域
+_active_metrics = contextvars.ContextVar('metrics', default=None)
+
+
+class Histogram(object):
+    """
+    固定桶的直方图，与Prometheus的histogram一致：counts[i]为落在(buckets[i-1], buckets[i]]内的样本数，
+    最后一个为+Inf
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        for i, c in enumerate(other.counts):
+            self.counts[i] += c
+        self.sum += other.sum
+        self.count += other.count
+
+    def quantile(self, q):
+        """
+        按桶内线性插值估计分位数，与PromQL的histogram_quantile相同；落在+Inf桶时返回最后一个桶上限
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for i, c in enumerate(self.counts):
+            if cumulative + c >= rank and c > 0:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / c
+            cumulative += c
+        return self.buckets[-1]
+
+    def to_dict(self):
+        return {'buckets': list(self.buckets), 'counts': list(self.counts), 'sum': self.sum, 'count': self.count,
+                'p50': self.quantile(0.5), 'p99': self.quantile(0.99)}
+
+
+class RunMetrics(object):
+    """
+    一次下载(get_img_*调用或HRW的一批位置)的运行指标：按数据源统计请求数、状态码、重试、字节数和延迟直方图，
+    解码/写入/合并等阶段的耗时直方图，队列深度，以及瓦片的处理结果(每次尝试计一次，失败后重试或换数据源成功的瓦片
+    同时计入failed和done)。
+    通过run_scope启用，各下载路径调用本模块的record_*函数记录，未启用时这些函数什么都不做。
+    """
+
+    def __init__(self, name='run', parent=None):
+        self.name = name
+        self.parent = parent
+        self.start_time = time.time()
+        self.end_time = None
+        self.lock = threading.Lock()
+        # (数据源, 状态码)，请求异常(超时、连接错误)的状态码记为"error"
+        self.requests = Counter()
+        self.retries = Counter()
+        self.bytes = Counter()
+        self.latency = {}
+        self.stages = {}
+        # 队列名 -> [当前深度, 最大深度]
+        self.queues = {}
+        self.tiles = Counter()
+
+    def request(self, source, status, latency, nbytes):
+        with self.lock:
+            self.requests[(source, status)] += 1
+            self.bytes[source] += nbytes
+            if source not in self.latency:
+                self.latency[source] = Histogram(latency_buckets)
+            self.latency[source].observe(latency)
+
+    def retry(self, source, count=1):
+        with self.lock:
+            self.retries[source] += count
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = Histogram(stage_buckets)
+            self.stages[stage].observe(seconds)
+
+    def queue(self, name, depth):
+        with self.lock:
+            gauge = self.queues.setdefault(name, [0, 0])
+            gauge[0] = depth
+            gauge[1] = max(gauge[1], depth)
+
+    def tile(self, outcome):
+        with self.lock:
+            self.tiles[outcome] += 1
+
+    def merge(self, other):
+        with self.lock:
+            self.requests.update(other.requests)
+            self.retries.update(other.retries)
+            self.bytes.update(other.bytes)
+            for target, source, buckets in ((self.latency, other.latency, latency_buckets),
+                                            (self.stages, other.stages, stage_buckets)):
+                for key, histogram in source.items():
+                    target.setdefault(key, Histogram(buckets)).merge(histogram)
+            for name, (depth, max_depth) in other.queues.items():
+                gauge = self.queues.setdefault(name, [0, 0])
+                gauge[0] = depth
+                gauge[1] = max(gauge[1], max_depth)
+            self.tiles.update(other.tiles)
+
+    def elapsed(self):
+        return (self.end_time or time.time()) - self.start_time
+
+    def snapshot(self):
+        """
+        :return: 可直接json序列化的dict
+        """
+        with self.lock:
+            sources = {}
+            for (source, status), count in self.requests.items():
+                entry = sources.setdefault(source, {'requests': 0, 'status': {}})
+                entry['requests'] += count
+                entry['status'][str(status)] = count
+            for source, entry in sources.items():
+                entry['retries'] = self.retries[source]
+                entry['bytes'] = self.bytes[source]
+                entry['latency'] = self.latency[source].to_dict()
+            return {
+                'name': self.name,
+                'start_time': self.start_time,
+                'seconds': self.elapsed(),
+                'tiles': dict(self.tiles),
+                'sources': sources,
+                'stages': {stage: h.to_dict() for stage, h in self.stages.items()},
+                'queues': {name: {'depth': d, 'max': m} for name, (d, m) in self.queues.items()},
+            }
+
+    def save_json(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(), f, indent=1)
+
+    def to_prometheus(self, prefix='gedownloader'):
+        """
+        :return: Prometheus文本格式(text exposition format 0.0.4)
+        """
+        snapshot = self.snapshot()
+        lines = []
+
+        def metric(name, kind, help_text):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+
+        def histogram(name, labels, h):
+            cumulative = 0
+            for bound, count in zip(h['buckets'] + ['+Inf'], h['counts']):
+                cumulative += count
+                lines.append(f'{prefix}_{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{prefix}_{name}_sum{{{labels}}} {h["sum"]}')
+            lines.append(f'{prefix}_{name}_count{{{labels}}} {h["count"]}')
+
+        metric('run_seconds', 'gauge', 'Elapsed seconds of the run.')
+        lines.append(f'{prefix}_run_seconds {snapshot["seconds"]}')
+        metric('tiles_total', 'counter', 'Tiles by outcome.')
+        for outcome, count in snapshot['tiles'].items():
+            lines.append(f'{prefix}_tiles_total{{outcome="{outcome}"}} {count}')
+        metric('requests_total', 'counter', 'Tile requests by source and status code.')
+        for source, entry in snapshot['sources'].items():
+            for status, count in entry['status'].items():
+                lines.append(f'{prefix}_requests_total{{source="{source}",status="{status}"}} {count}')
+        metric('retries_total', 'counter', 'Tile request retries by source.')
+        for source, entry in snapshot['sources'].items():
+            lines.append(f'{prefix}_retries_total{{source="{source}"}} {entry["retries"]}')
+        metric('response_bytes_total', 'counter', 'Response bytes by source.')
+        for source, entry in snapshot['sources'].items():
+            lines.append(f'{prefix}_response_bytes_total{{source="{source}"}} {entry["bytes"]}')
+        metric('request_latency_seconds', 'histogram', 'Tile request latency by source.')
+        for source, entry in snapshot['sources'].items():
+            histogram('request_latency_seconds', f'source="{source}"', entry['latency'])
+        metric('stage_seconds', 'histogram', 'Time spent in decode, write and merge stages.')
+        for stage, h in snapshot['stages'].items():
+            histogram('stage_seconds', f'stage="{stage}"', h)
+        metric('queue_depth', 'gauge', 'Last observed queue depth.')
+        for name, gauge in snapshot['queues'].items():
+            lines.append(f'{prefix}_queue_depth{{queue="{name}"}} {gauge["depth"]}')
+        metric('queue_depth_max', 'gauge', 'Maximum observed queue depth.')
+        for name, gauge in snapshot['queues'].items():
+            lines.append(f'{prefix}_queue_depth_max{{queue="{name}"}} {gauge["max"]}')
+        return '\n'.join(lines) + '\n'
+
+    def save_prometheus(self, path):
+        # 先写临时文件再改名，node_exporter的textfile collector不会读到写了一半的文件
+        tmp_path = path + '.part'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+    def report(self):
+        snapshot = self.snapshot()
+        tiles = ", ".join(f"{k}={v}" for k, v in sorted(snapshot['tiles'].items()))
+        print(f"[{self.name}] {snapshot['seconds']:.1f}s, tiles: {tiles or 'none'}")
+        for source, entry in snapshot['sources'].items():
+            status = ", ".join(f"{k}={v}" for k, v in sorted(entry['status'].items()))
+            latency = entry['latency']
+            print(f"  {source}: {entry['requests']} requests ({status}), retries={entry['retries']}, "
+                  f"{entry['bytes'] / 1024 ** 2:.1f}MB, latency p50={latency['p50'] * 1000:.0f}ms "
+                  f"p99={latency['p99'] * 1000:.0f}ms")
+        if snapshot['stages']:
+            print("  " + ", ".join(f"{stage}: {h['count']} x {h['sum'] / h['count'] * 1000:.1f}ms = {h['sum']:.2f}s"
+                                   for stage, h in snapshot['stages'].items()))
+        if snapshot['queues']:
+            print("  queue depth max: " + ", ".join(f"{name}={gauge['max']}"
+                                                    for name, gauge in snapshot['queues'].items()))
+
+
+def get_metrics():
+    return _active_metrics.get()
+
+
+@contextmanager
+def run_scope(name, report=True):
+    """
+    在作用域内记录运行指标，结束时打印汇总并合并到外层作用域，
+    如HRW整批的作用域内每个get_img_*调用各有一份汇总，整批再汇总一次
+    :param report: 结束时是否打印汇总
+    """
+    parent = _active_metrics.get()
+    metrics = RunMetrics(name, parent)
+    token = _active_metrics.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _active_metrics.reset(token)
+        metrics.end_time = time.time()
+        if report:
+            metrics.report()
+        if parent is not None:
+            parent.merge(metrics)
+
+
+def report_run(func):
+    """
+    get_img_*的装饰器：每次调用在单独的run_scope中运行，结束时打印本次调用的汇总
+    """
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with run_scope(func.__name__):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def record_request(url, status, latency, nbytes=0):
+    """
+    :param status: HTTP状态码，请求异常时为"error"
+    """
+    metrics = _active_metrics.get()
+    if metrics is not None:
+        metrics.request(source_of(url), status, latency, nbytes)
+
+
+def record_retry(url, count=1):
+    metrics = _active_metrics.get()
+    if metrics is not None:
+        metrics.retry(source_of(url), count)
+
+
+def record_time(stage, seconds):
+    metrics = _active_metrics.get()
+    if metrics is not None:
+        metrics.observe(stage, seconds)
+
+
+def record_queue(name, depth):
+    metrics = _active_metrics.get()
+    if metrics is not None:
+        metrics.queue(name, depth)
+
+
+def record_tile(outcome):
+    metrics = _active_metrics.get()
+    if metrics is not None:
+        metrics.tile(outcome)
+
+
+@contextmanager
+def timed(stage):
+    """
+    记录代码块的耗时，也可以作为函数装饰器使用，如@timed('merge_jpg')
+    """
+    s = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_time(stage, time.perf_counter() - s)
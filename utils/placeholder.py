@@ -0,0 +1,223 @@
+import os
+import json
+import hashlib
+import threading
+import contextvars
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+import cv2
+from utils.url import format_url
+from utils.download import fetch, decode_tile, min_tile_bytes
+from utils.tile_cache import get_cache
+from utils.manifest import NODATA, OVERZOOM
+
+# 见utils.metrics._active_metrics，按线程/协程的上下文隔离
+_active_registry = contextvars.ContextVar('placeholders', default=None)
+# 向上级别补齐时缓存的父瓦片数，相邻的子瓦片共用同一个父瓦片
+parent_cache_size = 64
+
+
+class PlaceholderRegistry(object):
+    """
+    已知占位瓦片(纯色、"无影像"提示等)的指纹库，按数据源记录(字节数, sha1)，只比较原始字节不解码。
+    小于min_tile_bytes的响应总是视为占位瓦片。
+    :param path: 指纹库json文件，存在时加载，save()时写回
+    :param learn_threshold: 大于0时，同一数据源中字节完全相同、不超过learn_max_bytes的响应出现该次数后自动加入指纹库；
+        大片水域等纯色区域的真实瓦片也可能被学到，按需开启
+    :param overzoom: 大于0时，占位瓦片改为从低1~overzoom级的父瓦片中裁剪放大补齐
+    """
+
+    def __init__(self, path=None, learn_threshold=0, learn_max_bytes=8192, overzoom=0):
+        self.path = path
+        self.learn_threshold = learn_threshold
+        self.learn_max_bytes = learn_max_bytes
+        self.overzoom = overzoom
+        self.fingerprints = {}
+        self.sizes = {}
+        self.seen = Counter()
+        self.matched = Counter()
+        self.lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for source, items in json.load(f).items():
+                    for size, digest in items:
+                        self._add(source, (size, digest))
+
+    def _add(self, source, fingerprint):
+        self.fingerprints.setdefault(source, set()).add(fingerprint)
+        self.sizes.setdefault(source, set()).add(fingerprint[0])
+
+    def add(self, source, input_image_data):
+        fingerprint = (len(input_image_data), hashlib.sha1(input_image_data).hexdigest())
+        with self.lock:
+            self._add(source, fingerprint)
+
+    def add_file(self, source, path):
+        with open(path, 'rb') as f:
+            self.add(source, f.read())
+
+    def match(self, source, input_image_data):
+        size = len(input_image_data)
+        if size < min_tile_bytes:
+            self._count(source)
+            return True
+        # 先比较字节数，字节数相同的才计算sha1
+        with self.lock:
+            known_size = size in self.sizes.get(source, ())
+        if not known_size and not (self.learn_threshold and size <= self.learn_max_bytes):
+            return False
+        fingerprint = (size, hashlib.sha1(input_image_data).hexdigest())
+        with self.lock:
+            if fingerprint in self.fingerprints.get(source, ()):
+                self.matched[source] += 1
+                return True
+            if not self.learn_threshold or size > self.learn_max_bytes:
+                return False
+            self.seen[(source,) + fingerprint] += 1
+            if self.seen[(source,) + fingerprint] < self.learn_threshold:
+                return False
+            print(f"learned placeholder tile of {source}: {fingerprint[0]} bytes, sha1={fingerprint[1]}")
+            self._add(source, fingerprint)
+            self.matched[source] += 1
+            return True
+
+    def known(self, source, input_image_data):
+        """
+        是否为已知的占位瓦片，与match相同但不计数、不学习
+        """
+        size = len(input_image_data)
+        if size < min_tile_bytes:
+            return True
+        with self.lock:
+            if size not in self.sizes.get(source, ()):
+                return False
+        fingerprint = (size, hashlib.sha1(input_image_data).hexdigest())
+        with self.lock:
+            return fingerprint in self.fingerprints.get(source, ())
+
+    def _count(self, source):
+        with self.lock:
+            self.matched[source] += 1
+
+    def save(self, path=None):
+        path = path or self.path
+        with self.lock:
+            data = {source: sorted([size, digest] for size, digest in items)
+                    for source, items in self.fingerprints.items()}
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=1)
+
+    def summary(self):
+        with self.lock:
+            return dict(self.matched)
+
+
+class PlaceholderSink(object):
+    """
+    占位瓦片不解码、不写入：后面还有备用数据源时按失败处理交给下一个数据源，
+    否则(可选地从低级别补齐失败后)在清单中记为nodata并按成功返回，输出中该处为nodata；
+    由父瓦片补齐的瓦片在清单中记为OVERZOOM，之后的运行会重新下载；
+    sink支持invalidate时(utils.geotiff_writer.GeoTiffSink)，补齐的瓦片在输出的掩膜中同样标为无效
+    :param final: 是否为最后一个数据源
+    :param policy: 下载父瓦片时使用的utils.policy.AdaptivePolicy，与网格中的其他瓦片相同
+    """
+
+    def __init__(self, sink, registry, datasource, zoom, tileX_tl, tileY_tl, manifest=None, final=True,
+                 policy=None):
+        self.sink = sink
+        self.registry = registry
+        self.datasource = datasource
+        self.zoom = zoom
+        self.tileX_tl = tileX_tl
+        self.tileY_tl = tileY_tl
+        self.manifest = manifest
+        self.final = final
+        self.policy = policy
+        self.stats = Counter()
+        self.parents = OrderedDict()
+        self.lock = threading.Lock()
+
+    def exists(self, x, y):
+        return self.sink.exists(x, y)
+
+    def _parent(self, tileX, tileY, zoom):
+        key = (tileX, tileY, zoom)
+        with self.lock:
+            if key in self.parents:
+                self.parents.move_to_end(key)
+                return self.parents[key]
+        # 与其他瓦片一样先查本地缓存，再按policy、对冲设置请求
+        cache = get_cache()
+        input_image_data = cache.get(self.datasource, zoom, tileX, tileY) if cache is not None else None
+        cached = input_image_data is not None
+        if not cached:
+            url, headers = format_url(self.datasource, tileX, 0, tileY, 0, zoom)
+            input_image_data = fetch(url, headers, self.policy)
+        parent = None
+        if input_image_data is not None and not self.registry.match(self.datasource, input_image_data):
+            parent = decode_tile(input_image_data)
+            if parent is not None and cache is not None and not cached:
+                cache.put(self.datasource, zoom, tileX, tileY, input_image_data)
+        with self.lock:
+            self.parents[key] = parent
+            if len(self.parents) > parent_cache_size:
+                self.parents.popitem(last=False)
+        return parent
+
+    def _overzoom(self, x, y):
+        tileX, tileY = self.tileX_tl + x, self.tileY_tl + y
+        for k in range(1, min(self.registry.overzoom, self.zoom, 8) + 1):
+            parent = self._parent(tileX >> k, tileY >> k, self.zoom - k)
+            if parent is None:
+                continue
+            if parent.ndim == 2:
+                parent = cv2.cvtColor(parent, cv2.COLOR_GRAY2BGR)
+            # 子瓦片在父瓦片中占(256 >> k)像素见方
+            size = 256 >> k
+            ox, oy = (tileX % (1 << k)) * size, (tileY % (1 << k)) * size
+            tile = cv2.resize(parent[oy:oy + size, ox:ox + size, :3], (256, 256), interpolation=cv2.INTER_CUBIC)
+            if self.sink.write(cv2.imencode('.jpg', tile, [cv2.IMWRITE_JPEG_QUALITY, 95])[1].tobytes(), x, y) == 0:
+                return True
+        return False
+
+    def write(self, input_image_data, x, y):
+        if not self.registry.match(self.datasource, input_image_data):
+            return self.sink.write(input_image_data, x, y)
+        if not self.final:
+            return -1
+        if self.registry.overzoom and self._overzoom(x, y):
+            self._count('overzoom')
+            if self.manifest is not None:
+                self.manifest.mark(x, y, OVERZOOM)
+            # 没有清单时直接告知sink，输出的掩膜中与真实影像区分
+            if hasattr(self.sink, 'invalidate'):
+                self.sink.invalidate(x, y)
+            return 0
+        self._count('nodata')
+        if self.manifest is not None:
+            self.manifest.mark(x, y, NODATA)
+        return 0
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def close(self):
+        self.sink.close()
+
+
+def get_placeholders():
+    return _active_registry.get()
+
+
+@contextmanager
+def placeholder_scope(registry):
+    """
+    在作用域内所有下载路径都先按registry识别占位瓦片
+    :param registry: PlaceholderRegistry，为None时不启用
+    """
+    token = _active_registry.set(registry)
+    try:
+        yield registry
+    finally:
+        _active_registry.reset(token)
@@ -0,0 +1,180 @@
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+# 视为限流/过载的状态码，触发并发数乘性减小
+throttle_status = (429, 503, 509)
+
+
+def _percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[int(q * (len(ordered) - 1))]
+
+
+def _set_ready(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class HostController(object):
+    """
+    单个瓦片主机的自适应控制：
+    - 并发数按AIMD调整：成功且延迟正常时加性增加，限流/错误/延迟突增时乘性减小
+    - 超时时间由观测到的延迟分位数推算
+    线程通过acquire等待名额，协程通过acquire_async等待，两者共用同一个并发计数
+    """
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.limit = float(policy.initial_concurrency)
+        self.inflight = 0
+        self.latencies = deque(maxlen=policy.window)
+        self.last_decrease = 0.0
+        self.cond = threading.Condition()
+        # 等待名额的协程，(事件循环, future)
+        self.async_waiters = deque()
+
+    def acquire(self):
+        with self.cond:
+            while self.inflight >= max(1, int(self.limit)):
+                self.cond.wait()
+            self.inflight += 1
+
+    async def acquire_async(self):
+        """
+        名额不足时挂起，直到有请求release或并发上限提高时被唤醒，不轮询
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.cond:
+                if self.inflight < max(1, int(self.limit)):
+                    self.inflight += 1
+                    return
+                waiter = (loop, loop.create_future())
+                self.async_waiters.append(waiter)
+            try:
+                await waiter[1]
+            except asyncio.CancelledError:
+                with self.cond:
+                    if waiter in self.async_waiters:
+                        self.async_waiters.remove(waiter)
+                    else:
+                        # 已被唤醒但不再需要名额，转交给下一个等待者
+                        self._wake_async()
+                raise
+
+    def _wake_async(self):
+        # 调用时持有self.cond；按空出的名额唤醒等待的协程，可能由其他线程调用
+        free = max(1, int(self.limit)) - self.inflight
+        while free > 0 and self.async_waiters:
+            loop, future = self.async_waiters.popleft()
+            loop.call_soon_threadsafe(_set_ready, future)
+            free -= 1
+
+    def release(self):
+        with self.cond:
+            self.inflight -= 1
+            self.cond.notify_all()
+            self._wake_async()
+
+    def timeout(self):
+        policy = self.policy
+        with self.cond:
+            if len(self.latencies) < policy.min_samples:
+                return policy.initial_timeout
+            t = _percentile(self.latencies, policy.timeout_percentile) * policy.timeout_factor
+        return min(policy.max_timeout, max(policy.min_timeout, t))
+
+    def _decrease(self):
+        # 一个冷却期内只减一次，避免同一批失败把并发数压到底
+        now = time.time()
+        if now - self.last_decrease < self.policy.decrease_cooldown:
+            return
+        self.last_decrease = now
+        self.limit = max(self.policy.min_concurrency, self.limit * self.policy.decrease_factor)
+
+    def on_success(self, latency):
+        policy = self.policy
+        with self.cond:
+            slow = (len(self.latencies) >= policy.min_samples and
+                    latency > _percentile(self.latencies, 0.5) * policy.slow_factor)
+            self.latencies.append(latency)
+            if slow:
+                self._decrease()
+            else:
+                self.limit = min(policy.max_concurrency, self.limit + 1.0 / self.limit)
+            self.cond.notify_all()
+            self._wake_async()
+
+    def on_failure(self, status=None):
+        with self.cond:
+            # status为None表示超时或连接错误
+            if status is None or status in throttle_status or status >= 500:
+                self._decrease()
+            self.cond.notify_all()
+
+
+class AdaptivePolicy(object):
+    """
+    下载策略对象，按主机维护HostController，传给get_img_*的policy参数即可启用。
+    启用后每个瓦片每轮只请求一次，失败的瓦片推迟到整个网格之后，
+    按带抖动的指数退避最多重试retry_limit轮。
+    同一个策略对象可以在多次下载之间复用，已学到的并发数和延迟会被保留。
+    """
+
+    def __init__(self,
+                 max_concurrency=8,
+                 min_concurrency=1,
+                 initial_concurrency=None,
+                 decrease_factor=0.5,
+                 decrease_cooldown=1.0,
+                 slow_factor=3.0,
+                 initial_timeout=2.0,
+                 min_timeout=0.5,
+                 max_timeout=10.0,
+                 timeout_percentile=0.99,
+                 timeout_factor=2.0,
+                 window=200,
+                 min_samples=20,
+                 retry_limit=3,
+                 backoff_base=0.5,
+                 backoff_max=30.0):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.initial_concurrency = initial_concurrency or max(min_concurrency, max_concurrency // 2)
+        self.decrease_factor = decrease_factor
+        self.decrease_cooldown = decrease_cooldown
+        self.slow_factor = slow_factor
+        self.initial_timeout = initial_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.timeout_percentile = timeout_percentile
+        self.timeout_factor = timeout_factor
+        self.window = window
+        self.min_samples = min_samples
+        self.retry_limit = retry_limit
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._controllers = {}
+        self._lock = threading.Lock()
+
+    def controller(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._controllers:
+                self._controllers[host] = HostController(self)
+            return self._controllers[host]
+
+    def backoff(self, attempt):
+        # 指数退避，在[delay/2, delay]之间随机抖动
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        return random.uniform(delay / 2, delay)
+
+    def summary(self):
+        with self._lock:
+            controllers = dict(self._controllers)
+        return {host: {'concurrency': int(c.limit), 'timeout': round(c.timeout(), 3)}
+                for host, c in controllers.items()}
@@ -0,0 +1,56 @@
+import threading
+from contextlib import contextmanager
+import requests
+from requests.adapters import HTTPAdapter
+
+# 瓦片服务的主机数: mt0-3, ecn.t0-3, t1-4, server.arcgisonline.com
+pool_connections = 16
+default_pool_maxsize = 8
+
+_lock = threading.Lock()
+_session = None
+_scope_depth = 0
+
+
+def _new_session(pool_maxsize):
+    session = requests.Session()
+    # 每个主机一个连接池，池大小与下载线程数一致，连接在请求之间复用(keep-alive)
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=max(1, int(pool_maxsize)), max_retries=0)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    """
+    返回当前共享的Session，不在session_scope内时惰性创建一个默认Session
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            _session = _new_session(default_pool_maxsize)
+        return _session
+
+
+@contextmanager
+def session_scope(nproc=default_pool_maxsize):
+    """
+    在整个get_img_*调用或一批下载期间保持同一个Session，嵌套使用时复用最外层的Session
+    :param nproc: 下载线程数，决定每个主机连接池的大小
+    """
+    global _session, _scope_depth
+    with _lock:
+        if _scope_depth == 0:
+            if _session is not None:
+                _session.close()
+            _session = _new_session(nproc)
+        _scope_depth += 1
+        session = _session
+    try:
+        yield session
+    finally:
+        with _lock:
+            _scope_depth -= 1
+            if _scope_depth == 0:
+                _session.close()
+                _session = None
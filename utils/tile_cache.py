@@ -0,0 +1,161 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# 每写入多少个瓦片检查一次容量
+evict_interval = 256
+# 超出容量时清理到容量的这个比例，避免频繁触发
+evict_ratio = 0.9
+
+# 见utils.metrics._active_metrics，按线程/协程的上下文隔离
+_active_cache = contextvars.ContextVar('tile_cache', default=None)
+
+
+class TileCache(object):
+    """
+    本地持久瓦片缓存，按(source, zoom, x, y)索引，瓦片内容按sha1存储(相同内容只存一份)。
+    索引保存在sqlite中，多个进程可同时读写同一个缓存目录；
+    总字节数超过max_bytes时按最近访问时间(LRU)淘汰。
+    """
+
+    def __init__(self, cache_dir, max_bytes=20 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.objects_dir = os.path.join(cache_dir, 'objects')
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._puts = 0
+        self._conn = sqlite3.connect(os.path.join(cache_dir, 'index.sqlite'), timeout=60,
+                                     check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS tiles (source TEXT, zoom INTEGER, x INTEGER, y INTEGER, '
+                               'hash TEXT, atime REAL, PRIMARY KEY (source, zoom, x, y))')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, size INTEGER)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS tiles_atime ON tiles (atime)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS tiles_hash ON tiles (hash)')
+
+    def _blob_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def get(self, source, zoom, x, y):
+        with self._lock:
+            row = self._conn.execute('SELECT hash FROM tiles WHERE source=? AND zoom=? AND x=? AND y=?',
+                                     (source, zoom, x, y)).fetchone()
+        if row is None:
+            return None
+        try:
+            with open(self._blob_path(row[0]), 'rb') as f:
+                data = f.read()
+        except OSError:
+            # 文件已被其他进程淘汰，视为未命中；引用该文件的索引都已失效，与blobs中的记录一起删除
+            with self._lock:
+                self._conn.execute('BEGIN IMMEDIATE')
+                try:
+                    self._conn.execute('DELETE FROM tiles WHERE hash=?', (row[0],))
+                    self._conn.execute('DELETE FROM blobs WHERE hash=?', (row[0],))
+                    self._conn.execute('COMMIT')
+                except Exception:
+                    self._conn.execute('ROLLBACK')
+                    raise
+            return None
+        with self._lock:
+            self._conn.execute('UPDATE tiles SET atime=? WHERE source=? AND zoom=? AND x=? AND y=?',
+                               (time.time(), source, zoom, x, y))
+        return data
+
+    def put(self, source, zoom, x, y, data):
+        digest = hashlib.sha1(data).hexdigest()
+        path = self._blob_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 先写临时文件再改名，其他进程不会读到半个文件
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.execute('INSERT OR IGNORE INTO blobs (hash, size) VALUES (?, ?)', (digest, len(data)))
+                self._conn.execute('INSERT OR REPLACE INTO tiles (source, zoom, x, y, hash, atime) '
+                                   'VALUES (?, ?, ?, ?, ?, ?)', (source, zoom, x, y, digest, time.time()))
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._puts += 1
+            need_evict = self._puts % evict_interval == 0
+        if need_evict:
+            self.evict()
+
+    def size(self):
+        with self._lock:
+            return self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+
+    def evict(self):
+        """
+        总字节数超过max_bytes时，按最近访问时间淘汰瓦片，直到低于max_bytes*evict_ratio
+        """
+        removed = []
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                total = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+                target = self.max_bytes * evict_ratio
+                if total <= self.max_bytes:
+                    target = total
+                while total > target:
+                    rows = self._conn.execute('SELECT source, zoom, x, y, hash FROM tiles '
+                                              'ORDER BY atime LIMIT 1000').fetchall()
+                    if not rows:
+                        break
+                    self._conn.executemany('DELETE FROM tiles WHERE source=? AND zoom=? AND x=? AND y=?',
+                                           [row[:4] for row in rows])
+                    # 只检查本轮释放的内容是否还有其他瓦片引用(走tiles_hash索引)，不扫描整个blobs表
+                    orphans = []
+                    for h in set(row[4] for row in rows):
+                        if self._conn.execute('SELECT 1 FROM tiles WHERE hash=? LIMIT 1', (h,)).fetchone() is None:
+                            orphans.append(h)
+                    for h in orphans:
+                        size = self._conn.execute('SELECT size FROM blobs WHERE hash=?', (h,)).fetchone()
+                        if size is not None:
+                            total -= size[0]
+                    self._conn.executemany('DELETE FROM blobs WHERE hash=?', [(h,) for h in orphans])
+                    removed.extend(orphans)
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        for digest in removed:
+            try:
+                os.remove(self._blob_path(digest))
+            except OSError:
+                pass
+        return len(removed)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def get_cache():
+    return _active_cache.get()
+
+
+@contextmanager
+def cache_scope(cache):
+    """
+    在作用域内所有下载路径都先查询cache，命中则不再请求网络
+    :param cache: TileCache，为None时不启用缓存
+    """
+    token = _active_cache.set(cache)
+    try:
+        yield cache
+    finally:
+        _active_cache.reset(token)
@@ -0,0 +1,208 @@
+import os
+import time
+from collections import Counter
+import numpy as np
+from tqdm import tqdm
+from utils.url import format_url
+from utils.download import download_tile
+from utils.session import session_scope
+from utils.concurrent_helper import run_with_concurrent
+from utils.canvas import new_canvas
+from utils.decode_pool import open_canvas_sink
+from utils.manifest import JobManifest, ManifestSink
+from utils.placeholder import PlaceholderSink, get_placeholders
+from utils.metrics import record_retry
+
+supported_engine = ['thread', 'async']
+
+
+def _skip(x, y, manifest, tile_mask):
+    if tile_mask is not None and not tile_mask[x, y]:
+        return True
+    return manifest is not None and manifest.is_done(x, y)
+
+
+def _iter_tasks(datasource, tileX_tl, tileY_tl, nX, nY, zoom, manifest=None, tile_mask=None):
+    for x in range(nX):
+        for y in range(nY):
+            if _skip(x, y, manifest, tile_mask):
+                continue
+            url, headers = format_url(datasource, tileX_tl, x, tileY_tl, y, zoom)
+            yield url, headers, x, y, (datasource, zoom, tileX_tl + x, tileY_tl + y)
+
+
+def _retry_deferred(retry_list, policy, max_failures, run):
+    # 失败的瓦片推迟到整个网格之后，按带抖动的指数退避分轮重试
+    for attempt in range(policy.retry_limit):
+        if not retry_list:
+            break
+        time.sleep(policy.backoff(attempt))
+        print(f"Retrying {len(retry_list)} failed tiles, attempt {attempt + 1}/{policy.retry_limit}...")
+        for task in retry_list:
+            record_retry(task[0])
+        retry_list = run(retry_list)
+    return len(retry_list) < max_failures
+
+
+def _run_tile_tasks(task_list, nproc):
+    status = run_with_concurrent(download_tile, task_list, "thread", min(nproc, len(task_list)))
+    return [task_list[i] for i in range(len(status)) if status[i] != 0]
+
+
+def _download_grid_thread(sink, datasource, tileX_tl, tileY_tl, nX, nY, zoom, nproc, pbar, policy, manifest,
+                          tile_mask, max_failures):
+    failure_count = 0
+    retry_list = []
+    for x in range(nX):
+        task_list = []
+        for y in range(nY):
+            # 范围外以及清单中已完成的瓦片不再派发
+            if _skip(x, y, manifest, tile_mask):
+                continue
+            url, headers = format_url(datasource, tileX_tl, x, tileY_tl, y, zoom)
+            key = (datasource, zoom, tileX_tl + x, tileY_tl + y)
+            task_list.append([url, headers, x, y, sink, pbar, policy, key])
+        # 多线程并发
+        failed = _run_tile_tasks(task_list, nproc)
+        retry_list.extend(failed)
+        failure_count += len(failed)
+        # 使用policy时失败瓦片会在最后重试，不在中途放弃
+        if policy is None and failure_count >= max_failures:
+            return False
+    if policy is not None:
+        return _retry_deferred(retry_list, policy, max_failures, lambda tasks: _run_tile_tasks(tasks, nproc))
+    status = run_with_concurrent(download_tile, retry_list, "thread", min(nproc, len(retry_list)))
+    return True
+
+
+def _download_grid_async(sink, datasource, tileX_tl, tileY_tl, nX, nY, zoom, nproc, pbar, policy, manifest,
+                         tile_mask, max_failures):
+    from utils.async_download import download_tiles_async
+
+    tasks = _iter_tasks(datasource, tileX_tl, tileY_tl, nX, nY, zoom, manifest, tile_mask)
+    if policy is not None:
+        retry_list = download_tiles_async(tasks, sink, pbar, nproc, policy=policy)
+        return _retry_deferred(retry_list, policy, max_failures,
+                               lambda tasks: download_tiles_async(tasks, sink, pbar, nproc, policy=policy))
+    retry_list = download_tiles_async(tasks, sink, pbar, nproc, max_failures=max_failures)
+    if len(retry_list) >= max_failures:
+        return False
+    download_tiles_async(retry_list, sink, pbar, nproc)
+    return True
+
+
+def download_grid(sink, datasource, tileX_tl, tileY_tl, nX, nY, zoom, nproc=8, engine='thread', policy=None,
+                  manifest=None, tile_mask=None, batch=None, fallback=None):
+    """
+    下载以(tileX_tl, tileY_tl)为左上角、nX*nY个瓦片的网格并写入sink
+    :param sink: 瓦片写入目标，见utils.download中的*Sink
+    :param engine: "thread" 逐列使用线程池并发；"async" 在整个网格上用asyncio保持数百个请求在途(需安装aiohttp)
+    :param policy: utils.policy.AdaptivePolicy，按主机自适应调整并发、超时和重试退避，为None时使用固定的重试次数和超时
+    :param manifest: utils.manifest.JobManifest，记录每个瓦片的完成状态，只下载未完成的瓦片
+    :param tile_mask: (nX, nY)的bool数组，只下载为True的瓦片，见utils.aoi.covering_tiles
+    :param batch: utils.batch_plan.BatchPlan.job(i)，批量下载时与其他位置共享重叠的瓦片，每个瓦片只请求一次
+    :param fallback: utils.failover.SourceChain，datasource下载失败或返回空白的瓦片依次由后面的数据源补齐，
+        并记录每个瓦片的来源
+    :return: 失败瓦片达到10%时返回False
+    """
+    if engine not in supported_engine:
+        raise ValueError("unknow download engine, {}".format(engine))
+    if batch is not None:
+        batch.check(datasource, tileX_tl, tileY_tl, nX, nY, zoom)
+
+    total = nX * nY if tile_mask is None else int(np.count_nonzero(tile_mask))
+    initial = 0
+    if manifest is not None:
+        sink = ManifestSink(sink, manifest)
+        done = manifest.done_mask()
+        initial = int(np.count_nonzero(done if tile_mask is None else done & tile_mask))
+        if initial:
+            print(f"Resume job, {initial}/{total} tiles already done")
+    if fallback is not None:
+        fallback.start(datasource, zoom, nX, nY, manifest)
+    registry = get_placeholders()
+    placeholder_sinks = []
+
+    def pass_sink(source, index):
+        # 每一轮(数据源)的写入链：占位瓦片识别 -> 批量共享 -> 来源记录
+        s = sink
+        if registry is not None:
+            final = fallback is None or index == len(fallback.sources) - 1
+            s = PlaceholderSink(s, registry, source, zoom, tileX_tl, tileY_tl, manifest, final, policy)
+            placeholder_sinks.append(s)
+        if batch is not None:
+            s = batch.wrap(s)
+        if fallback is not None:
+            s = fallback.wrap(s, index)
+        return s
+
+    run = _download_grid_async if engine == 'async' else _download_grid_thread
+    try:
+        with session_scope(nproc):
+            with tqdm(total=total, initial=initial) as pbar:
+                if fallback is None:
+                    return run(pass_sink(datasource, 0), datasource, tileX_tl, tileY_tl, nX, nY, zoom, nproc, pbar,
+                               policy, manifest, tile_mask, total / 10)
+                # 有备用数据源时不在中途放弃，失败的瓦片依次换下一个数据源重新下载
+                run(pass_sink(datasource, 0), datasource, tileX_tl, tileY_tl, nX, nY, zoom, nproc, pbar,
+                    policy, manifest, tile_mask, float('inf'))
+                for index in range(1, len(fallback.sources)):
+                    missing = fallback.missing(tile_mask)
+                    count = int(np.count_nonzero(missing))
+                    if count == 0:
+                        break
+                    print(f"{count} tiles missing, fall back to {fallback.sources[index]}")
+                    pbar.total += count
+                    run(pass_sink(fallback.sources[index], index), fallback.sources[index], tileX_tl, tileY_tl,
+                        nX, nY, zoom, nproc, pbar, policy, None, missing, float('inf'))
+                fallback.report()
+                return np.count_nonzero(fallback.missing(tile_mask)) < total / 10
+    finally:
+        if manifest is not None:
+            manifest.flush()
+        if batch is not None:
+            batch.release()
+        if placeholder_sinks:
+            stats = sum((s.stats for s in placeholder_sinks), Counter())
+            if stats:
+                print(f"placeholder tiles: nodata={stats['nodata']}, from lower zoom={stats['overzoom']}")
+
+
+def download_canvas(datasource, tileX_tl, tileY_tl, nX, nY, zoom, nproc=8, engine='thread', policy=None,
+                    memmap_dir=None, out=None, decode_workers=0, job=None, tile_mask=None, batch=None,
+                    fallback=None):
+    """
+    下载网格到nY*256 x nX*256 x 3的画布，参数见utils.canvas.new_canvas和download_grid
+    :param job: 任务文件路径前缀，指定时画布保存在{job}.canvas、进度保存在{job}.manifest，
+        中断或失败后以相同参数重新运行只下载缺失的瓦片，完成后删除这两个文件
+    :param tile_mask: 只下载为True的瓦片，其余位置保持为0
+    :param batch: 见download_grid
+    :param fallback: 见download_grid
+    :return: 画布，失败瓦片达到10%时返回None
+    """
+    manifest = None
+    memmap_path = None
+    if job is not None:
+        memmap_path = job + '.canvas'
+        manifest = JobManifest(job + '.manifest', datasource, zoom, tileX_tl, tileY_tl, nX, nY)
+    canvas = new_canvas(nX, nY, memmap_dir, out, shared=decode_workers > 0, memmap_path=memmap_path)
+
+    sink = open_canvas_sink(canvas, decode_workers)
+    try:
+        success = download_grid(sink, datasource, tileX_tl, tileY_tl, nX, nY, zoom, nproc,
+                                engine=engine, policy=policy, manifest=manifest, tile_mask=tile_mask, batch=batch,
+                                fallback=fallback)
+    finally:
+        sink.close()
+        if manifest is not None:
+            manifest.close()
+    if not success:
+        return None
+    if job is not None:
+        # 任务完成，结果读入内存后删除任务文件
+        result = np.array(canvas)
+        del canvas
+        os.remove(memmap_path)
+        os.remove(manifest.path)
+        return result
+    return canvas
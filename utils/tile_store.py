@@ -0,0 +1,201 @@
+import os
+import sqlite3
+import hashlib
+import threading
+from utils import tile_utils
+from utils.download import check_tile, decode_tile, TmpdirSink
+
+# 每积累多少个瓦片提交一次事务
+batch_size = 512
+
+
+class MBTilesStore(object):
+    """
+    单文件的瓦片存储(MBTiles格式，sqlite)，用于替代每个瓦片一个文件的临时目录。
+    - 使用MBTiles的去重表结构(map + images)，内容相同的瓦片(海洋、无影像占位图)只存一份
+    - 写入按batch_size批量提交事务
+    - 对外接口使用相对于左上角瓦片(tileX_tl, tileY_tl)的x, y，与临时目录中的{x}_{y}.jpg一致，
+      左上角和网格大小写在metadata中，合并时可直接打开已有文件
+    同时实现了exists/write接口，可以直接作为download_grid的sink。
+    """
+
+    def __init__(self, path, zoom=None, tileX_tl=None, tileY_tl=None, nX=None, nY=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._pending = []
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS map (zoom_level INTEGER, tile_column INTEGER, '
+                               'tile_row INTEGER, tile_id TEXT, PRIMARY KEY (zoom_level, tile_column, tile_row))')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS images (tile_id TEXT PRIMARY KEY, tile_data BLOB)')
+            self._conn.execute('CREATE VIEW IF NOT EXISTS tiles AS SELECT map.zoom_level AS zoom_level, '
+                               'map.tile_column AS tile_column, map.tile_row AS tile_row, '
+                               'images.tile_data AS tile_data FROM map JOIN images ON map.tile_id = images.tile_id')
+            self._conn.commit()
+            metadata = dict(self._conn.execute('SELECT name, value FROM metadata').fetchall())
+
+        if 'origin_x' in metadata:
+            stored = (int(metadata['maxzoom']), int(metadata['origin_x']), int(metadata['origin_y']),
+                      int(metadata['grid_width']), int(metadata['grid_height']))
+            if zoom is not None and stored != (zoom, tileX_tl, tileY_tl, nX, nY):
+                raise ValueError("tile store {} was created for another grid {}".format(path, stored))
+            zoom, tileX_tl, tileY_tl, nX, nY = stored
+        elif zoom is None:
+            raise ValueError("tile store {} has no grid metadata".format(path))
+        else:
+            self._write_metadata(zoom, tileX_tl, tileY_tl, nX, nY)
+
+        self.zoom = zoom
+        self.tileX_tl = tileX_tl
+        self.tileY_tl = tileY_tl
+        self.nX = nX
+        self.nY = nY
+        # 已有瓦片的坐标一次性读入内存，断点续传时不必逐个查询
+        with self._lock:
+            rows = self._conn.execute('SELECT tile_column, tile_row FROM map WHERE zoom_level=?', (zoom,)).fetchall()
+        self._existing = set(self._to_xy(col, row) for col, row in rows)
+
+    def _write_metadata(self, zoom, tileX_tl, tileY_tl, nX, nY):
+        lng_l, lat_t = tile_utils.tileToLnglat(tileX_tl, tileY_tl, zoom)
+        lng_r, lat_b = tile_utils.tileToLnglat(tileX_tl + nX, tileY_tl + nY, zoom)
+        metadata = {
+            'name': os.path.splitext(os.path.basename(self.path))[0],
+            'format': 'jpg',
+            'type': 'baselayer',
+            'version': '1.1',
+            'bounds': f"{lng_l},{lat_b},{lng_r},{lat_t}",
+            'minzoom': zoom,
+            'maxzoom': zoom,
+            'origin_x': tileX_tl,
+            'origin_y': tileY_tl,
+            'grid_width': nX,
+            'grid_height': nY,
+        }
+        with self._lock:
+            self._conn.executemany('INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)',
+                                   [(k, str(v)) for k, v in metadata.items()])
+            self._conn.commit()
+
+    # MBTiles使用TMS坐标，行号从南往北
+    def _to_col_row(self, x, y):
+        return self.tileX_tl + x, (1 << self.zoom) - 1 - (self.tileY_tl + y)
+
+    def _to_xy(self, col, row):
+        return col - self.tileX_tl, (1 << self.zoom) - 1 - row - self.tileY_tl
+
+    def exists(self, x, y):
+        return (x, y) in self._existing
+
+    def put(self, x, y, input_image_data):
+        tile_id = hashlib.sha1(input_image_data).hexdigest()
+        col, row = self._to_col_row(x, y)
+        with self._lock:
+            self._pending.append((self.zoom, col, row, tile_id, input_image_data))
+            self._existing.add((x, y))
+            if len(self._pending) >= batch_size:
+                self._flush_locked()
+
+    def write(self, input_image_data, x, y):
+        try:
+            # 快速检查通不过时再尝试解码，能正常解码才入库
+            if not check_tile(input_image_data) and decode_tile(input_image_data) is None:
+                raise ValueError("invalid tile data at ({}, {})".format(x, y))
+            self.put(x, y, input_image_data)
+        except Exception as e:
+            print(str(e))
+            return -1
+        return 0
+
+    def _flush_locked(self):
+        if not self._pending:
+            return
+        self._conn.executemany('INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)',
+                               [(p[3], sqlite3.Binary(p[4])) for p in self._pending])
+        self._conn.executemany('INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) '
+                               'VALUES (?, ?, ?, ?)', [p[:4] for p in self._pending])
+        self._conn.commit()
+        self._pending = []
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def get(self, x, y):
+        col, row = self._to_col_row(x, y)
+        self.flush()
+        with self._lock:
+            r = self._conn.execute('SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                                   (self.zoom, col, row)).fetchone()
+        return None if r is None else bytes(r[0])
+
+    def iter_tiles(self, start_x=0, end_x=None, start_y=0, end_y=None):
+        """
+        一次查询取出[start_x, end_x) x [start_y, end_y)范围内的瓦片，返回(x, y, 瓦片字节)
+        """
+        end_x = self.nX if end_x is None else end_x
+        end_y = self.nY if end_y is None else end_y
+        col_0, row_1 = self._to_col_row(start_x, start_y)
+        col_1, row_0 = self._to_col_row(end_x - 1, end_y - 1)
+        self.flush()
+        # 单独的只读连接逐行读取，整个文件的瓦片不会一次性进内存
+        conn = sqlite3.connect(self.path, timeout=60)
+        try:
+            rows = conn.execute('SELECT tile_column, tile_row, tile_data FROM tiles WHERE zoom_level=? '
+                                'AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?',
+                                (self.zoom, col_0, col_1, row_0, row_1))
+            for col, row, data in rows:
+                x, y = self._to_xy(col, row)
+                yield x, y, bytes(data)
+        finally:
+            conn.close()
+
+    def count(self):
+        return len(self._existing)
+
+    def tiles(self):
+        return list(self._existing)
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._conn.close()
+
+    def remove(self):
+        self.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+
+supported_spool = ['dir', 'mbtiles']
+
+
+def open_spool(tiff_filename, spool, zoom, tileX_tl, tileY_tl, nX, nY):
+    """
+    打开tiff_filename对应的瓦片暂存位置
+    :param spool: "dir" 与tiff同名的临时目录，每个瓦片一个{x}_{y}.jpg；"mbtiles" 与tiff同名的单个.mbtiles文件
+    :return: TmpdirSink或MBTilesStore
+    """
+    if spool not in supported_spool:
+        raise ValueError("unknow spool type, {}".format(spool))
+    tmpdir = os.path.join(os.path.dirname(tiff_filename), os.path.basename(tiff_filename).split('.')[0])
+    if spool == 'mbtiles':
+        return MBTilesStore(tmpdir + '.mbtiles', zoom, tileX_tl, tileY_tl, nX, nY)
+    os.makedirs(tmpdir, exist_ok=True)
+    return TmpdirSink(tmpdir)
+
+
+def open_tile_source(tmpdir):
+    """
+    瓦片来源可以是临时目录、TmpdirSink或.mbtiles文件，后者返回MBTilesStore
+    """
+    if isinstance(tmpdir, MBTilesStore):
+        return tmpdir
+    if isinstance(tmpdir, TmpdirSink):
+        return tmpdir.tmpdir
+    if isinstance(tmpdir, str) and tmpdir.endswith('.mbtiles'):
+        return MBTilesStore(tmpdir)
+    return tmpdir
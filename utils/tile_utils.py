@@ -1,4 +1,5 @@
 import math
+import numpy as np
 
 
 # 像素分辨率
@@ -6,54 +7,105 @@ def getResolution(level):
     return 156543.03 * math.pow(2, -level)
 
 
+# 以下*Array函数接受标量或任意形状的数组(经纬度、瓦片号可广播)，返回同形状的numpy数组；
+# 同名的标量函数是对应数组函数的简单包装(TileXYToQuadKey除外)
+
+
 # 经纬度转瓦片
-def lnglatToTile(lng, lat, level):
-    tileX = int((lng + 180) / 360 * math.pow(2, level))
-    tileY = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) * math.pow(2, level - 1))
+def lnglatToTileArray(lng, lat, level):
+    lng = np.asarray(lng, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    n = 2.0 ** level
+    # astype向零取整，与int()一致
+    tileX = ((lng + 180) / 360 * n).astype(np.int64)
+    tileY = ((1 - np.arcsinh(np.tan(np.radians(lat))) / np.pi) * (n / 2)).astype(np.int64)
     return tileX, tileY
 
 
+def lnglatToTile(lng, lat, level):
+    tileX, tileY = lnglatToTileArray(lng, lat, level)
+    return int(tileX), int(tileY)
+
+
 # 瓦片转经纬度
-def tileToLnglat(tileX, tileY, level):
-    # level -= 1
-    lng = tileX / math.pow(2, level) * 360 - 180
-    lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * tileY / math.pow(2, level)))))
+def tileToLnglatArray(tileX, tileY, level):
+    n = 2.0 ** level
+    lng = np.asarray(tileX, dtype=np.float64) / n * 360 - 180
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * np.asarray(tileY, dtype=np.float64) / n))))
     return lng, lat
 
 
+def tileToLnglat(tileX, tileY, level):
+    lng, lat = tileToLnglatArray(tileX, tileY, level)
+    return float(lng), float(lat)
+
+
 # 经纬度转像素
-def lnglatToPixel(lng, lat, level):
-    pixelX = round((lng + 180) / 360 * math.pow(2, level) * 256 % 256)
-    pixelY = round(
-        (1 - math.log(math.tan(math.radians(lat)) + 1 / math.cos(math.radians(lat))) / (2 * math.pi)) * math.pow(2,
-                                                                                                                 level) * 256 % 256)
+def lnglatToPixelArray(lng, lat, level):
+    lng = np.asarray(lng, dtype=np.float64)
+    rlat = np.radians(np.asarray(lat, dtype=np.float64))
+    n = 2.0 ** level
+    # np.round与round()一样四舍六入五成双
+    pixelX = np.round((lng + 180) / 360 * n * 256 % 256).astype(np.int64)
+    pixelY = np.round((1 - np.log(np.tan(rlat) + 1 / np.cos(rlat)) / (2 * np.pi)) * n * 256 % 256).astype(np.int64)
     return pixelX, pixelY
 
 
+def lnglatToPixel(lng, lat, level):
+    pixelX, pixelY = lnglatToPixelArray(lng, lat, level)
+    return int(pixelX), int(pixelY)
+
+
 # 瓦片和像素转经纬度
-def pixelToLnglat(tileX, tileY, pixelX, pixelY, level):
-    lng = (tileX + pixelX / 256) / math.pow(2, level) * 360 - 180
-    lat = math.degrees(math.atan(math.sinh(math.pi - 2 * math.pi * (tileY + pixelY / 256) / math.pow(2, level))))
+def pixelToLnglatArray(tileX, tileY, pixelX, pixelY, level):
+    n = 2.0 ** level
+    x = np.asarray(tileX, dtype=np.float64) + np.asarray(pixelX, dtype=np.float64) / 256
+    y = np.asarray(tileY, dtype=np.float64) + np.asarray(pixelY, dtype=np.float64) / 256
+    lng = x / n * 360 - 180
+    lat = np.degrees(np.arctan(np.sinh(np.pi - 2 * np.pi * y / n)))
     return lng, lat
 
 
-# bing瓦片坐标转换
+def pixelToLnglat(tileX, tileY, pixelX, pixelY, level):
+    lng, lat = pixelToLnglatArray(tileX, tileY, pixelX, pixelY, level)
+    return float(lng), float(lat)
+
+
+# bing瓦片坐标转换，每一级取tileX、tileY的一位拼成一个字符
+def TileXYToQuadKeyArray(tileX, tileY, level):
+    tileX, tileY = np.broadcast_arrays(np.asarray(tileX, dtype=np.int64), np.asarray(tileY, dtype=np.int64))
+    if level == 0:
+        return np.full(tileX.shape, '', dtype='U1')
+    shifts = np.arange(level - 1, -1, -1, dtype=np.int64)
+    digits = ord('0') + ((tileX[..., None] >> shifts) & 1) + 2 * ((tileY[..., None] >> shifts) & 1)
+    # 每行level个ASCII字节直接看作一个定长字符串
+    quadKeys = np.ascontiguousarray(digits, dtype=np.uint8).view(f'S{level}')[..., 0]
+    return quadKeys.astype(f'U{level}')
+
+
+# 下载时每个瓦片调用一次，单个瓦片不经过numpy，纯Python更快
 def TileXYToQuadKey(tileX, tileY, level):
-    quadKey = ''
-    for l in range(level):
-        i = level - l
-        digit = ord('0')
-        mask = 1 << (i - 1)
-        if (tileX & mask) != 0:
-            digit += 1
-        if (tileY & mask) != 0:
-            digit += 2
-        quadKey += chr(digit)
-    return quadKey
+    return ''.join(['0123'[((tileX >> i) & 1) | (((tileY >> i) & 1) << 1)] for i in range(level - 1, -1, -1)])
+
+
+# 整个网格的quadkey，返回形状为(nX, nY)的数组，[x, y]对应瓦片(tileX_tl + x, tileY_tl + y)
+def quadKeysForRange(tileX_tl, tileY_tl, nX, nY, level):
+    tileX = np.arange(tileX_tl, tileX_tl + nX, dtype=np.int64)[:, None]
+    tileY = np.arange(tileY_tl, tileY_tl + nY, dtype=np.int64)[None, :]
+    return TileXYToQuadKeyArray(tileX, tileY, level)
 
 
 def getGeoTransform(tileX_tl, tileY_tl, nX, nY, level):
-    lng_lt, lat_lt = tileToLnglat(tileX_tl, tileY_tl, level)
-    lng_rb, lat_rb = tileToLnglat(tileX_tl + nX, tileY_tl + nY, level)
+    lng, lat = tileToLnglatArray([tileX_tl, tileX_tl + nX], [tileY_tl, tileY_tl + nY], level)
+    lng_lt, lng_rb = float(lng[0]), float(lng[1])
+    lat_lt, lat_rb = float(lat[0]), float(lat[1])
     geoTransform = (lng_lt, (lng_rb - lng_lt) / (nX * 256), 0, lat_lt, 0, (lat_rb - lat_lt) / (nY * 256))
     return geoTransform
+
+
+# Web墨卡托(EPSG:3857)下的仿射变换，瓦片本身就是该投影下的规则网格
+def getMercatorGeoTransform(tileX_tl, tileY_tl, level):
+    origin = 20037508.342789244
+    res = 2 * origin / (256 * math.pow(2, level))
+    geoTransform = (tileX_tl * 256 * res - origin, res, 0, origin - tileY_tl * 256 * res, 0, -res)
+    return geoTransform
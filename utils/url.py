@@ -1,6 +1,18 @@
+import re
 import random
+from urllib.parse import urlsplit
 from utils import tile_utils
 
+# 各数据源支持的最大级别
+max_zoom = {'tianditu': 18, 'google': 20, 'bing': 19, 'arcgis': 19}
+
+# 各数据源的镜像子域名，同一个瓦片可以从任一镜像获取；arcgis只有一个主机
+_mirrors = [
+    (re.compile(r'//mt(\d)\.google\.com/'), '//mt{}.google.com/', range(0, 4)),
+    (re.compile(r'//ecn\.t(\d)\.tiles\.virtualearth\.net/'), '//ecn.t{}.tiles.virtualearth.net/', range(0, 4)),
+    (re.compile(r'//t(\d)\.tianditu\.gov\.cn/'), '//t{}.tianditu.gov.cn/', range(1, 5)),
+]
+
 
 def format_url(datasource, tileX, dx, tileY, dy, zoom):
     headers = {
@@ -39,3 +51,30 @@ def format_url(datasource, tileX, dx, tileY, dy, zoom):
         url = "http://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/%d/%d/%d" % \
               (zoom, tileY + dy, tileX + dx)
     return url, headers
+
+
+_source_hosts = [('google.com', 'google'), ('virtualearth.net', 'bing'), ('tianditu.gov.cn', 'tianditu'),
+                 ('arcgisonline.com', 'arcgis')]
+
+
+def source_of(url):
+    """
+    由瓦片url的主机名得到数据源名称，无法识别时返回主机名
+    """
+    host = urlsplit(url).hostname or ''
+    for suffix, source in _source_hosts:
+        if host.endswith(suffix):
+            return source
+    return host
+
+
+def mirror_url(url):
+    """
+    把瓦片url换到同一数据源的另一个镜像子域名，没有其他镜像时返回None
+    """
+    for pattern, host, mirrors in _mirrors:
+        m = pattern.search(url)
+        if m is not None:
+            others = [i for i in mirrors if i != int(m.group(1))]
+            return url[:m.start()] + host.format(random.choice(others)) + url[m.end():]
+    return None
@@ -0,0 +1,124 @@
+import os
+from xml.sax.saxutils import escape
+import numpy as np
+from osgeo import gdal
+from utils.metrics import timed
+
+_color_interp = ['Red', 'Green', 'Blue']
+
+
+def _source_path(path, vrt_dir):
+    # 尽量使用相对于VRT的路径，整个目录移动后仍可打开；不同盘符时只能用绝对路径
+    try:
+        return os.path.relpath(path, vrt_dir).replace('\\', '/'), 1
+    except ValueError:
+        return os.path.abspath(path), 0
+
+
+def _write_mask(vrt_filename, placeholder_mask):
+    """
+    每个瓦片一个像素的掩膜文件{vrt}_mask.tif，占位瓦片为0，其余为255，VRT中按最近邻放大到全分辨率
+    :return: 掩膜文件路径
+    """
+    nX, nY = placeholder_mask.shape
+    mask_filename = os.path.splitext(vrt_filename)[0] + '_mask.tif'
+    dataset = gdal.GetDriverByName('GTiff').Create(mask_filename, nX, nY, 1, gdal.GDT_Byte, ['COMPRESS=DEFLATE'])
+    dataset.GetRasterBand(1).WriteRaster(0, 0, nX, nY, np.where(placeholder_mask.T, 0, 255).astype(np.uint8).tobytes())
+    dataset = None
+    return mask_filename
+
+
+def _write_vrt(vrt_filename, width, height, gt, epsg, sources, source_block_y, placeholder_mask=None):
+    """
+    :param sources: [(文件路径, 在输出中的x偏移, y偏移, 宽, 高)]
+    :param placeholder_mask: (nX, nY)的bool数组，指定时VRT带掩膜，占位瓦片处为nodata
+    """
+    vrt_dir = os.path.dirname(os.path.abspath(vrt_filename))
+    lines = [f'<VRTDataset rasterXSize="{width}" rasterYSize="{height}">',
+             f'  <SRS>EPSG:{epsg}</SRS>',
+             '  <GeoTransform>{}</GeoTransform>'.format(', '.join(repr(float(v)) for v in gt))]
+    for band in range(3):
+        lines.append(f'  <VRTRasterBand dataType="Byte" band="{band + 1}">')
+        lines.append(f'    <ColorInterp>{_color_interp[band]}</ColorInterp>')
+        for path, xoff, yoff, w, h in sources:
+            filename, relative = _source_path(path, vrt_dir)
+            # 写明源文件的尺寸，打开VRT时不必逐个打开源文件
+            lines.append('    <SimpleSource>'
+                         f'<SourceFilename relativeToVRT="{relative}">{escape(filename)}</SourceFilename>'
+                         f'<SourceBand>{band + 1}</SourceBand>'
+                         f'<SourceProperties RasterXSize="{w}" RasterYSize="{h}" DataType="Byte" '
+                         f'BlockXSize="{w}" BlockYSize="{source_block_y}"/>'
+                         f'<SrcRect xOff="0" yOff="0" xSize="{w}" ySize="{h}"/>'
+                         f'<DstRect xOff="{xoff}" yOff="{yoff}" xSize="{w}" ySize="{h}"/>'
+                         '</SimpleSource>')
+        lines.append('  </VRTRasterBand>')
+    if placeholder_mask is not None:
+        nX, nY = placeholder_mask.shape
+        filename, relative = _source_path(_write_mask(vrt_filename, placeholder_mask), vrt_dir)
+        lines += ['  <MaskBand>',
+                  '    <VRTRasterBand dataType="Byte">',
+                  '      <SimpleSource>'
+                  f'<SourceFilename relativeToVRT="{relative}">{escape(filename)}</SourceFilename>'
+                  '<SourceBand>1</SourceBand>'
+                  f'<SrcRect xOff="0" yOff="0" xSize="{nX}" ySize="{nY}"/>'
+                  f'<DstRect xOff="0" yOff="0" xSize="{width}" ySize="{height}"/>'
+                  '</SimpleSource>',
+                  '    </VRTRasterBand>',
+                  '  </MaskBand>']
+    lines.append('</VRTDataset>')
+    with open(vrt_filename, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+    print(f"VRT保存完成：{vrt_filename}，引用{len(sources)}个文件")
+
+
+@timed('merge_vrt')
+def writeTilesVRT(tmpdir, vrt_filename, nX, nY, gt, epsg=3857, placeholder_mask=None):
+    """
+    生成直接引用临时目录中{x}_{y}.jpg瓦片的VRT，缺失的瓦片处为0
+    :param gt: 网格左上角的仿射变换，见tile_utils.getMercatorGeoTransform
+    :param placeholder_mask: (nX, nY)的bool数组，有占位瓦片时另存掩膜文件，见_write_mask
+    """
+    sources = []
+    for x in range(nX):
+        for y in range(nY):
+            img_path = os.path.join(tmpdir, f"{x}_{y}.jpg")
+            if os.path.exists(img_path):
+                sources.append((img_path, x * 256, y * 256, 256, 256))
+    _write_vrt(vrt_filename, nX * 256, nY * 256, gt, epsg, sources, 1, placeholder_mask)
+
+
+@timed('merge_vrt')
+def writeBlocksVRT(jpg_dir, vrt_filename, width, height, gt, epsg=3857, placeholder_mask=None):
+    """
+    生成引用mergeInJPG输出的block_{sx}_{sy}_{ex}_{ey}.jpg的VRT
+    :param placeholder_mask: 见writeTilesVRT
+    """
+    sources = []
+    for block_filename in sorted(os.listdir(jpg_dir)):
+        if not block_filename.startswith('block_'):
+            continue
+        xs, ys, xe, ye = [int(v) for v in block_filename.split('.')[0].split('_')[-4:]]
+        sources.append((os.path.join(jpg_dir, block_filename), xs * 256, ys * 256,
+                        (xe - xs) * 256, (ye - ys) * 256))
+    _write_vrt(vrt_filename, width, height, gt, epsg, sources, 1, placeholder_mask)
+
+
+@timed('materialize_vrt')
+def materializeVRT(vrt_filename, tiff_filename, output='tiff', compress='JPEG', blocksize=512):
+    """
+    需要实体文件时再把VRT转换为GeoTIFF或COG
+    :param output: "tiff" 分块压缩的GeoTIFF；"cog" Cloud Optimized GeoTIFF(由COG驱动生成金字塔)
+    """
+    if output == 'cog':
+        options = [f'BLOCKSIZE={blocksize}', f'COMPRESS={compress}', 'BIGTIFF=IF_SAFER']
+        fmt = 'COG'
+    elif output == 'tiff':
+        options = ['TILED=YES', f'BLOCKXSIZE={blocksize}', f'BLOCKYSIZE={blocksize}', f'COMPRESS={compress}',
+                   'BIGTIFF=IF_SAFER']
+        if compress == 'JPEG':
+            options.append('PHOTOMETRIC=YCBCR')
+        fmt = 'GTiff'
+    else:
+        raise ValueError("unknow materialize output, {}".format(output))
+    gdal.Translate(tiff_filename, vrt_filename, format=fmt, creationOptions=options)
+    print("保存完成：" + tiff_filename)